@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Memory use and dict lookup speed of ExifEntry, against the dict-backed class it replaced.
+
+    python bench/bench_entries.py [--entries N]
+
+Entries are built the way load_exif_file() builds them: a fresh string for
+every field of every record, spread over a few hundred folders and cameras.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exif
+
+
+class LegacyExifEntry:
+    """ExifEntry before __slots__, interning and the cached key"""
+
+    def __init__(self, filename="", dirpath="", timestamp="", shutter_count="", serial_number="", make="", size="", dimensions=""):
+        self.filename = filename
+        self.dirpath = dirpath
+        self.timestamp = timestamp
+        self.serial_number = serial_number
+        self.shutter_count = shutter_count
+        self.make = make
+        self.size = size
+        self.dimensions = dimensions
+        self.file_ext = self.filename.lower().split('.')[-1] if '.' in self.filename else ''
+
+    def __eq__(self, x):
+        return self.uniq_str() == x.uniq_str()
+
+    def __hash__(self):
+        return hash(self.uniq_str())
+
+    def uniq_str(self):
+        return "".join([
+            self.timestamp or "",
+            self.make or "",
+            self.shutter_count or "",
+            self.serial_number or "",
+            self.file_ext or "",
+            self.size or "",
+            self.dimensions or ""
+        ])
+
+
+MAKES = ["NIKON CORPORATION", "Apple", "Canon", "SONY"]
+
+
+def records(n, distinct=None):
+    """Field values as fresh strings, the way json.loads produces them; only `distinct` keys are different"""
+    for j in range(n):
+        i = j % (distinct or n)
+        yield dict(
+            filename="DSC_%06d.NEF" % j,
+            dirpath="/photos/%04d/event-%03d" % (2000 + j % 20, j // 1000 % 300),
+            timestamp="20%02d:%02d:%02d %02d:%02d:%02d" % (i % 20, i % 12 + 1, i % 28 + 1, i % 24, i % 60, i * 7 % 60),
+            shutter_count=str(i),
+            serial_number="%d" % (3000000 + i % 8),
+            make="%s" % MAKES[i % len(MAKES)],
+            size="%.1f MB" % (20 + i % 50 / 10),
+            dimensions="%dx%d" % (6048, 4024),
+        )
+
+
+def measure(cls, n):
+    tracemalloc.start()
+    entries = [cls(**r) for r in records(n)]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    index = {}
+    start = time.perf_counter()
+    for e in entries:
+        index.setdefault(e, []).append(e)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(3):
+        for e in entries:
+            index[e]
+    lookup = (time.perf_counter() - start) / 3
+    return memory, build, lookup
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=500000)
+    args = parser.parse_args()
+
+    print("%-8s %14s %12s %12s" % ("", "bytes/entry", "index (s)", "lookup (s)"))
+    for name, cls in (("legacy", LegacyExifEntry), ("current", exif.ExifEntry)):
+        memory, build, lookup = measure(cls, args.entries)
+        print("%-8s %14.0f %12.3f %12.3f" % (name, memory / args.entries, build, lookup))
+
+
+if __name__ == "__main__":
+    main()
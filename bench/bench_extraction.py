@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Compare a plain `exiftool -j <dir>` with the extraction profile scan uses.
+
+    python bench/bench_extraction.py [--photos N] [--sidecars N] [--repeat N]
+
+Runs against whatever $EXIFTOOL points at (exiftool by default) on a synthetic
+directory, and reports the time per run and the size of the JSON to parse.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exif import exiftool
+from exif.exiftool import ExifTool, extraction_args
+from synthetic import make_directory
+
+
+def legacy(worker, dirpath):
+    return [worker.execute("-j", dirpath)[0]]
+
+
+def profile(worker, dirpath):
+    outputs = []
+    for formats in (exiftool.IMAGE_FORMATS, exiftool.VIDEO_FORMATS):
+        ext_args = [arg for f in formats for arg in ("-ext", f)]
+        outputs.append(worker.execute(*extraction_args(formats), *ext_args, dirpath)[0])
+    return outputs
+
+
+def measure(run, worker, dirpath, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = run(worker, dirpath)
+        records = sum(len(json.loads(o)) for o in outputs if o)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sum(len(o) for o in outputs), records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=500)
+    parser.add_argument("--sidecars", type=int, default=250)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        make_directory(dirpath, args.photos, args.sidecars)
+        worker = ExifTool()
+        try:
+            print("%-8s %10s %12s %8s" % ("", "best (s)", "JSON bytes", "records"))
+            for name, run in (("legacy", legacy), ("profile", profile)):
+                elapsed, size, records = measure(run, worker, dirpath, args.repeat)
+                print("%-8s %10.3f %12d %8d" % (name, elapsed, size, records))
+        finally:
+            worker.close()
+
+
+if __name__ == "__main__":
+    main()
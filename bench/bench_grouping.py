@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Time and peak memory of duplicate grouping with each find_duplicates --store.
+
+    python bench/bench_grouping.py [--entries N]
+
+Entries are streamed in as they would be from .exif_data files, so only what a
+store keeps is counted, not the entries themselves. Time is measured on a
+separate run from memory, since tracing allocations slows everything down.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exif
+from exif import grouping
+from bench_entries import records
+
+
+def group(make_grouper, n, distinct):
+    grouper = make_grouper()
+    for r in records(n, distinct):
+        e = exif.ExifEntry(**r)
+        grouper.add(e, e.path())
+    return sum(1 for _ in grouper.duplicate_groups())
+
+
+def measure(make_grouper, n, distinct):
+    start = time.perf_counter()
+    groups = group(make_grouper, n, distinct)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    group(make_grouper, n, distinct)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, groups
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=500000)
+    parser.add_argument("--memory-budget", type=int, default=16, metavar="MB",
+                        help="Memory budget of the external store, small enough that it spills")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Fraction of entries that duplicate another")
+    args = parser.parse_args()
+    distinct = int(args.entries * (1 - args.duplicates)) or 1
+
+    stores = [("dict", grouping.DictGrouper),
+              ("columnar (python)", lambda: grouping.ColumnarGrouper(use_numpy=False))]
+    if grouping.np is not None:
+        stores.append(("columnar (numpy)", lambda: grouping.ColumnarGrouper(use_numpy=True)))
+    stores.append(("external", lambda: grouping.ExternalGrouper(args.memory_budget * 1024 * 1024)))
+
+    print("%-18s %10s %14s %8s" % ("", "time (s)", "peak MB", "groups"))
+    for name, make_grouper in stores:
+        elapsed, peak, groups = measure(make_grouper, args.entries, distinct)
+        print("%-18s %10.2f %14.1f %8d" % (name, elapsed, peak / 1e6, groups))
+
+
+if __name__ == "__main__":
+    main()
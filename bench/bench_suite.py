@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Time every stage of the pipeline on a synthetic library.
+
+    python bench/bench_suite.py [--folders N] [--photos N] [--videos N] [--duplicates RATIO]
+                                [--file-size BYTES] [--ignored N] [--thumbs N] [--seed N]
+                                [--repeat N] [--output FILE]
+
+Generates a library with synthetic.make_library() and times, each on its own:
+
+scan             collect_exif_data.py on a library without .exif_data
+rescan           collect_exif_data.py again, with every .exif_data up to date
+hashing          SHA-256 of every file through a HashService
+find_duplicates  find_duplicates.py on the scanned library
+deduplicate      deduplicate.py into an empty target
+
+The scripts run as subprocesses, the way they are used. Unless $EXIFTOOL is
+set, they use fake_exiftool.py, so results don't depend on the installed
+exiftool. Each stage reports the best of --repeat runs. A JSON line with the
+parameters, the library counts and the stage times is appended to --output
+(bench_output.txt in the repository root) so runs can be compared over time.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import exif
+from exif import exiftool
+from exif.hashing import HashService
+from exif.walk import walk
+from synthetic import make_library
+
+STAGES = ("scan", "rescan", "hashing", "find_duplicates", "deduplicate")
+
+
+def script(name, *args, env):
+    subprocess.run([sys.executable, os.path.join(ROOT, name)] + list(args), env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def clear_scan(library):
+    for dirpath, _, filenames in os.walk(library):
+        for name in filenames:
+            if name.startswith(".exif_") and name != exif.EXIF_IGNORE_NAME:
+                os.remove(os.path.join(dirpath, name))
+
+
+def hash_all(library):
+    paths = [entry.path for _, files in walk(library) for entry in files if not entry.name.startswith(".")]
+    with HashService() as service:
+        for _ in service.map(paths):
+            pass
+
+
+def best_of(repeat, run, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--photos", type=int, default=50, help="Photos per folder")
+    parser.add_argument("--videos", type=int, default=5, help="Files without EXIF per folder")
+    parser.add_argument("--duplicates", type=float, default=0.2, help="Fraction of files that are copies")
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--ignored", type=int, default=1, help="Folders with an .exif_ignore file")
+    parser.add_argument("--thumbs", type=int, default=1, help="Thumbnail folders")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench_output.txt"))
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault(exiftool.EXIFTOOL_ENV, "%s %s" % (sys.executable, os.path.join(ROOT, "fake_exiftool.py")))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = os.path.join(tmp, "library")
+        target = os.path.join(tmp, "target")
+        counts = make_library(library, args.folders, args.photos, args.videos, args.duplicates, args.file_size,
+                              args.ignored, args.thumbs, args.seed)
+
+        def clear_target():
+            shutil.rmtree(target, ignore_errors=True)
+
+        times = {
+            "scan": best_of(args.repeat, lambda: script("collect_exif_data.py", library, env=env),
+                            lambda: clear_scan(library)),
+            "rescan": best_of(args.repeat, lambda: script("collect_exif_data.py", library, env=env)),
+            "hashing": best_of(args.repeat, lambda: hash_all(library)),
+            "find_duplicates": best_of(args.repeat, lambda: script("find_duplicates.py", library, env=env)),
+            "deduplicate": best_of(args.repeat, lambda: script("deduplicate.py", library, target, env=env),
+                                   clear_target),
+        }
+
+    result = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "exiftool": env[exiftool.EXIFTOOL_ENV],
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "library": counts,
+        "seconds": {stage: round(times[stage], 4) for stage in STAGES},
+    }
+    with open(args.output, "a") as fp:
+        fp.write(json.dumps(result, sort_keys=True) + "\n")
+
+    print("%d folders, %d files, %.1f MB, %d duplicates, %d in pruned folders" % (
+        counts["folders"], counts["files"], counts["bytes"] / 1e6, counts["duplicates"], counts["pruned"]))
+    print("%-16s %10s" % ("", "best (s)"))
+    for stage in STAGES:
+        print("%-16s %10.3f" % (stage, times[stage]))
+    print("Appended to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
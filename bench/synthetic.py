@@ -0,0 +1,139 @@
+"""
+Synthetic photo libraries for the benchmarks.
+
+The JPEGs written here are tiny but real: an EXIF APP1 segment with the tags
+scan reads (including a Nikon maker note), a SOF marker and padding standing in
+for the image data, so both exiftool and exif.native can parse them.
+
+make_library() writes whole libraries for fake_exiftool.py instead: each photo
+starts with a JSON line of its tags, the format the tests use, followed by
+random bytes up to the requested file size.
+"""
+
+import json
+import os
+import random
+import struct
+
+SIDECAR_EXTS = ("xmp", "txt", "png", "aae")
+
+
+def _ifd(entries, offset):
+    data_pos = offset + 2 + 12 * len(entries) + 4
+    head = struct.pack("<H", len(entries))
+    data = b""
+    for tag, value in sorted(entries):
+        if isinstance(value, list):
+            head += struct.pack("<HHII", tag, 4, 1, data_pos + len(data))
+            data += _ifd(value, data_pos + len(data))
+            continue
+        if isinstance(value, str):
+            typ, raw, count = 2, value.encode() + b"\0", len(value) + 1
+        elif isinstance(value, int):
+            typ, raw, count = 4, struct.pack("<I", value), 1
+        else:
+            typ, raw, count = 7, value, len(value)
+        if len(raw) <= 4:
+            field = raw.ljust(4, b"\0")
+        else:
+            field = struct.pack("<I", data_pos + len(data))
+            data += raw
+        head += struct.pack("<HHI", tag, typ, count) + field
+    return head + b"\0\0\0\0" + data
+
+
+def _tiff(entries):
+    return b"II*\0" + struct.pack("<I", 8) + _ifd(entries, 8)
+
+
+def jpeg(timestamp, make="NIKON CORPORATION", serial_number="3012345", shutter_count=1,
+         width=6048, height=4024, padding=16 * 1024):
+    """A JPEG with EXIF; `padding` bytes stand in for the compressed image"""
+    maker_note = b"Nikon\0\x02\x10\0\0" + _tiff([(0x001d, serial_number), (0x00a7, shutter_count)])
+    exif_ifd = [(0x9003, timestamp), (0x927c, maker_note)]
+    app1 = b"Exif\0\0" + _tiff([(0x010f, make), (0x8769, exif_ifd)])
+    sof = struct.pack(">BHHB", 8, height, width, 3) + b"\x01\x11\0\x02\x11\x01\x03\x11\x01"
+    return (b"\xff\xd8"
+            + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+            + b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof
+            + b"\xff\xda\0\x02" + b"\0" * padding + b"\xff\xd9")
+
+
+def make_directory(dirpath, photos=200, sidecars=100, padding=16 * 1024):
+    """Fill dirpath with `photos` JPEGs and `sidecars` files scan should ignore"""
+    os.makedirs(dirpath, exist_ok=True)
+    for i in range(photos):
+        timestamp = "2023:%02d:%02d %02d:%02d:%02d" % (i // 672 % 12 + 1, i // 24 % 28 + 1, i % 24, i % 60, i * 7 % 60)
+        with open(os.path.join(dirpath, "DSC_%04d.jpg" % i), "wb") as fp:
+            fp.write(jpeg(timestamp, shutter_count=i + 1, padding=padding))
+    for i in range(sidecars):
+        with open(os.path.join(dirpath, "DSC_%04d.%s" % (i, SIDECAR_EXTS[i % len(SIDECAR_EXTS)])), "wb") as fp:
+            fp.write(b"\0" * 1024)
+
+
+def fake_photo(path, tags, size, rng):
+    """A file fake_exiftool.py reports with `tags`, padded with random bytes to `size`"""
+    header = json.dumps(tags).encode() + b"\n"
+    with open(path, "wb") as fp:
+        fp.write(header + rng.randbytes(max(size - len(header), 0)))
+
+
+def make_library(root, folders=20, photos=50, videos=5, duplicates=0.2, file_size=64 * 1024,
+                 ignored=1, thumbs=1, seed=0):
+    """
+    Write a library of `folders` folders below root and return its counts.
+
+    Each folder holds `photos` photos and `videos` videos without EXIF. A
+    `duplicates` fraction of them are byte-for-byte copies of an earlier photo
+    or video. `ignored` folders with an .exif_ignore file and `thumbs`
+    thumbnail folders hold copies that scanning must prune. The same seed
+    always gives the same library.
+    """
+    rng = random.Random(seed)
+    written = {"photo": [], "video": []}
+    counts = {"folders": 0, "files": 0, "bytes": 0, "duplicates": 0, "pruned": 0}
+
+    def write(dirpath, name, tags=None):
+        path = os.path.join(dirpath, name)
+        earlier = written["video" if tags is None else "photo"]
+        if earlier and rng.random() < duplicates:
+            with open(rng.choice(earlier), "rb") as src, open(path, "wb") as dst:
+                dst.write(src.read())
+            counts["duplicates"] += 1
+        elif tags is None:
+            with open(path, "wb") as fp:
+                fp.write(rng.randbytes(file_size))
+        else:
+            fake_photo(path, tags, file_size, rng)
+        earlier.append(path)
+        counts["files"] += 1
+        counts["bytes"] += os.path.getsize(path)
+
+    for f in range(folders):
+        dirpath = os.path.join(root, "%d" % (2000 + f // 12), "%02d-event-%d" % (f % 12 + 1, f))
+        os.makedirs(dirpath, exist_ok=True)
+        counts["folders"] += 1
+        for i in range(photos):
+            n = f * photos + i
+            write(dirpath, "IMG_%05d.jpg" % n, {
+                "DateTimeOriginal": "%d:%02d:%02d %02d:%02d:%02d" % (
+                    2000 + f // 12, f % 12 + 1, n % 28 + 1, n // 3600 % 24, n // 60 % 60, n % 60),
+                "Make": "Apple",
+                "ImageSize": "4032x3024",
+            })
+        for i in range(videos):
+            write(dirpath, "clip_%05d.mov" % (f * videos + i))
+
+    # pruned subtrees hold copies of files that are also elsewhere, like real caches do
+    pruned_dirs = [os.path.join(root, "ignored-%d" % i) for i in range(ignored)]
+    pruned_dirs += [os.path.join(root, ".thumbnails-%d" % i) for i in range(thumbs)]
+    for i, dirpath in enumerate(pruned_dirs):
+        os.makedirs(dirpath)
+        if i < ignored:
+            open(os.path.join(dirpath, ".exif_ignore"), "w").close()
+        for src in written["photo"][:photos]:
+            with open(src, "rb") as fp, open(os.path.join(dirpath, os.path.basename(src)), "wb") as dst:
+                dst.write(fp.read())
+            counts["pruned"] += 1
+
+    return counts
@@ -5,10 +5,15 @@ import argparse
 import os
 import sys
 import json
-import subprocess
-import shlex
-
-SUPPORTED_FORMATS = ("nef", "jpg", "heic", "heif", "mov", "mp4")
+import functools
+import signal
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from exif import exiftool, inotify, metrics, native
+from exif.catalog import Catalog
+from exif.walk import walk
+from exif.watch import Watcher, Library, DEFAULT_SETTLE, DEFAULT_MAX_WAIT
+from exif.exiftool import SUPPORTED_FORMATS, file_ext
 
 def is_img(f):
     if "." not in f:
@@ -18,99 +23,283 @@ def is_img(f):
     return ext in SUPPORTED_FORMATS
 
 
-ignore_cache = set()
+def scan(dirname, strict, jobs=1, catalog=None, use_native=False):
+    entries = []
+    dirs = walk(dirname)
 
-def is_ignored(dirpath):
-    if os.path.exists(os.path.join(dirpath, exif.EXIF_IGNORE_NAME)):
-        # ignore dirs with the ignore file
-        ignore_cache.add(dirpath)
-        return True
+    for dirpath, dir_entries in scan_dirs(dirs, strict, jobs, use_native):
+        print("Scanning dir %s" % dirpath)
+        dir_entries = dir_entries()
+        if catalog is not None:
+            catalog.replace_dir(dirpath, dir_entries)
+        entries.extend(dir_entries)
 
-    for ignored_dir in ignore_cache:
-        if dirpath.startswith(ignored_dir):
-            # ignore all child dirs
-            return True
+    for entry in entries:
+        print(entry)
+    print("Exif count: %d" % len(entries))
 
-    return False
 
-def scan(dirname, strict):
-    entries = []
+def watch(dirname, strict, jobs=1, catalog=None, use_native=False, deduplicator=None, settle=DEFAULT_SETTLE,
+          max_wait=DEFAULT_MAX_WAIT):
+    """
+    Scan dirname once, then keep its .exif_data up to date as files change, until interrupted.
 
-    for dirpath, _, filenames in os.walk(dirname):
+    Only the files that changed are passed to exiftool again, as in any rescan.
+    New or changed entries are printed along with the other files in the
+    library that have the same key, and given to `deduplicator` to be placed
+    in its target when there is one.
+    """
+    library = Library()
+    is_relevant = lambda name: is_img(name) or name == exif.EXIF_IGNORE_NAME
+    with Watcher(dirname, is_relevant, settle, max_wait) as watcher:
+        for dirpath, dir_entries in scan_dirs(watcher.watch_tree(dirname), strict, jobs, use_native):
+            dir_entries = dir_entries()
+            library.update(dirpath, dir_entries)
+            if catalog is not None:
+                catalog.replace_dir(dirpath, dir_entries)
+        print("Watching %d folders with %d entries" % (len(watcher.wds), len(library)))
 
-        if is_ignored(dirpath):
-            continue
+        try:
+            for changed, removed in watcher.batches():
+                for dirpath in removed:
+                    print("Removed dir %s" % dirpath)
+                    library.forget(dirpath)
+                    if catalog is not None:
+                        catalog.replace_dir(dirpath, [])
 
-        print("Scanning dir %s" % dirpath)
-        exif_file_exists = exif.EXIF_FILE_NAME in filenames
-        exif_file_path = os.path.join(dirpath, exif.EXIF_FILE_NAME)
+                for dirpath, files in changed.items():
+                    print("Scanning dir %s" % dirpath)
+                    try:
+                        dir_entries = scan_one(dirpath, files, strict, use_native)
+                    except exiftool.FileErrors as e:
+                        # left as it was, and scanned again on its next change
+                        print("Error running exiftool\n%s" % e)
+                        continue
+                    added = library.update(dirpath, dir_entries)
+                    if catalog is not None:
+                        catalog.replace_dir(dirpath, dir_entries)
+                    for entry in added:
+                        print(entry)
+                        for path in library.duplicates_of(entry):
+                            print("  same as %s" % path)
+                    if deduplicator is not None and added:
+                        deduplicator.place_all(added)
+        except KeyboardInterrupt:
+            print("Stopped watching %s" % dirname)
 
-        # check if the dir is writeable before running a potentially expensive exiftool command
-        if not os.access(dirpath, os.W_OK):
-            continue
 
-        # TODO: Ensure exif file does not need to be regnerated based on something
-        if exif_file_exists:
-            with open(exif_file_path) as fp:
-                dir_entries = list(exif.load_exif_file(fp, dirpath))
-        else:
-            dir_entries = list()
+def scan_dirs(dirs, strict, jobs=1, use_native=False):
+    """
+    Yield (dirpath, dir_entries) for each (dirpath, files) in `dirs`, in order.
+
+    Calling dir_entries() returns the entries of that directory. With jobs > 1 the
+    directories are scanned ahead on a thread pool; exiftool runs out of process
+    and hashlib releases the GIL, so threads are enough to keep every core busy.
+    """
+    if jobs <= 1:
+        for dirpath, files in dirs:
+            yield dirpath, functools.partial(scan_one, dirpath, files, strict, use_native)
+        return
+
+    exiftool.get_pool(jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for dirpath, files in dirs:
+            pending.append((dirpath, executor.submit(scan_one, dirpath, files, strict, use_native)))
+            if len(pending) >= jobs * 4:
+                dirpath, future = pending.popleft()
+                yield dirpath, future.result
+
+        while pending:
+            dirpath, future = pending.popleft()
+            yield dirpath, future.result
+
+
+def scan_one(dirpath, files, strict, use_native=False):
+    """
+    Load the entries of a single directory, updating its .exif_data if needed.
+
+    `files` are the os.DirEntry objects of the directory, as yielded by walk().
+    The (size, mtime_ns, inode) of every image is recorded in .exif_stat, so on a
+    rescan only files that were added or changed since are passed to exiftool.
+    """
+    filenames = {f.name for f in files}
+    exif_file_exists = exif.EXIF_FILE_NAME in filenames
+    exif_file_path = os.path.join(dirpath, exif.EXIF_FILE_NAME)
+    stat_file_path = os.path.join(dirpath, exif.EXIF_STAT_NAME)
+
+    # check if the dir is writeable before running a potentially expensive exiftool command
+    if not os.access(dirpath, os.W_OK):
+        return []
+
+    img_entries = [f for f in files if is_img(f.name)]
+    img_files = [f.name for f in img_entries]
+    metrics.count("files_scanned", len(img_files))
+
+    if len(img_files) == 0:
+        return []
 
-        img_files = {f.lower() for f in filenames if is_img(f)}
+    if exif_file_exists:
+        with open(exif_file_path) as fp:
+            dir_entries = list(exif.load_exif_file(fp, dirpath))
+        cached_stats = exif.load_stat_file(stat_file_path)
+    else:
+        dir_entries = list()
+        cached_stats = None
 
-        if len(img_files) == 0:
-            continue
+    current_stats = {}
+    for f in img_entries:
+        try:
+            current_stats[f.name] = exif.stat_key(f.stat())
+        except OSError:
+            pass
 
-        if "thumb" in dirpath.lower() or "preview" in dirpath.lower():
-            continue
+    known_files = {e.filename for e in dir_entries}
+    if not exif_file_exists:
+        changed = set(current_stats)
+    elif cached_stats is None:
+        # .exif_data from before stats were recorded: trust it, but pick up new files
+        needs_regen = strict and {f.lower() for f in img_files} != {f.lower() for f in known_files}
+        changed = set(current_stats) if needs_regen else set(current_stats) - known_files
+    else:
+        changed = {f for f, st in current_stats.items() if cached_stats.get(f) != st}
 
-        needs_regen = strict and img_files != {e.filename.lower() for e in dir_entries}
-        if not exif_file_exists or needs_regen:
-            generated_dir_entries = True
-            dir_entries = [exif_entry for exif_entry in scan_dir(dirpath, filenames)]
+    # entries for other files, such as sidecars an .exif_data from before -ext holds, are dropped too
+    removed = {f for f in known_files if f not in filenames or not is_img(f)}
+
+    if not changed and not removed and cached_stats == current_stats:
+        return dir_entries
+
+    metrics.count("files_extracted", len(changed))
+    if changed:
+        if changed == set(current_stats):
+            new_entries = list(scan_dir(dirpath, filenames, use_native))
         else:
-            generated_dir_entries = False
+            new_entries = list(scan_files(dirpath, sorted(changed), use_native))
+        dir_entries = [e for e in dir_entries if e.filename not in changed and e.filename not in removed] + new_entries
+    else:
+        dir_entries = [e for e in dir_entries if e.filename not in removed]
 
-        if generated_dir_entries:
-            with open(exif_file_path, "w") as fp:
-                for entry in sorted(dir_entries, key=lambda e: e.filename):
-                    fp.write(json.dumps(entry.as_dict()) + "\n")
+    dir_entries.sort(key=lambda e: e.filename)
+    with metrics.phase("json"):
+        with open(exif_file_path, "w") as fp:
+            for entry in dir_entries:
+                fp.write(json.dumps(entry.as_dict()) + "\n")
+        exif.save_stat_file(stat_file_path, current_stats)
 
-        entries.extend(dir_entries)
-    for entry in entries:
-        print(entry)
-    print("Exif count: %d" % len(entries))
+    return dir_entries
 
 
-def scan_dir(dirpath, filenames):
-    proc = subprocess.run(shlex.split('exiftool -j "%s"' % dirpath), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    raw_json = proc.stdout
+def scan_dir(dirpath, filenames, use_native=False):
+    if use_native:
+        return run_native(dirpath, sorted(f for f in filenames if is_img(f)))
+    return run_exiftool(dirpath, [dirpath], filenames)
 
-    if len(raw_json) == 0:
-        return
 
-    exiftool_data = json.loads(raw_json)
+def scan_files(dirpath, filenames, use_native=False):
+    """Like scan_dir, for only the given files of the directory"""
+    if use_native:
+        return run_native(dirpath, filenames)
+    return run_exiftool(dirpath, [os.path.join(dirpath, f) for f in filenames])
 
-    if proc.returncode != 0:
-        print("Error running exiftool")
-        for e in exiftool_data:
-            if "Error" in e:
-                print("%s: %s" % (os.path.join(dirpath, e["FileName"]), e["Error"]))
-        sys.exit(1)
 
-    for e in exiftool_data:
-        yield exif.from_exif_entry(e, dirpath)
+def run_native(dirpath, filenames):
+    """Read the headers of the files in process, passing only those it can't handle to exiftool"""
+    entries = []
+    fallback = []
+    with metrics.phase("native"):
+        for f in filenames:
+            try:
+                entries.append(exif.from_exif_entry(native.read_tags(os.path.join(dirpath, f)), dirpath))
+            except (native.Unsupported, OSError):
+                fallback.append(os.path.join(dirpath, f))
+
+    if fallback:
+        entries.extend(run_exiftool(dirpath, fallback))
+    return entries
+
+
+def run_exiftool(dirpath, paths, filenames=None):
+    """
+    The entries of `paths`, which is either [dirpath] or files in dirpath.
+
+    Records are parsed as exiftool prints them, so a huge directory is never
+    held in memory as one JSON document. See exiftool.extract_dir() for the
+    commands sent; given the directory's `filenames`, one for images or
+    videos is only sent if it has some. If exiftool fails on any file,
+    FileErrors is raised once every command has finished, and no entry is
+    returned.
+    """
+    if paths == [dirpath]:
+        exts = None if filenames is None else {file_ext(f) for f in filenames}
+        records = exiftool.extract_dir(dirpath, exts)
+    else:
+        records = exiftool.extract_files(paths)
+    entries = []
+    errors = {}
+
+    for e in records:
+        # -stay_open mode has no exit status, per-file failures only show up as "Error" tags
+        if "Error" in e:
+            errors[e.get("SourceFile") or os.path.join(dirpath, e["FileName"])] = e["Error"]
+        elif not errors:
+            entries.append(exif.from_exif_entry(e, dirpath))
+
+    if errors:
+        raise exiftool.FileErrors(errors)
+    return entries
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("dir", help="Root folder to scan")
-    parser.add_argument("-s", "--strict", action="store_true", help="Be strict about regenerating .exif_data")
+    parser.add_argument("-s", "--strict", action="store_true", help="Regenerate .exif_data without recorded stats when its files do not match the directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of directories to scan in parallel")
+    parser.add_argument("-c", "--catalog", help="Also record the scanned entries in this catalog database")
+    parser.add_argument("-n", "--native", action="store_true", help="Read JPEG, NEF and HEIC headers in process, using exiftool only for other files")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Keep running after the scan, rescanning folders as their files change (Linux inotify)")
+    parser.add_argument("--organize", metavar="TARGET_ROOT",
+                        help="With --watch, place new arrivals into TARGET_ROOT the way deduplicate does")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE,
+                        help="With --watch, seconds without changes before rescanning")
+    parser.add_argument("--max-wait", type=float, default=DEFAULT_MAX_WAIT,
+                        help="With --watch, seconds after which changes are rescanned even if more keep arriving")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
     if not os.path.exists(args.dir):
         print("Error: Path does not exist: %s" % args.dir)
         sys.exit(1)
-    scan(args.dir, args.strict)
+    if args.watch and not inotify.available():
+        print("Error: --watch needs inotify")
+        sys.exit(1)
+    if args.organize and not args.watch:
+        print("Error: --organize only works with --watch")
+        sys.exit(1)
+    if args.watch:
+        # stop cleanly, closing the catalog and target, when the daemon is terminated
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    catalog = Catalog(args.catalog) if args.catalog else None
+    try:
+        with metrics.reporting(args):
+            if not args.watch:
+                scan(args.dir, args.strict, args.jobs, catalog, args.native)
+            elif args.organize:
+                from deduplicate import Deduplicator
+                from exif.hashing import HashService
+                with HashService() as service, Deduplicator(args.organize, args.dir, hash_service=service) as d:
+                    watch(args.dir, args.strict, args.jobs, catalog, args.native, d, args.settle, args.max_wait)
+            else:
+                watch(args.dir, args.strict, args.jobs, catalog, args.native, settle=args.settle,
+                      max_wait=args.max_wait)
+    except exiftool.FileErrors as e:
+        print("Error running exiftool\n%s" % e)
+        sys.exit(1)
+    finally:
+        exiftool.shutdown()
+        if catalog is not None:
+            catalog.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,32 @@
+import pytest
+import json
+import os
+import sys
+from exif import exiftool
+
+FAKE_EXIFTOOL = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_exiftool.py")]
+
+
+@pytest.fixture
+def tmp(tmp_path):
+    """A scratch folder, as a str path"""
+    return str(tmp_path)
+
+
+@pytest.fixture
+def write_photo():
+    """Write a file that fake_exiftool.py reports with the given tags"""
+    def write(dirpath, name, tags, payload=b""):
+        with open(os.path.join(dirpath, name), "wb") as fp:
+            fp.write(json.dumps(tags).encode() + b"\n" + payload)
+        return os.path.join(dirpath, name)
+    return write
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    """Point the shared exiftool pool at fake_exiftool.py"""
+    monkeypatch.setenv(exiftool.EXIFTOOL_ENV, " ".join(FAKE_EXIFTOOL))
+    exiftool.shutdown()
+    yield exiftool.get_pool()
+    exiftool.shutdown()
@@ -5,20 +5,33 @@ import os
 import sys
 import json
 import exif
-import shutil
-from collections import defaultdict
-
-
-def collect_all_files(dirname):
-    """Collect all files (both EXIF and NoExif) by scanning directory"""
-    from collect_exif_data import scan_dir, is_img, is_ignored
-
-    for dirpath, dirnames, filenames in os.walk(dirname):
-        if is_ignored(dirpath):
-            continue
-
-        if "thumb" in dirpath.lower() or "preview" in dirpath.lower():
+import sqlite3
+import tempfile
+import itertools
+import queue
+import threading
+from exif import exiftool, metrics, shard
+from exif.catalog import Catalog
+from exif.hashing import HashService, DEFAULT_WORKERS, DEFAULT_DEVICE_LIMIT
+from exif.transfer import Transferrer, transfer_file, MODES
+from exif.transfer import DEFAULT_WORKERS as DEFAULT_TRANSFER_WORKERS
+from exif.hashstore import HashStore
+from exif.journal import Journal, settle
+from exif.target_index import TargetIndex
+from exif.walk import walk
+
+
+STREAM_QUEUE_SIZE = 1024
+
+
+def collect_all_files(dirname, skip_dirs=()):
+    """Collect all files (both EXIF and NoExif) by scanning directory, except those in skip_dirs"""
+    from collect_exif_data import scan_dir, is_img
+
+    for dirpath, files in walk(dirname):
+        if dirpath in skip_dirs:
             continue
+        filenames = [f.name for f in files]
 
         # Check if directory has supported image/video files
         img_files = [f for f in filenames if is_img(f)]
@@ -44,120 +57,477 @@ def collect_all_files(dirname):
                 continue
 
 
-def handle_noexif_file(noexif_file, target_root, scan_root, existing_hashes, hash_file_path, force_move=False):
-    """Handle files without EXIF data using hash-based deduplication"""
-    noexif_dir = os.path.join(target_root, "noexif")
+def noexif_target_path(noexif_file, target_root, scan_root):
+    """Where a NoExifFile is placed: its path relative to scan_root, below target_root/noexif"""
+    return os.path.join(target_root, "noexif", noexif_file.relative_path(scan_root))
 
-    # If hash already exists, skip the file
-    if noexif_file.file_hash in existing_hashes:
-        print(f"{noexif_file.path()} already exists (hash match)")
-        return False
 
-    # Create target directory structure preserving relative path
-    relative_path = noexif_file.relative_path(scan_root)
-    target_file_path = os.path.join(noexif_dir, relative_path)
-    target_dir = os.path.dirname(target_file_path)
+def target_path(entry, target_root):
+    """Where an ExifEntry is placed: target_root/YYYY/MM/DD/HH-MM-SS-<shutter count or make>.<ext>"""
+    date_part, time_part = entry.timestamp.split()
+    year, month, day = date_part.split(":") if ":" in date_part else date_part.split("/")
+    hour, minute, second = time_part.split(":")
+    target_dir = os.path.join(target_root, year, month, day)
 
-    # Create directory if it doesn't exist
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+    shutter_count_valid = entry.shutter_count is not None \
+            and entry.shutter_count != "" \
+            and entry.shutter_count != "None"
 
-    # Copy or move the file
-    source_path = noexif_file.path()
-    if not os.path.exists(target_file_path):
-        try:
-            if force_move:
-                shutil.move(source_path, target_file_path)
-            else:
-                shutil.copyfile(source_path, target_file_path)
+    identifier = entry.shutter_count if shutter_count_valid else (entry.make or "Unknown")
+    file_name = "%s.%s" % ("-".join([hour, minute, second, identifier]), entry.file_ext)
 
-            # Save hash to file and add to in-memory set
-            exif.save_hash_to_file(hash_file_path, noexif_file.file_hash)
-            existing_hashes.add(noexif_file.file_hash)
+    return os.path.join(target_dir, file_name)
 
-            print(f"{source_path} -> {target_file_path}")
-            return True
-        except (IOError, OSError) as e:
-            print(f"Error copying {source_path}: {e}")
-            return False
-    else:
-        print(f"{target_file_path} already exists")
-        return False
 
+class SeenKeys:
+    """
+    Set of dedup keys kept in a throwaway SQLite database in the local temp
+    folder, or dirpath.
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("scan_root", help="Root folder to scan")
-    parser.add_argument("target_root", help="Root folder to place all images")
-    parser.add_argument("--force", "-f", action="store_true", help="Move instead of copy")
-    args = parser.parse_args()
+    Memory use stays the same no matter how many keys are added; SQLite's page
+    cache is bounded and spills to disk.
+    """
+
+    def __init__(self, dirpath=None):
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="dedupe-seen-", dir=dirpath)
+        self.db = sqlite3.connect(os.path.join(self._tmpdir.name, "seen.db"))
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID")
+
+    def add(self, key):
+        """Add key, returning False if it had already been added"""
+        return self.db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key,)).rowcount == 1
+
+    def __contains__(self, key):
+        return self.db.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone() is not None
+
+    def close(self):
+        self.db.close()
+        self._tmpdir.cleanup()
 
-    if not os.path.exists(args.scan_root):
-        print("Error: Path does not exist: %s" % args.dir)
-        sys.exit(1)
 
-    exif_photo_dict = defaultdict(list)
-    noexif_files = []
+class Deduplicator:
+    """
+    Places entries into target_root as they arrive.
 
-    # Collect all files from fresh scan
-    for entry in collect_all_files(args.scan_root):
+    The first ExifEntry with a given key is placed and later ones are skipped,
+    the same as grouping every entry first and copying the first of each group.
+    NoExifFiles are deduplicated by content hash against the HashStore in
+    target_root/noexif.
+
+    Files are copied by a Transferrer, so place() only schedules the transfer;
+    the outcome of each one is printed when it finishes and the counters are
+    final once close() returns.
+
+    What is already in target_root is looked up in a TargetIndex, listed once
+    here or loaded from `manifest` (which close() then rewrites).
+
+    The seen keys and the TargetIndex are kept in SQLite databases in the local
+    temp folder, or `tmp_dir`, and the HashStore holds a bounded number of new
+    hashes, so memory doesn't grow with the number of files. What does grow
+    is the set of folders a resumed run skips: those its interrupted run
+    finished.
+
+    With a `journal`, every transfer is planned in it before it starts, and a
+    run the journal shows was interrupted is resumed: its unfinished transfers
+    are settled first, and journal.run.dirs lists the folders not to scan again.
+    """
+
+    def __init__(self, target_root, scan_root, force_move=False, hash_service=None, transferrer=None,
+                 manifest=None, journal=None, tmp_dir=None):
+        self.target_root = target_root
+        self.scan_root = scan_root
+        self.force_move = force_move
+        self.hash_service = hash_service
+        self.transferrer = transferrer or Transferrer("move" if force_move else "copy", 1)
+        self.manifest = manifest
+        self.journal = journal
+        self.hashes = None
+
+        os.makedirs(target_root, exist_ok=True)
+        self.resumed = journal is not None and journal.start(scan_root, self.transferrer.mode)
+        if self.resumed:
+            # before the target is listed, as settling removes copies cut short
+            self.recover()
+
+        if manifest:
+            self.index = TargetIndex.load(target_root, manifest, tmp_dir)
+        else:
+            self.index = TargetIndex.scan(target_root, tmp_dir)
+        self.seen = SeenKeys(tmp_dir)
+
+        self.claimed = set()
+        self._batch = None
+        self.lock = threading.Lock()  # callbacks run on the transfer workers
+        self.placed_count = 0
+        self.noexif_count = 0
+        self.copied_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(finished=exc_type is None)
+
+    def close(self, finished=True):
+        self.transferrer.close()
+        self.seen.close()
+        if self.hashes is not None:
+            self.hashes.close()
+        if self.journal is not None:
+            if finished:
+                self.journal.end()
+            self.journal.close()
+        if self.manifest:
+            self.index.save(self.manifest)
+        self.index.close()
+        if self.noexif_count:
+            print(f"Processed {self.noexif_count} NoExif files, copied {self.copied_count} new files")
+        print(self.transferrer.report())
+
+    def place_all(self, entries):
+        """Place a batch of entries, typically one directory, hashing its NoExifFiles in parallel first"""
+        if self.hash_service is not None:
+            self.hash_service.hash_files([e for e in entries if isinstance(e, exif.NoExifFile)])
+
+        self._batch = []
+        for entry in entries:
+            self.place(entry)
+        futures, self._batch = self._batch, None
+
+        if self.journal is not None and entries:
+            self._track_dir(entries[0].dirpath, futures)
+
+    def recover(self):
+        """Settle the transfers an interrupted run left unfinished, and restore the hashes of its copies"""
+        run = self.journal.run
+        for plan in run.pending():
+            self.journal.outcome(plan["id"], "done" if settle(plan) else "fail")
+
+        # hashes are written in batches, so the last ones may not have made it
+        hashed = [plan["hash"] for plan in run.done() if "hash" in plan]
+        if hashed:
+            noexif_dir = os.path.join(self.target_root, "noexif")
+            os.makedirs(noexif_dir, exist_ok=True)
+            self.hashes = HashStore(noexif_dir)
+            for file_hash in hashed:
+                self.hashes.add(file_hash)
+
+        # only run.dirs is needed from here on
+        run.plans.clear()
+        run.outcomes.clear()
+        print(f"Resuming the interrupted run into {self.target_root}: {len(run.dirs)} folders already done")
+
+    def _track_dir(self, dirpath, futures):
+        """Record dirpath as done in the journal once every transfer from it has finished"""
+        if not futures:
+            self.journal.dir_done(dirpath)
+            return
+
+        state = {"remaining": len(futures), "failed": False}
+
+        def done(future):
+            error = future.exception()
+            with self.lock:
+                state["failed"] |= error is not None and not isinstance(error, FileExistsError)
+                state["remaining"] -= 1
+                finished = state["remaining"] == 0 and not state["failed"]
+            if finished:
+                self.journal.dir_done(dirpath)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _transfer(self, src, dst, done, file_hash=None):
+        """Schedule a transfer, planned in the journal first if there is one"""
+        if self.journal is None:
+            future = self.transferrer.submit(src, dst)
+        else:
+            op_id, seq = self.journal.plan(src, dst, self.transferrer.mode, file_hash)
+            future = self.transferrer.submit(src, dst, before=lambda: self.journal.sync(seq))
+            future.add_done_callback(
+                lambda f: self.journal.outcome(op_id, "fail" if f.exception() is not None else "done"))
+
+        future.add_done_callback(done)
+        if self._batch is not None:
+            self._batch.append(future)
+
+    def place(self, entry):
+        """Schedule entry to be placed, returning False if it is skipped as a duplicate"""
         if isinstance(entry, exif.ExifEntry):
-            exif_photo_dict[entry].append(entry)
+            return self.place_exif(entry)
         elif isinstance(entry, exif.NoExifFile):
-            noexif_files.append(entry)
+            return self.place_noexif(entry)
+        return False
 
-    # Handle EXIF files with timestamp-based organization
-    for k, v in exif_photo_dict.items():
-        to_copy = v[0]
+    def place_exif(self, entry):
+        if not self.seen.add(entry.uniq_str()):
+            return False
 
-        date_part, time_part = k.timestamp.split()
-        year, month, day = date_part.split(":") if ":" in date_part else date_part.split("/")
-        hour, minute, second = time_part.split(":")
-        target_dir = os.path.join(args.target_root, year, month, day)
+        dest_file = target_path(entry, self.target_root)
+        if self.index.exists(dest_file):
+            print("%s is already copied" % entry.path())
+            return False
 
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
+        self.index.makedirs(os.path.dirname(dest_file))
+        self.index.add(dest_file)
 
-        shutter_count_valid = k.shutter_count is not None \
-                and k.shutter_count != "" \
-                and k.shutter_count != "None"
+        def done(future):
+            try:
+                future.result()
+            except FileExistsError:
+                print("%s is already copied" % entry.path())
+            except (IOError, OSError) as e:
+                print(f"Error copying {entry.path()}: {e}")
+                self.index.discard(dest_file)
+            else:
+                print("%s -> %s" % (entry.path(), dest_file))
+                with self.lock:
+                    self.placed_count += 1
+
+        self._transfer(entry.path(), dest_file, done)
+        return True
+
+    def place_noexif(self, noexif_file):
+        if self.hashes is None:
+            # Set up noexif directory and open the hash store once
+            noexif_dir = os.path.join(self.target_root, "noexif")
+            self.index.makedirs(noexif_dir)
+
+            self.hashes = HashStore(noexif_dir)
+            if self.hashes.migrated:
+                print(f"Migrated {self.hashes.migrated} hashes from {exif.NOEXIF_HASH_FILE} to {self.hashes.path}")
+            print(f"Opened {len(self.hashes)} existing hashes from {self.hashes.path}")
+
+        self.noexif_count += 1
+        file_hash = noexif_file.file_hash
+        if file_hash is None:
+            print(f"Skipping {noexif_file.path()}: can't hash it")
+            return False
 
-        identifier = k.shutter_count if shutter_count_valid else (k.make or "Unknown")
-        file_name = "%s.%s" % ("-".join([hour, minute, second, identifier]), k.file_ext)
+        # If hash already exists, skip the file
+        with self.lock:
+            known = file_hash in self.claimed or file_hash in self.hashes
+        if known:
+            print(f"{noexif_file.path()} already exists (hash match)")
+            return False
 
-        dest_file = os.path.join(target_dir, file_name)
+        target_file_path = noexif_target_path(noexif_file, self.target_root, self.scan_root)
+        if self.index.exists(target_file_path):
+            print(f"{target_file_path} already exists")
+            return False
 
-        if not os.path.exists(dest_file):
-            print("%s -> %s" % (to_copy.path(), dest_file))
-            if args.force:
-                os.rename(to_copy.path(), dest_file)
+        self.index.makedirs(os.path.dirname(target_file_path))
+        self.index.add(target_file_path)
+
+        # Claim the hash now so a second copy of the file queued behind this one is skipped
+        with self.lock:
+            self.claimed.add(file_hash)
+
+        def done(future):
+            try:
+                future.result()
+            except FileExistsError:
+                print(f"{target_file_path} already exists")
+            except (IOError, OSError) as e:
+                print(f"Error copying {noexif_file.path()}: {e}")
+                self.index.discard(target_file_path)
+            else:
+                with self.lock:
+                    self.hashes.add(file_hash)
+                    self.claimed.discard(file_hash)
+                    self.copied_count += 1
+                print(f"{noexif_file.path()} -> {target_file_path}")
+                return
+            with self.lock:
+                self.claimed.discard(file_hash)
+
+        self._transfer(noexif_file.path(), target_file_path, done, file_hash)
+        return True
+
+
+def undo(target_root):
+    """Revert the transfers of the last run into target_root, newest first"""
+    journal = Journal(target_root)
+    run = journal.run
+    if run.scan_root is None:
+        print(f"Nothing to undo in {target_root}")
+        return
+
+    journal.reopen()
+    removed_hashes = []
+    with journal:
+        for plan in run.pending():
+            journal.outcome(plan["id"], "done" if settle(plan) else "fail")
+
+        for plan in reversed(run.done()):
+            src, dst = plan["src"], plan["dst"]
+            try:
+                if plan["mode"] == "move":
+                    os.makedirs(os.path.dirname(src), exist_ok=True)
+                    transfer_file(dst, src, "move")
+                elif os.path.exists(src):
+                    os.unlink(dst)
+                else:
+                    print(f"{src} is gone, keeping {dst}")
+                    continue
+            except FileExistsError:
+                print(f"{src} already exists, keeping {dst}")
+                continue
+            except FileNotFoundError:
+                print(f"{dst} is already gone")
+            except (IOError, OSError) as e:
+                print(f"Error restoring {dst}: {e}")
+                continue
             else:
-                shutil.copyfile(to_copy.path(), dest_file)
+                print(f"{dst} -> {src}" if plan["mode"] == "move" else f"Removed {dst}")
+
+            journal.outcome(plan["id"], "undo")
+            if "hash" in plan:
+                removed_hashes.append(plan["hash"])
+            _remove_empty_dirs(os.path.dirname(dst), target_root)
+
+        if removed_hashes:
+            with HashStore(os.path.join(target_root, "noexif")) as hashes:
+                hashes.remove(removed_hashes)
+        journal.end()
+
+
+def _remove_empty_dirs(dirpath, root):
+    while dirpath != root and dirpath.startswith(root):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            return
+        dirpath = os.path.dirname(dirpath)
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+_DONE = object()
+
+
+def stream_entries(make_entries, maxsize=STREAM_QUEUE_SIZE):
+    """
+    Iterate over make_entries() while it runs on a background thread.
+
+    Scanning and placing files then overlap, and at most `maxsize` scanned
+    entries are held in memory waiting to be placed. An exception raised
+    while scanning is raised again here.
+    """
+    q = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for entry in make_entries():
+                q.put(entry)
+        except BaseException as e:
+            q.put(_Failure(e))
+        finally:
+            q.put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = q.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.exc
+        yield item
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scan_root", nargs="?", help="Root folder to scan")
+    parser.add_argument("target_root", nargs="?", help="Root folder to place all images")
+    parser.add_argument("--force", "-f", action="store_true", help="Move instead of copy")
+    parser.add_argument("--link", choices=[m for m in MODES if m != "move"],
+                        help="How to place files when not moving: copy (the default), reflink (btrfs/XFS) or "
+                             "hardlink (same filesystem); falls back to copy where unsupported")
+    parser.add_argument("--target-manifest",
+                        help="Load the list of files in target_root from this manifest instead of listing the "
+                             "target, and save it when done. Only for targets nothing else writes to")
+    parser.add_argument("--transfer-workers", type=int, default=DEFAULT_TRANSFER_WORKERS,
+                        help="Number of files to copy in parallel")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="Don't keep the journal in target_root that lets an interrupted run resume and "
+                             "the last run be undone")
+    parser.add_argument("--undo", metavar="TARGET_ROOT",
+                        help="Revert the last run into TARGET_ROOT: move moved files back, remove copies")
+    parser.add_argument("--catalog", "-c", help="Read entries from this catalog database instead of scanning")
+    parser.add_argument("--plan", help="Place the files a plan from `python -m exif.shard merge` gives to --node, "
+                                       "from that node's root into the target_root given as the only positional")
+    parser.add_argument("--node", help="Which node of --plan this is")
+    parser.add_argument("--spill-dir", help="Folder for the databases of seen keys and target paths "
+                                            "(default: the temp folder)")
+    parser.add_argument("--hash-workers", type=int, default=DEFAULT_WORKERS, help="Number of files to hash in parallel")
+    parser.add_argument("--device-limit", type=int, default=DEFAULT_DEVICE_LIMIT, help="Number of files to read at once from a single device")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.force and args.link is not None:
+        parser.error("--force moves files, so it can't be combined with --link")
+    if args.undo:
+        undo(args.undo)
+        return
+    planned = None
+    if args.plan:
+        if args.node is None or args.scan_root is None or args.target_root is not None:
+            parser.error("--plan takes --node and only target_root")
+        args.target_root = args.scan_root
+        try:
+            args.scan_root, planned = shard.read_plan(args.plan, args.node)
+        except (OSError, ValueError) as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+    elif args.target_root is None:
+        parser.error("scan_root and target_root are required")
+
+    if not os.path.exists(args.scan_root):
+        print("Error: Path does not exist: %s" % args.scan_root)
+        sys.exit(1)
+
+    os.makedirs(args.target_root, exist_ok=True)
+    journal = None if args.no_journal else Journal(args.target_root)
+    mode = "move" if args.force else args.link or "copy"
+    if journal is not None:
+        try:
+            journal.unfinished(args.scan_root, mode)
+        except ValueError as e:
+            print("Error: %s" % e)
+            sys.exit(1)
+
+    def entries():
+        # runs on the scanning thread, which must own its SQLite connection
+        done_dirs = journal.run.dirs if deduplicator.resumed else set()
+        if planned is not None:
+            for entry in planned:
+                if entry.dirpath not in done_dirs:
+                    yield entry
+        elif args.catalog:
+            with Catalog(args.catalog) as catalog:
+                for entry in catalog.iter_entries(args.scan_root):
+                    if entry.dirpath not in done_dirs:
+                        yield entry
         else:
-            print("%s is already copied" % to_copy.path())
-
-    # Handle NoExif files with hash-based deduplication
-    if noexif_files:
-        # Set up noexif directory and load existing hashes once
-        noexif_dir = os.path.join(args.target_root, "noexif")
-        hash_file_path = os.path.join(noexif_dir, exif.NOEXIF_HASH_FILE)
-
-        # Ensure noexif directory exists
-        if not os.path.exists(noexif_dir):
-            os.makedirs(noexif_dir)
-
-        # Load existing hashes once
-        existing_hashes = exif.load_hash_file(hash_file_path)
-        print(f"Loaded {len(existing_hashes)} existing hashes from {hash_file_path}")
-
-        # Process all noexif files
-        copied_count = 0
-        for noexif_file in noexif_files:
-            if handle_noexif_file(noexif_file, args.target_root, args.scan_root,
-                                existing_hashes, hash_file_path, args.force):
-                copied_count += 1
-
-        print(f"Processed {len(noexif_files)} NoExif files, copied {copied_count} new files")
+            try:
+                yield from collect_all_files(args.scan_root, done_dirs)
+            finally:
+                exiftool.shutdown()
+
+    transferrer = Transferrer(mode, args.transfer_workers)
+
+    with metrics.reporting(args), \
+            HashService(args.hash_workers, args.device_limit) as service, \
+            Deduplicator(args.target_root, args.scan_root, args.force, service, transferrer,
+                         args.target_manifest, journal, args.spill_dir) as deduplicator:
+        for _, batch in itertools.groupby(stream_entries(entries), key=lambda e: e.dirpath):
+            deduplicator.place_all(list(batch))
 
 if __name__ == "__main__":
     main()
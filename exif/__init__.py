@@ -6,23 +6,45 @@ import sys
 import json
 import hashlib
 from collections import defaultdict
+from exif import metrics
 
 EXIF_FILE_NAME = ".exif_data"
 EXIF_IGNORE_NAME = ".exif_ignore"
+EXIF_STAT_NAME = ".exif_stat"
 NOEXIF_HASH_FILE = "file_hashes.txt"
 
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+def _intern(value):
+    """Share one copy of strings that repeat across many entries (folders, makes, sizes)"""
+    return sys.intern(value) if type(value) is str else value
+
+
 class ExifEntry:
+    """
+    A photo or video with an EXIF timestamp.
+
+    Millions of these can be alive at once, so they have no __dict__, the
+    strings that repeat between entries are interned, and the dedup key is
+    built once. Entries are not modified after they are created; the key would
+    not follow such a change.
+    """
+
+    __slots__ = ("filename", "dirpath", "timestamp", "serial_number", "shutter_count", "make", "size",
+                 "dimensions", "file_ext", "_key")
 
     def __init__(self, filename="", dirpath="", timestamp="", shutter_count="", serial_number="", make="", size="", dimensions=""):
         self.filename = filename
-        self.dirpath = dirpath
+        self.dirpath = _intern(dirpath)
         self.timestamp = timestamp
-        self.serial_number = serial_number
+        self.serial_number = _intern(serial_number)
         self.shutter_count = shutter_count
-        self.make = make
-        self.size = size
-        self.dimensions = dimensions
-        self.file_ext = self.filename.lower().split('.')[-1] if '.' in self.filename else ''
+        self.make = _intern(make)
+        self.size = _intern(size)
+        self.dimensions = _intern(dimensions)
+        self.file_ext = _intern(self.filename.lower().split('.')[-1] if '.' in self.filename else '')
+        self._key = None
 
     def __str__(self):
         return "%s: %s, timestamp: %s, %s, shutter count: %s" % (self.filename, self.make, self.timestamp, self.serial_number, self.shutter_count)
@@ -37,15 +59,17 @@ class ExifEntry:
         return hash(self.uniq_str())
 
     def uniq_str(self):
-        return "".join([
-            self.timestamp or "",
-            self.make or "",
-            self.shutter_count or "",
-            self.serial_number or "",
-            self.file_ext or "",
-            self.size or "",
-            self.dimensions or ""
-        ])
+        if self._key is None:
+            self._key = "".join([
+                self.timestamp or "",
+                self.make or "",
+                self.shutter_count or "",
+                self.serial_number or "",
+                self.file_ext or "",
+                self.size or "",
+                self.dimensions or ""
+            ])
+        return self._key
 
     def path(self):
         return os.path.join(self.dirpath, self.filename)
@@ -64,13 +88,40 @@ class ExifEntry:
 
 
 class NoExifFile:
-    """Represents a file without EXIF timestamp data, identified by content hash"""
+    """
+    Represents a file without EXIF timestamp data, identified by content hash.
+
+    Passing file_hash=None defers hashing until the hash is first needed, so
+    files that can never collide with anything are not read at all.
+    """
+
+    __slots__ = ("filename", "dirpath", "size", "_file_hash", "_hash_pending")
 
     def __init__(self, filename="", dirpath="", file_hash="", size=""):
         self.filename = filename
-        self.dirpath = dirpath
+        self.dirpath = _intern(dirpath)
         self.file_hash = file_hash
-        self.size = size
+        self.size = _intern(size)
+
+    @property
+    def file_hash(self):
+        if self._hash_pending:
+            self.set_calculated_hash(calculate_file_hash(self.path()))
+        return self._file_hash
+
+    @file_hash.setter
+    def file_hash(self, file_hash):
+        self._file_hash = file_hash
+        self._hash_pending = file_hash is None
+
+    def set_calculated_hash(self, file_hash):
+        """Record the result of hashing the file, None if it couldn't be read, so it isn't tried again"""
+        self._file_hash = file_hash
+        self._hash_pending = False
+
+    def has_hash(self):
+        """Whether the file has been hashed, or its hash was known; file_hash is None if hashing failed"""
+        return not self._hash_pending
 
     def path(self):
         return os.path.join(self.dirpath, self.filename)
@@ -81,7 +132,8 @@ class NoExifFile:
         return os.path.relpath(full_path, base_dir)
 
     def __str__(self):
-        return f"{self.filename}: hash={self.file_hash[:12]}..., size={self.size}"
+        file_hash = f"{self._file_hash[:12]}..." if self._file_hash else "deferred"
+        return f"{self.filename}: hash={file_hash}, size={self.size}"
 
     def __eq__(self, other):
         return isinstance(other, NoExifFile) and self.file_hash == other.file_hash
@@ -98,21 +150,35 @@ class NoExifFile:
             return hash(self.file_hash)
 
     def as_dict(self):
-        return {
+        d = {
             "FileName": self.filename,
             "Dirpath": self.dirpath,
-            "FileHash": self.file_hash,
             "FileSize": self.size,
         }
+        # A deferred hash stays deferred in .exif_data rather than being forced here
+        if self.has_hash() and self._file_hash is not None:
+            d["FileHash"] = self._file_hash
+        return d
 
 
-def calculate_file_hash(file_path, chunk_size=8192):
-    """Calculate SHA256 hash of file content"""
+def read_size(file_size):
+    """Read buffer for a file: small files are read in one go, large ones in MAX_READ_SIZE pieces"""
+    return max(MIN_READ_SIZE, min(MAX_READ_SIZE, file_size))
+
+
+def calculate_file_hash(file_path, chunk_size=None):
+    """Calculate SHA256 hash of file content, sizing the read buffer to the file unless chunk_size is given"""
     sha256_hash = hashlib.sha256()
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(chunk_size), b""):
-                sha256_hash.update(chunk)
+        with metrics.phase("hash"), open(file_path, "rb", buffering=0) as f:
+            buf = bytearray(chunk_size or read_size(os.fstat(f.fileno()).st_size))
+            view = memoryview(buf)
+            read = 0
+            for n in iter(lambda: f.readinto(buf), 0):
+                sha256_hash.update(view[:n])
+                read += n
+        metrics.count("files_hashed")
+        metrics.count("bytes_read", read)
         return sha256_hash.hexdigest()
     except (IOError, OSError) as e:
         print(f"Error calculating hash for {file_path}: {e}")
@@ -143,9 +209,87 @@ def save_hash_to_file(hash_file_path, file_hash):
         print(f"Error writing to hash file {hash_file_path}: {e}")
 
 
+def stat_key(st):
+    """The parts of an os.stat() result that change when a file is replaced or edited"""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def load_stat_file(stat_file_path):
+    """Load the {filename: stat_key} map stored next to .exif_data, or None if there is none"""
+    try:
+        with open(stat_file_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_stat_file(stat_file_path, stats):
+    """Replace the stat file in one step so it never describes a half-written .exif_data"""
+    tmp_path = stat_file_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stats, f, sort_keys=True)
+    os.replace(tmp_path, stat_file_path)
+
+
+def save_file_hashes(noexif_files):
+    """
+    Store the full hashes calculated for NoExifFiles in the .exif_data of their
+    folders, so later runs don't read the files again.
+
+    A hash is only stored while its file still matches the size, mtime and
+    inode .exif_stat recorded when it was scanned. A file changed since then is
+    extracted again by the next scan, which drops the hash, and hashed again
+    after that. Returns the number of hashes stored.
+    """
+    by_dir = defaultdict(dict)
+    for f in noexif_files:
+        if f.has_hash() and f.file_hash is not None:
+            by_dir[f.dirpath][f.filename] = f.file_hash
+    return sum(_save_dir_hashes(dirpath, hashes) for dirpath, hashes in by_dir.items())
+
+
+def _save_dir_hashes(dirpath, hashes):
+    exif_file_path = os.path.join(dirpath, EXIF_FILE_NAME)
+    stats = load_stat_file(os.path.join(dirpath, EXIF_STAT_NAME))
+    if stats is None:
+        return 0
+    try:
+        with open(exif_file_path) as f:
+            records = [json.loads(line) for line in f]
+    except (IOError, OSError, ValueError):
+        return 0
+
+    stored = 0
+    for record in records:
+        name = record.get("FileName")
+        file_hash = hashes.get(name)
+        if file_hash is None or record.get("DateTimeOriginal") or record.get("FileHash") == file_hash:
+            continue
+        try:
+            st = stat_key(os.stat(os.path.join(dirpath, name)))
+        except OSError:
+            continue
+        if stats.get(name) == st:
+            record["FileHash"] = file_hash
+            stored += 1
+
+    if stored:
+        tmp_path = exif_file_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, exif_file_path)
+        except (IOError, OSError) as e:
+            print(f"Error writing hashes to {exif_file_path}: {e}")
+            return 0
+    return stored
+
+
 def load_exif_file(fp, dirpath):
-    for line in fp.readlines():
-        j = json.loads(line)
+    with metrics.phase("json"):
+        records = [json.loads(line) for line in fp.readlines()]
+    for j in records:
         yield from_exif_entry(j, dirpath)
 
 
@@ -163,13 +307,10 @@ def from_exif_entry(e, dirpath):
             dimensions=e.get("ImageSize")
         )
     else:
-        # File without EXIF timestamp - create NoExifFile entry
-        file_path = os.path.join(dirpath, e["FileName"])
-        file_hash = e["FileHash"] if "FileHash" in e else calculate_file_hash(file_path) 
-
+        # File without EXIF timestamp - create NoExifFile entry, hashed only once the hash is needed
         return NoExifFile(
             filename=e["FileName"],
             dirpath=dirpath,
-            file_hash=file_hash,
+            file_hash=e.get("FileHash"),
             size=str(e.get("FileSize", ""))
         )
@@ -0,0 +1,111 @@
+"""
+Staged duplicate detection for NoExifFile entries.
+
+Hashing every file in full is by far the most expensive part of handling files
+without EXIF data, and most of that work is wasted: two files can only have the
+same content if they have the same size. Candidates are therefore narrowed down
+in three stages, each more expensive than the last:
+
+1. group by size, which only needs a stat
+2. hash the first and last PARTIAL_HASH_EDGE bytes of each candidate
+3. hash the remaining candidates in full
+
+Only full hashes are ever stored on a NoExifFile, so everything downstream
+(the deduplicate hash store, the catalog) keeps working with full hashes. Like
+every full hash, they are also saved to .exif_data for the next run.
+"""
+
+import hashlib
+import os
+from collections import defaultdict
+
+import exif
+from exif import metrics
+
+PARTIAL_HASH_EDGE = 2 * 1024 * 1024
+
+
+def partial_file_hash(file_path, size, edge=PARTIAL_HASH_EDGE):
+    """
+    SHA256 of the first and last `edge` bytes of a file.
+
+    Files no larger than 2 * edge are read whole, in which case the result is
+    the same as calculate_file_hash().
+    """
+    sha256_hash = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as f:
+            if size <= 2 * edge:
+                data = f.read()
+                sha256_hash.update(data)
+                read = len(data)
+            else:
+                head = f.read(edge)
+                f.seek(size - edge)
+                tail = f.read(edge)
+                sha256_hash.update(head)
+                sha256_hash.update(tail)
+                read = len(head) + len(tail)
+        metrics.count("bytes_read", read)
+        return sha256_hash.hexdigest()
+    except (IOError, OSError) as e:
+        print(f"Error calculating hash for {file_path}: {e}")
+        return None
+
+
+def _split(groups, key):
+    """Regroup each group by key(), dropping groups that end up with one member"""
+    for group in groups:
+        regrouped = defaultdict(list)
+        for item in group:
+            k = key(item)
+            if k is not None:
+                regrouped[k].append(item)
+        for candidates in regrouped.values():
+            if len(candidates) > 1:
+                yield candidates
+
+
+def duplicate_groups(noexif_files, edge=PARTIAL_HASH_EDGE, service=None):
+    """
+    Group NoExifFiles with identical content.
+
+    Returns the groups with more than one member, in order of first appearance.
+    Files with a unique size are never read, and only files whose partial
+    hashes collide are hashed in full. Passing a HashService reads the
+    candidates of each stage in parallel.
+    """
+    sizes = {}
+    for f in noexif_files:
+        try:
+            sizes[id(f)] = os.stat(f.path()).st_size
+        except OSError as e:
+            print(f"Error reading {f.path()}: {e}")
+
+    by_size = list(_split([noexif_files], lambda f: sizes.get(id(f))))
+
+    candidates = [f for group in by_size for f in group]
+    paths = [f.path() for f in candidates]
+    candidate_sizes = [sizes[id(f)] for f in candidates]
+    if service is None:
+        digests = map(partial_file_hash, paths, candidate_sizes, [edge] * len(paths))
+    else:
+        digests = service.map(paths, partial_file_hash, candidate_sizes, [edge] * len(paths))
+
+    partials = {}
+    whole = []
+    for f, size, digest in zip(candidates, candidate_sizes, digests):
+        partials[id(f)] = digest
+        if digest is not None and size <= 2 * edge and not f.has_hash():
+            # the whole file was read, so this already is the full hash
+            f.file_hash = digest
+            whole.append(f)
+    exif.save_file_hashes(whole)
+
+    by_partial = list(_split(by_size, lambda f: partials[id(f)]))
+    if service is not None:
+        service.hash_files([f for group in by_partial for f in group])
+    by_full = _split(by_partial, lambda f: f.file_hash)
+
+    order = {id(f): i for i, f in enumerate(noexif_files)}
+    return sorted(by_full, key=lambda group: order[id(group[0])])
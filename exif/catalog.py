@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Optional SQLite catalog of ExifEntry and NoExifFile rows.
+
+The per-directory .exif_data files stay the source of truth written by scan; the
+catalog holds the same entries in one indexed database, so tools can query a
+whole library without walking it and parsing every .exif_data file again.
+
+    python -m exif.catalog import library.db /photos
+    python -m exif.catalog export library.db
+    python -m exif.catalog duplicates library.db
+"""
+
+import argparse
+import heapq
+import json
+import os
+import sqlite3
+import sys
+from operator import itemgetter
+
+import exif
+from exif.walk import walk
+
+KEY_COLUMNS = ("timestamp", "make", "shutter_count", "serial_number", "file_ext", "size", "dimensions")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exif_entries (
+    dirpath TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    make TEXT NOT NULL,
+    shutter_count TEXT NOT NULL,
+    serial_number TEXT NOT NULL,
+    file_ext TEXT NOT NULL,
+    size TEXT NOT NULL,
+    dimensions TEXT NOT NULL,
+    PRIMARY KEY (dirpath, filename)
+);
+CREATE INDEX IF NOT EXISTS exif_entries_key ON exif_entries (%s);
+
+CREATE TABLE IF NOT EXISTS noexif_files (
+    dirpath TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    file_hash TEXT,
+    size TEXT NOT NULL,
+    PRIMARY KEY (dirpath, filename)
+);
+CREATE INDEX IF NOT EXISTS noexif_files_hash ON noexif_files (file_hash);
+""" % ", ".join(KEY_COLUMNS)
+
+
+def _subtree(root):
+    """WHERE clause and parameters matching dirpath at or below root"""
+    root = os.path.abspath(root)
+    prefix = os.path.join(root, "")
+    # "0" sorts right after "/", so this range is every path starting with prefix
+    return "(dirpath = ? OR (dirpath >= ? AND dirpath < ?))", (root, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+class Catalog:
+    """A catalog database, created on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def replace_dir(self, dirpath, entries):
+        """Replace every row of a directory with the given entries"""
+        dirpath = os.path.abspath(dirpath)
+        exif_rows = []
+        noexif_rows = []
+        for e in entries:
+            if isinstance(e, exif.ExifEntry):
+                exif_rows.append((dirpath, e.filename) + tuple(getattr(e, c) or "" for c in KEY_COLUMNS))
+            else:
+                noexif_rows.append((dirpath, e.filename, e.file_hash if e.has_hash() else None, e.size or ""))
+
+        with self.db:
+            self.db.execute("DELETE FROM exif_entries WHERE dirpath = ?", (dirpath,))
+            self.db.execute("DELETE FROM noexif_files WHERE dirpath = ?", (dirpath,))
+            self.db.executemany("INSERT INTO exif_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", exif_rows)
+            self.db.executemany("INSERT INTO noexif_files VALUES (?, ?, ?, ?)", noexif_rows)
+
+    def update_hashes(self, noexif_files):
+        """Store full hashes that were calculated after the files were cataloged"""
+        with self.db:
+            self.db.executemany("UPDATE noexif_files SET file_hash = ? WHERE dirpath = ? AND filename = ?",
+                                [(f.file_hash, os.path.abspath(f.dirpath), f.filename)
+                                 for f in noexif_files if f.has_hash()])
+
+    def iter_entries(self, root=None):
+        """
+        Every entry at or below root, folder by folder: the EXIF entries of a
+        folder, then its NoExifFiles, each by filename.
+
+        Callers such as deduplicate treat a change of folder as the end of it,
+        so no folder may come back later in the stream.
+        """
+        where, params = _subtree(root) if root else ("1", ())
+
+        # both tables are read in primary key order; SQLite compares dirpath
+        # as UTF-8 bytes, which sorts the same as Python compares the strings
+        exif_rows = self.db.execute("SELECT dirpath, filename, %s FROM exif_entries WHERE %s "
+                                    "ORDER BY dirpath, filename" % (", ".join(KEY_COLUMNS), where), params)
+        noexif_rows = self.db.execute("SELECT dirpath, filename, file_hash, size FROM noexif_files WHERE %s "
+                                      "ORDER BY dirpath, filename" % where, params)
+        exif_entries = ((row[0], 0, self._exif_entry(row)) for row in exif_rows)
+        noexif_files = ((dirpath, 1, exif.NoExifFile(filename=filename, dirpath=dirpath, file_hash=file_hash, size=size))
+                        for dirpath, filename, file_hash, size in noexif_rows)
+        for _, _, entry in heapq.merge(exif_entries, noexif_files, key=itemgetter(0, 1)):
+            yield entry
+
+    def duplicate_groups(self, root=None):
+        """
+        Lists of ExifEntries sharing the same key, found through the key index.
+
+        Entries are in iter_entries() order within a group, and groups in the
+        order of their first entry, the same as the stores of exif.grouping.
+        """
+        where, params = _subtree(root) if root else ("1", ())
+        columns = ", ".join(KEY_COLUMNS)
+        query = """
+            SELECT dirpath, filename, %s, MIN(pos) OVER (PARTITION BY %s) AS first FROM (
+                SELECT e.dirpath, e.filename, %s, ROW_NUMBER() OVER (ORDER BY e.dirpath, e.filename) AS pos
+                FROM exif_entries e
+                JOIN (SELECT %s FROM exif_entries WHERE %s GROUP BY %s HAVING COUNT(*) > 1) d USING (%s)
+                WHERE %s
+            )
+            ORDER BY first, pos
+        """ % (columns, columns, ", ".join("e." + c for c in KEY_COLUMNS), columns, where, columns, columns, where)
+
+        group = []
+        group_first = None
+        for row in self.db.execute(query, params + params):
+            if group and row[-1] != group_first:
+                yield group
+                group = []
+            group_first = row[-1]
+            group.append(self._exif_entry(row[:-1]))
+        if group:
+            yield group
+
+    def hash_groups(self, root=None):
+        """Lists of NoExifFiles sharing the same known content hash"""
+        where, params = _subtree(root) if root else ("1", ())
+        query = """
+            SELECT dirpath, filename, file_hash, size FROM noexif_files
+            WHERE file_hash IN (SELECT file_hash FROM noexif_files WHERE %s AND file_hash IS NOT NULL
+                                GROUP BY file_hash HAVING COUNT(*) > 1) AND %s
+            ORDER BY file_hash, rowid
+        """ % (where, where)
+
+        group = []
+        for dirpath, filename, file_hash, size in self.db.execute(query, params + params):
+            if group and group[0].file_hash != file_hash:
+                yield group
+                group = []
+            group.append(exif.NoExifFile(filename=filename, dirpath=dirpath, file_hash=file_hash, size=size))
+        if group:
+            yield group
+
+    def import_tree(self, root):
+        """Load every .exif_data file below root, returning the number of directories imported"""
+        count = 0
+        for dirpath, files in walk(root):
+            if not any(f.name == exif.EXIF_FILE_NAME for f in files):
+                continue
+            with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+                self.replace_dir(dirpath, list(exif.load_exif_file(fp, os.path.abspath(dirpath))))
+            count += 1
+        return count
+
+    def export_tree(self, root=None):
+        """Write the .exif_data file of every cataloged directory, returning the number written"""
+        by_dir = {}
+        for e in self.iter_entries(root):
+            by_dir.setdefault(e.dirpath, []).append(e)
+
+        count = 0
+        for dirpath, entries in by_dir.items():
+            if not os.path.isdir(dirpath):
+                print("Skipping missing directory %s" % dirpath)
+                continue
+            with open(os.path.join(dirpath, exif.EXIF_FILE_NAME), "w") as fp:
+                for entry in sorted(entries, key=lambda e: e.filename):
+                    fp.write(json.dumps(entry.as_dict()) + "\n")
+            count += 1
+        return count
+
+    @staticmethod
+    def _exif_entry(row):
+        dirpath, filename = row[:2]
+        fields = dict(zip(KEY_COLUMNS, row[2:]))
+        del fields["file_ext"]  # derived from the filename
+        return exif.ExifEntry(filename=filename, dirpath=dirpath, **fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m exif.catalog")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Load the .exif_data files below a folder")
+    import_parser.add_argument("db", help="Catalog database")
+    import_parser.add_argument("dir", help="Root folder to import")
+
+    export_parser = subparsers.add_parser("export", help="Write .exif_data files from the catalog")
+    export_parser.add_argument("db", help="Catalog database")
+    export_parser.add_argument("dir", nargs="?", help="Only export folders below this one")
+
+    dupes_parser = subparsers.add_parser("duplicates", help="List duplicates using the catalog indexes")
+    dupes_parser.add_argument("db", help="Catalog database")
+    dupes_parser.add_argument("dir", nargs="?", help="Only consider folders below this one")
+
+    args = parser.parse_args()
+
+    if args.command == "import" and not os.path.exists(args.dir):
+        print("Error: Path does not exist: %s" % args.dir)
+        sys.exit(1)
+
+    with Catalog(args.db) as catalog:
+        if args.command == "import":
+            print("Imported %d folders" % catalog.import_tree(args.dir))
+        elif args.command == "export":
+            print("Exported %d folders" % catalog.export_tree(args.dir))
+        else:
+            for group in catalog.duplicate_groups(args.dir):
+                print()
+                print("Duplcates:")
+                for e in group:
+                    print(e.path())
+            for group in catalog.hash_groups(args.dir):
+                print()
+                print("Duplcates:")
+                for f in group:
+                    print(f.path())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Long-lived exiftool workers.
+
+Starting exiftool means starting a Perl interpreter, which costs far more than
+reading the metadata of a small folder. Instead each worker is started once with
+``-stay_open True -@ -`` and fed one command at a time on stdin. Every command
+ends with ``-executeN`` so that its output is terminated by ``{readyN}`` on
+stdout, and ``-echo4 {readyN}`` writes the same marker to stderr once the
+command has finished.
+"""
+
+import atexit
+import itertools
+import json
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+from exif import metrics
+
+EXIFTOOL_ENV = "EXIFTOOL"
+DEFAULT_EXIFTOOL = "exiftool"
+SHUTDOWN_TIMEOUT = 5
+
+SUPPORTED_FORMATS = ("nef", "jpg", "heic", "heif", "mov", "mp4")
+
+# the tags from_exif_entry reads; Error reports files exiftool failed on
+EXTRACT_TAGS = ("FileName", "FileSize", "DateTimeOriginal", "Make", "SerialNumber", "ShutterCount", "ImageSize", "Error")
+
+# -fast2 also skips maker notes, where e.g. Nikon keeps ShutterCount, so it is
+# only safe for videos; images get -fast, which only skips trailers after the image data
+VIDEO_FORMATS = ("mov", "mp4")
+IMAGE_FORMATS = tuple(f for f in SUPPORTED_FORMATS if f not in VIDEO_FORMATS)
+
+
+class ExifToolError(Exception):
+    """Raised when an exiftool worker cannot be started or dies mid-command"""
+
+
+class FileErrors(ExifToolError):
+    """Raised when exiftool reports an Error for files; `errors` maps their paths to its messages"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("\n".join("%s: %s" % (path, message) for path, message in sorted(errors.items())))
+
+
+def exiftool_command():
+    """Command used to start exiftool, overridable through $EXIFTOOL"""
+    return shlex.split(os.environ.get(EXIFTOOL_ENV, DEFAULT_EXIFTOOL))
+
+
+def iter_records(lines):
+    """
+    Yield the objects of a JSON array, such as the output of exiftool -j, one at a time.
+
+    `lines` is the array's text split into lines. An object is only decoded
+    once a line starting with "}" may have closed it, so just the object being
+    read is ever buffered, however long the array is.
+    """
+    decoder = json.JSONDecoder()
+    pending = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        pending.append(line)
+        if not line.lstrip().startswith("}"):
+            continue
+
+        # decoded before yielding, so the phase doesn't count the caller's time
+        records = []
+        with metrics.phase("json"):
+            text = "".join(pending)
+            pending = []
+            while True:
+                text = text.lstrip(" \t\r\n[,")
+                try:
+                    record, end = decoder.raw_decode(text)
+                except ValueError:
+                    pending = [text]
+                    break
+                records.append(record)
+                text = text[end:]
+        yield from records
+
+    rest = "".join(pending).strip(" \t\r\n[],")
+    if rest:
+        raise ValueError("Unexpected exiftool output: %s" % rest[:200])
+
+
+def _drain(pipe, lines):
+    for line in iter(pipe.readline, b""):
+        lines.put(line)
+    lines.put(None)
+
+
+class ExifTool:
+    """A single exiftool process running in -stay_open batch mode"""
+
+    def __init__(self, command=None):
+        self.command = command or exiftool_command()
+        self.proc = None
+        self._stderr = None
+        self._drainer = None
+        self._seq = itertools.count(1)
+
+    def start(self):
+        try:
+            self.proc = subprocess.Popen(self.command + ["-stay_open", "True", "-@", "-"],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise ExifToolError("Unable to start %s: %s" % (" ".join(self.command), e))
+
+        # stderr is drained on its own thread so a chatty command can never fill
+        # the pipe while we are blocked reading stdout
+        self._stderr = queue.Queue()
+        self._drainer = threading.Thread(target=_drain, args=(self.proc.stderr, self._stderr), daemon=True)
+        self._drainer.start()
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _send(self, args):
+        """Start a command, returning the sentinel that marks the end of its output"""
+        if not self.running():
+            self.start()
+
+        seq = next(self._seq)
+        sentinel = b"{ready%d}" % seq
+        lines = [os.fsencode(a) for a in args] + [b"-echo4", sentinel, b"-execute%d" % seq]
+        try:
+            self.proc.stdin.write(b"\n".join(lines) + b"\n")
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise ExifToolError("exiftool exited unexpectedly: %s" % e)
+        return sentinel
+
+    def _stdout_lines(self, sentinel, args):
+        for line in iter(self.proc.stdout.readline, b""):
+            if line.rstrip(b"\r\n").endswith(sentinel):
+                yield line.rstrip(b"\r\n")[:-len(sentinel)]
+                return
+            yield line
+        raise ExifToolError("exiftool exited unexpectedly while running: %s" % " ".join(args))
+
+    def _stderr_lines(self, sentinel, args):
+        stderr = []
+        while True:
+            line = self._stderr.get()
+            if line is None:
+                raise ExifToolError("exiftool exited unexpectedly while running: %s" % " ".join(args))
+            if line.rstrip(b"\r\n") == sentinel:
+                return stderr
+            stderr.append(line)
+
+    def execute(self, *args):
+        """Run a single command, returning its (stdout, stderr) as bytes"""
+        started = time.perf_counter()
+        sentinel = self._send(args)
+        stdout = b"".join(self._stdout_lines(sentinel, args))
+        stderr = b"".join(self._stderr_lines(sentinel, args))
+        metrics.observe("exiftool", time.perf_counter() - started)
+        return stdout, stderr
+
+    def execute_iter(self, *args):
+        """
+        Run a -j command, yielding its records one at a time as exiftool prints them.
+
+        If the caller stops early the rest of the output is still read and
+        discarded, so the worker is ready for the next command.
+        """
+        started = time.perf_counter()
+        sentinel = self._send(args)
+        lines = self._stdout_lines(sentinel, args)
+        try:
+            yield from iter_records(lines)
+        finally:
+            for _ in lines:
+                pass
+            self._stderr_lines(sentinel, args)
+            # includes the time the caller spent on each record, which is small next to exiftool's
+            metrics.observe("exiftool", time.perf_counter() - started)
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.write(b"-stay_open\nFalse\n")
+                self.proc.stdin.flush()
+            except OSError:
+                pass
+            try:
+                self.proc.wait(timeout=SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+        # the process is gone, so the drain thread reaches the end of stderr and
+        # stops; closing the pipe under it would block on its read
+        self._drainer.join(SHUTDOWN_TIMEOUT)
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            pipe.close()
+        self.proc = None
+        self._drainer = None
+
+
+class ExifToolPool:
+    """
+    A fixed set of ExifTool workers shared between threads.
+
+    Workers are started on first use. A worker that has crashed is restarted and
+    the command retried once before the error is passed on to the caller.
+    """
+
+    def __init__(self, size=1, command=None):
+        self.command = command
+        self._workers = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    @property
+    def size(self):
+        return len(self._workers)
+
+    def resize(self, size):
+        """Grow the pool to at least `size` workers"""
+        with self._lock:
+            while len(self._workers) < size:
+                worker = ExifTool(self.command)
+                self._workers.append(worker)
+                self._idle.put(worker)
+
+    def execute(self, *args):
+        worker = self._idle.get()
+        try:
+            try:
+                return worker.execute(*args)
+            except ExifToolError:
+                worker.close()
+                return worker.execute(*args)
+        finally:
+            self._idle.put(worker)
+
+    def execute_iter(self, *args):
+        """Like execute(), yielding the records of a -j command as they arrive"""
+        worker = self._idle.get()
+        try:
+            started = False
+            try:
+                for record in worker.execute_iter(*args):
+                    started = True
+                    yield record
+            except ExifToolError:
+                if started:
+                    raise
+                worker.close()
+                yield from worker.execute_iter(*args)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(size=1):
+    """The process-wide pool, grown to at least `size` workers"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExifToolPool(size)
+            atexit.register(shutdown)
+        else:
+            _pool.resize(size)
+        return _pool
+
+
+def shutdown():
+    """Stop every worker of the process-wide pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def file_ext(path):
+    return path.rsplit(".", 1)[1].lower() if "." in os.path.basename(path) else ""
+
+
+def extraction_args(formats):
+    """exiftool options extracting only EXTRACT_TAGS, as fast as is safe for files of the given formats"""
+    fast = "-fast2" if set(formats) <= set(VIDEO_FORMATS) else "-fast"
+    return ["-j", fast] + ["-" + tag for tag in EXTRACT_TAGS]
+
+
+def extract_dir(dirpath, exts=None):
+    """
+    Yield the records of the SUPPORTED_FORMATS files in dirpath, images first.
+
+    Images and videos are extracted with separate commands so each gets its
+    own speed options, limited to their formats with -ext. Given the `exts`
+    present in the directory, a command is only sent if it has some.
+    Records of files exiftool failed on have an "Error" tag.
+    """
+    for formats in (IMAGE_FORMATS, VIDEO_FORMATS):
+        if exts is not None and set(exts).isdisjoint(formats):
+            continue
+        ext_args = [arg for f in formats for arg in ("-ext", f)]
+        yield from get_pool().execute_iter(*extraction_args(formats), *ext_args, dirpath)
+
+
+def extract_files(paths):
+    """Like extract_dir(), for the given files"""
+    for formats in (IMAGE_FORMATS, VIDEO_FORMATS):
+        is_video = formats == VIDEO_FORMATS
+        args = [p for p in paths if (file_ext(p) in VIDEO_FORMATS) == is_video]
+        if args:
+            yield from get_pool().execute_iter(*extraction_args(formats), *args)
+
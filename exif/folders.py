@@ -0,0 +1,147 @@
+"""
+Folder containment detection for find_duplicates.
+
+Comparing every pair of folders is quadratic and never finishes on a large
+library. Instead an inverted index maps every entry key to the folders holding
+it. For each folder, walking the index over its keys counts how many keys it
+shares with every other folder. Folders that share nothing are never looked at.
+The shared count alone settles the relation: two folders are the same when it
+equals both their sizes, and one is inside the other when it equals the smaller
+size.
+
+The same count gives the exact Jaccard similarity |A & B| / |A | B| of every
+candidate pair. That is how near-identical folders are reported, so no
+MinHash/LSH approximation is needed.
+
+ExternalFolders computes the same relations without holding the keys in
+memory, for find_duplicates --store external. Every (key, folder) pair goes
+into an on-disk sort by packed key; merging it meets the folders of each key
+together, and every pair of folders sharing the key goes into a second sort.
+Reading that one back counts the keys each pair shares, already in the order
+folder_relations yields them. Only the folder paths and their sizes stay in
+memory.
+"""
+
+import itertools
+import tempfile
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+
+from exif.grouping import ExternalSort, pack_key, DEFAULT_MEMORY_BUDGET, np
+
+SAME = "same"
+SUBSET = "subset"
+SIMILAR = "similar"
+
+
+def folder_relations(folders, similar=None):
+    """
+    Yield (relation, path1, path2, similarity) for related pairs of folders.
+
+    `folders` maps each folder path to the set of its entry keys. relation is
+    SAME, SUBSET when every key of path1 is also in path2, or SIMILAR when
+    `similar` is given and the folders' Jaccard similarity reaches it. Pairs
+    come in the order of a pairwise loop over `folders`: by the first folder,
+    then the second.
+    """
+    paths = list(folders)
+    sizes = [len(folders[p]) for p in paths]
+
+    # posting lists are in ascending folder order, since folders are added in order
+    postings = defaultdict(list)
+    for i, path in enumerate(paths):
+        for key in folders[path]:
+            postings[key].append(i)
+
+    for i, path in enumerate(paths):
+        shared = defaultdict(int)
+        for key in folders[path]:
+            posting = postings[key]
+            if len(posting) > 1:
+                for k in posting[bisect_right(posting, i):]:
+                    shared[k] += 1
+
+        for k in sorted(shared):
+            relation = _relation(path, paths[k], sizes[i], sizes[k], shared[k], similar)
+            if relation is not None:
+                yield relation
+
+
+def _relation(path1, path2, size1, size2, shared, similar):
+    """How two folders sharing `shared` keys are related, or None"""
+    if shared == size1 and shared == size2:
+        return SAME, path1, path2, 1.0
+    if shared == size1:
+        return SUBSET, path1, path2, shared / size2
+    if shared == size2:
+        return SUBSET, path2, path1, shared / size1
+    if similar is not None:
+        similarity = shared / (size1 + size2 - shared)
+        if similarity >= similar:
+            return SIMILAR, path1, path2, similarity
+    return None
+
+
+class _Folder:
+    def __init__(self, folders, folder_id):
+        self._folders = folders
+        self._id = folder_id
+
+    def add(self, key):
+        self._folders.add(self._id, key)
+
+
+class ExternalFolders:
+    """
+    The keys of every folder, spilled to disk within a memory budget.
+
+    Used like the dict of sets folder_relations takes: `folders[path].add(key)`,
+    with folders numbered in the order they are first looked up. Keys can be
+    anything with a stable repr().
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None, use_numpy=None):
+        self.memory_budget = memory_budget
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        self._tmpdir = tempfile.TemporaryDirectory(prefix=".folders-", dir=spill_dir)
+        self._keys = ExternalSort(self._tmpdir.name, "keys", memory_budget, self.use_numpy)
+        self.paths = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, path):
+        folder_id = self._ids.get(path)
+        if folder_id is None:
+            folder_id = self._ids[path] = len(self.paths)
+            self.paths.append(path)
+        return _Folder(self, folder_id)
+
+    def add(self, folder_id, key):
+        high, low = pack_key(repr(key))
+        self._keys.add(high, low, folder_id, 0)
+
+    def close(self):
+        self._tmpdir.cleanup()
+
+    def relations(self, similar=None):
+        """What folder_relations would yield for the same folders and keys; this can only be done once"""
+        try:
+            sizes = array("Q", [0]) * len(self.paths)
+            pairs = ExternalSort(self._tmpdir.name, "pairs", self.memory_budget, self.use_numpy)
+            for _, group in itertools.groupby(self._keys.sorted(), key=lambda r: (r[0], r[1])):
+                # records of one key are sorted by folder, so repeats within a folder are adjacent
+                holders = [folder_id for folder_id, _ in itertools.groupby(r[2] for r in group)]
+                for i, folder_id in enumerate(holders):
+                    sizes[folder_id] += 1
+                    for other in holders[i + 1:]:
+                        pairs.add(folder_id, other, 0, 0)
+
+            for (i, k), group in itertools.groupby(pairs.sorted(), key=lambda r: (r[0], r[1])):
+                relation = _relation(self.paths[i], self.paths[k], sizes[i], sizes[k], sum(1 for _ in group), similar)
+                if relation is not None:
+                    yield relation
+        finally:
+            self.close()
@@ -0,0 +1,313 @@
+"""
+Grouping of ExifEntries into duplicates.
+
+The groupers take (entry, path) pairs through add() and give back the paths of
+every key seen more than once through duplicate_groups(), in the order the
+keys first appeared and each group in the order its paths were added.
+
+DictGrouper is the plain dict of lists. ColumnarGrouper keeps no entry objects
+at all: each uniq_str() is packed into a 128-bit integer ID, stored in two
+unsigned 64-bit columns, and duplicates are found by sorting those columns.
+That is about 20 bytes per entry plus its filename, so whole-library reports
+over tens of millions of entries fit in memory. Packing the whole key rather
+than each field keeps the exact equality of uniq_str(), and at 128 bits a
+collision between different keys is not a practical concern.
+
+ExternalGrouper sorts on disk for libraries whose keys don't fit in memory
+even packed. Each entry becomes a fixed-width record of its packed key, its
+position and where its path is in a spill file. Records are sorted in runs of
+at most `memory_budget` bytes and written out, then the runs are merged in a
+streaming pass that meets each key's records together (after merging runs
+MAX_FAN_IN at a time first, if there are more). The duplicate
+groups found are sorted again the same way, by the position of their first
+entry, to come out in the same order as the other stores.
+
+NumPy is used for the sort when it is installed; otherwise the columns are
+array.array and the sort is done in Python, which is slower but works.
+"""
+
+import hashlib
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STORES = ("dict", "columnar", "external")
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def pack_key(key):
+    """The 128-bit ID of a uniq_str() as two 64-bit halves"""
+    digest = hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+
+
+class DictGrouper:
+    """Paths grouped in a dict keyed by the entries themselves"""
+
+    def __init__(self):
+        self._groups = defaultdict(list)
+
+    def __len__(self):
+        return sum(len(paths) for paths in self._groups.values())
+
+    def add(self, entry, path):
+        self._groups[entry].append(path)
+
+    def duplicate_groups(self):
+        for paths in self._groups.values():
+            if len(paths) > 1:
+                yield paths
+
+
+class ColumnarGrouper:
+    """Paths grouped by sorting packed key columns"""
+
+    def __init__(self, use_numpy=None):
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        self._high = array("Q")
+        self._low = array("Q")
+        self._dir_ids = array("I")
+        self._dirs = []
+        self._dir_index = {}
+        self._names = []
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, entry, path):
+        high, low = pack_key(entry.uniq_str())
+        self._high.append(high)
+        self._low.append(low)
+
+        dirpath, name = os.path.split(path)
+        dir_id = self._dir_index.get(dirpath)
+        if dir_id is None:
+            dir_id = self._dir_index[dirpath] = len(self._dirs)
+            self._dirs.append(dirpath)
+        self._dir_ids.append(dir_id)
+        self._names.append(name)
+
+    def path(self, i):
+        return os.path.join(self._dirs[self._dir_ids[i]], self._names[i])
+
+    def duplicate_ranges(self):
+        """
+        (order, ranges) where order lists entry indexes sorted by key and each
+        (start, end) range of it holds one duplicate group.
+
+        Ranges come in the order their keys first appeared, and each range
+        lists its entries in the order they were added.
+        """
+        if self.use_numpy:
+            return self._numpy_ranges()
+        return self._python_ranges()
+
+    def _numpy_ranges(self):
+        high = np.frombuffer(self._high, dtype=np.uint64)
+        low = np.frombuffer(self._low, dtype=np.uint64)
+        if len(high) == 0:
+            return [], []
+
+        # lexsort is stable, so equal keys keep the order they were added in
+        order = np.lexsort((low, high))
+        sorted_high, sorted_low = high[order], low[order]
+        new_key = np.empty(len(order), dtype=bool)
+        new_key[0] = True
+        new_key[1:] = (sorted_high[1:] != sorted_high[:-1]) | (sorted_low[1:] != sorted_low[:-1])
+
+        starts = np.flatnonzero(new_key)
+        ends = np.append(starts[1:], len(order))
+        duplicates = ends - starts > 1
+        starts, ends = starts[duplicates], ends[duplicates]
+
+        by_first_appearance = np.argsort(order[starts], kind="stable")
+        ranges = list(zip(starts[by_first_appearance].tolist(), ends[by_first_appearance].tolist()))
+        return order.tolist(), ranges
+
+    def _python_ranges(self):
+        high, low = self._high, self._low
+        order = sorted(range(len(high)), key=lambda i: (high[i], low[i]))
+
+        ranges = []
+        start = 0
+        for end in range(1, len(order) + 1):
+            if end == len(order) or high[order[end]] != high[order[start]] or low[order[end]] != low[order[start]]:
+                if end - start > 1:
+                    ranges.append((start, end))
+                start = end
+
+        ranges.sort(key=lambda r: order[r[0]])
+        return order, ranges
+
+    def duplicate_groups(self):
+        order, ranges = self.duplicate_ranges()
+        for start, end in ranges:
+            yield [self.path(i) for i in order[start:end]]
+
+
+# What a record costs while its run is sorted: NumPy holds the run, the sort
+# order and the sorted copy; Python holds a tuple of four ints per record.
+NUMPY_SORT_FACTOR = 3
+PYTHON_RECORD_COST = 200
+READ_SIZE = 1024 * 1024
+MAX_FAN_IN = 64
+_RECORD = struct.Struct("<4Q")
+_PATH_LENGTH = struct.Struct("<I")
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ExternalSort:
+    """
+    Records of four unsigned 64-bit ints, sorted in runs on disk and read back
+    merged, in ascending order. Also used by exif.folders.ExternalFolders.
+    """
+
+    def __init__(self, dirpath, name, memory_budget, use_numpy):
+        self.dirpath = dirpath
+        self.name = name
+        self.use_numpy = use_numpy
+        if use_numpy:
+            self.run_size = max(1, memory_budget // (_RECORD.size * NUMPY_SORT_FACTOR))
+        else:
+            self.run_size = max(1, memory_budget // PYTHON_RECORD_COST)
+        self.runs = []
+        self._next_run = 0
+        self._buffer = bytearray()
+        self._count = 0
+
+    def add(self, *record):
+        self._buffer += _RECORD.pack(*record)
+        self._count += 1
+        if self._count == self.run_size:
+            self._spill()
+
+    def _spill(self):
+        if not self._count:
+            return
+        if self.use_numpy:
+            rows = np.frombuffer(self._buffer, dtype="<u8").reshape(-1, 4)
+            data = rows[np.lexsort(rows.T[::-1])].tobytes()
+        else:
+            data = b"".join(_RECORD.pack(*r) for r in sorted(_RECORD.iter_unpack(self._buffer)))
+
+        path = os.path.join(self.dirpath, "%s.%d" % (self.name, self._next_run))
+        self._next_run += 1
+        with open(path, "wb") as fp:
+            fp.write(data)
+        self.runs.append(path)
+        self._buffer = bytearray()
+        self._count = 0
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as fp:
+            while True:
+                chunk = fp.read(READ_SIZE - READ_SIZE % _RECORD.size)
+                if not chunk:
+                    return
+                yield from _RECORD.iter_unpack(chunk)
+
+    def _merge_runs(self, paths):
+        """Merge runs into a new one, keeping open files to MAX_FAN_IN"""
+        path = os.path.join(self.dirpath, "%s.%d" % (self.name, self._next_run))
+        self._next_run += 1
+        with open(path, "wb") as fp:
+            for chunk in _chunks(heapq.merge(*[self._read(p) for p in paths]), READ_SIZE // _RECORD.size):
+                fp.write(b"".join(_RECORD.pack(*r) for r in chunk))
+        for p in paths:
+            os.unlink(p)
+        return path
+
+    def sorted(self):
+        """Every record added, in order; the runs are deleted once read"""
+        self._spill()
+        while len(self.runs) > MAX_FAN_IN:
+            # records are unique, so the order runs are merged in doesn't matter
+            self.runs = self.runs[MAX_FAN_IN:] + [self._merge_runs(self.runs[:MAX_FAN_IN])]
+        try:
+            yield from heapq.merge(*[self._read(path) for path in self.runs])
+        finally:
+            for path in self.runs:
+                os.unlink(path)
+            self.runs = []
+
+
+class ExternalGrouper:
+    """Paths grouped by sorting packed key records on disk, within a memory budget"""
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None, use_numpy=None):
+        self.memory_budget = memory_budget
+        self.use_numpy = np is not None if use_numpy is None else use_numpy
+        self._tmpdir = tempfile.TemporaryDirectory(prefix=".group-", dir=spill_dir)
+        self._keys = ExternalSort(self._tmpdir.name, "keys", memory_budget, self.use_numpy)
+        self._paths = open(os.path.join(self._tmpdir.name, "paths"), "w+b")
+        self._offset = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, entry, path):
+        high, low = pack_key(entry.uniq_str())
+        self._keys.add(high, low, self._count, self._offset)
+        data = path.encode("utf-8", "surrogateescape")
+        self._paths.write(_PATH_LENGTH.pack(len(data)) + data)
+        self._offset += _PATH_LENGTH.size + len(data)
+        self._count += 1
+
+    def path(self, offset):
+        self._paths.seek(offset)
+        length, = _PATH_LENGTH.unpack(self._paths.read(_PATH_LENGTH.size))
+        return self._paths.read(length).decode("utf-8", "surrogateescape")
+
+    def close(self):
+        self._paths.close()
+        self._tmpdir.cleanup()
+
+    def duplicate_groups(self):
+        """The groups, in the order of the other stores; this can only be done once"""
+        try:
+            # the records of each duplicate group, re-keyed by the position of its first entry
+            groups = ExternalSort(self._tmpdir.name, "groups", self.memory_budget, self.use_numpy)
+            records = self._keys.sorted()
+            for _, group in itertools.groupby(records, key=lambda r: (r[0], r[1])):
+                first = next(group)
+                second = next(group, None)
+                if second is None:
+                    continue
+                for _, _, i, offset in itertools.chain((first, second), group):
+                    groups.add(first[2], i, offset, 0)
+
+            self._paths.flush()
+            for _, group in itertools.groupby(groups.sorted(), key=lambda r: r[0]):
+                yield [self.path(offset) for _, _, offset, _ in group]
+        finally:
+            self.close()
+
+
+def make_grouper(store="dict", memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None):
+    """A grouper for the given --store; memory_budget and spill_dir only apply to the external store"""
+    if store == "dict":
+        return DictGrouper()
+    if store == "columnar":
+        return ColumnarGrouper()
+    if store == "external":
+        return ExternalGrouper(memory_budget, spill_dir)
+    raise ValueError("Unknown store %s" % store)
@@ -0,0 +1,86 @@
+"""
+Parallel file hashing with bounded per-device I/O.
+
+hashlib releases the GIL while it hashes, so a handful of threads is enough to
+saturate an SSD. Spinning disks are the opposite: several readers seeking
+between files are slower than one. Every read therefore holds a per-device
+semaphore, keyed by st_dev, that limits how many files of the same device are
+read at once regardless of the number of workers.
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import exif
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_DEVICE_LIMIT = 4
+
+
+class HashService:
+    """
+    A thread pool that hashes files.
+
+    submit() returns a Future, map() streams results back in the order the
+    paths were given.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, device_limit=DEFAULT_DEVICE_LIMIT):
+        self.workers = workers
+        self.device_limit = device_limit
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._devices = {}
+        self._devices_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _device_semaphore(self, path):
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            device = None
+
+        with self._devices_lock:
+            if device not in self._devices:
+                self._devices[device] = threading.BoundedSemaphore(self.device_limit)
+            return self._devices[device]
+
+    def _run(self, func, path, args):
+        with self._device_semaphore(path):
+            return func(path, *args)
+
+    def submit(self, path, func=exif.calculate_file_hash, *args):
+        """Run func(path, *args) on the pool, calculate_file_hash by default"""
+        return self._executor.submit(self._run, func, path, args)
+
+    def map(self, paths, func=exif.calculate_file_hash, *iterables):
+        """
+        Yield func(path, *args) for every path, in order.
+
+        Only a few files per worker are queued ahead of the consumer, so this
+        can be fed an arbitrarily long stream of paths.
+        """
+        pending = deque()
+        for path, *args in zip(paths, *iterables):
+            pending.append(self.submit(path, func, *args))
+            if len(pending) >= self.workers * 4:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def hash_files(self, noexif_files):
+        """Calculate the hash of every NoExifFile that doesn't have one yet, and store it in .exif_data"""
+        pending = [f for f in noexif_files if not f.has_hash()]
+        for f, file_hash in zip(pending, self.map(f.path() for f in pending)):
+            f.set_calculated_hash(file_hash)
+        exif.save_file_hashes(pending)
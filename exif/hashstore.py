@@ -0,0 +1,316 @@
+"""
+On-disk store of the content hashes of files placed into target_root/noexif.
+
+file_hashes.txt kept one hex SHA-256 per line. Every run read all of it into a
+set, and every placed file appended a line through its own open() and close().
+This store keeps the same hashes as 32-byte binary digests in file_hashes.bin:
+
+    header   magic, number of digests, number of Bloom filter bits
+    digests  sorted, 32 bytes each
+    bloom    a Bloom filter over the digests
+
+The file is mmapped, never read in whole. A lookup first tests the Bloom
+filter, which answers most misses (the common case: a new file) from a few
+bits. Only a possible hit costs a binary search over the digests.
+
+New hashes are appended to file_hashes.log in batches, each one fsynced, and
+the log is kept in memory. When the log grows past a fraction of the sorted
+digests, close() merges the two into a new file_hashes.bin, and once it holds
+LOG_LIMIT digests add() does so straight away, so the log never takes more
+memory than that. A crash loses at most the batch being written, and the next
+open() reads the log back, or merges it first if it is longer than LOG_LIMIT.
+
+A file_hashes.txt without a file_hashes.bin is migrated on the first open().
+"""
+
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_left
+
+HASH_STORE_FILE = "file_hashes.bin"
+HASH_LOG_FILE = "file_hashes.log"
+LEGACY_HASH_FILE = "file_hashes.txt"
+
+MAGIC = b"EXHS0001"
+HEADER = struct.Struct("<8sQQQ")
+DIGEST_SIZE = 32
+BITS_PER_DIGEST = 10
+BLOOM_PROBES = 7
+BATCH_SIZE = 256
+MIGRATE_CHUNK = 1 << 20
+LOG_LIMIT = 1 << 18
+
+
+def to_digest(file_hash):
+    """The 32 bytes of a hex SHA-256, or None if file_hash isn't one"""
+    try:
+        digest = bytes.fromhex(file_hash)
+    except (TypeError, ValueError):
+        return None
+    return digest if len(digest) == DIGEST_SIZE else None
+
+
+def _bloom_positions(digest, bits):
+    # the digests are SHA-256, so two slices of one make independent hashes
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:16], "little") | 1
+    return [(h1 + i * h2) % bits for i in range(BLOOM_PROBES)]
+
+
+class _Digests:
+    """The sorted digests of a mapped store as a sequence, for bisect"""
+
+    def __init__(self, mm, count):
+        self.mm = mm
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start = HEADER.size + i * DIGEST_SIZE
+        return self.mm[start:start + DIGEST_SIZE]
+
+
+def write_store(path, digests, capacity):
+    """
+    Write sorted `digests` to a new store at path, dropping repeats.
+
+    capacity is an upper bound on their number, used to size the Bloom filter.
+    The file is written next to path, fsynced and then moved over it.
+    """
+    bits = max(64, capacity * BITS_PER_DIGEST + 7 & ~7)
+    bloom = bytearray(bits // 8)
+    count = 0
+
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, 0, 0, 0))
+            previous = None
+            for digest in digests:
+                if digest == previous:
+                    continue
+                previous = digest
+                f.write(digest)
+                count += 1
+                for pos in _bloom_positions(digest, bits):
+                    bloom[pos >> 3] |= 1 << (pos & 7)
+            f.write(bloom)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, count, bits, 0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+def read_digests(f):
+    """The digests of a binary file of them, such as the log, dropping a partial last one"""
+    for digest in iter(lambda: f.read(DIGEST_SIZE), b""):
+        if len(digest) == DIGEST_SIZE:
+            yield digest
+
+
+def sort_runs(digests, dirpath, runs):
+    """
+    Sort `digests` in chunks of MIGRATE_CHUNK, each written to a temporary
+    file in dirpath that is appended to runs. Returns the number of digests.
+    """
+    total = 0
+    while True:
+        chunk = sorted(itertools.islice(digests, MIGRATE_CHUNK))
+        if not chunk:
+            return total
+        run = tempfile.TemporaryFile(dir=dirpath or ".")
+        runs.append(run)
+        run.write(b"".join(chunk))
+        run.seek(0)
+        total += len(chunk)
+
+
+def migrate_text_file(text_path, path):
+    """
+    Convert a file_hashes.txt to a store at path, returning the number of hashes.
+
+    The text file is sorted in chunks of MIGRATE_CHUNK hashes written to
+    temporary runs, which are then merged, so memory stays bounded however
+    many hashes it holds. Lines that aren't SHA-256 hashes are skipped.
+    """
+    runs = []
+    try:
+        with open(text_path) as f:
+            digests = (d for d in (to_digest(line.strip()) for line in f) if d is not None)
+            total = sort_runs(digests, os.path.dirname(path), runs)
+        return write_store(path, heapq.merge(*[read_digests(run) for run in runs]), total)
+    finally:
+        for run in runs:
+            run.close()
+
+
+class HashStore:
+    """
+    The set of content hashes in a noexif directory.
+
+    Supports `in` and add() with hex SHA-256 strings; use as a context manager
+    or call close() to write the last batch. At most `log_limit` hashes
+    added since the last merge are held in memory.
+    """
+
+    def __init__(self, dirpath, batch_size=BATCH_SIZE, log_limit=LOG_LIMIT):
+        self.path = os.path.join(dirpath, HASH_STORE_FILE)
+        self.log_path = os.path.join(dirpath, HASH_LOG_FILE)
+        self.batch_size = batch_size
+        self.log_limit = max(log_limit, batch_size)
+        self.migrated = 0
+
+        legacy_path = os.path.join(dirpath, LEGACY_HASH_FILE)
+        if not os.path.exists(self.path) and os.path.exists(legacy_path):
+            self.migrated = migrate_text_file(legacy_path, self.path)
+
+        self._file = None
+        self._mm = None
+        self._count = 0
+        self._bits = 0
+        self._map()
+
+        self._logged = set()
+        self._pending = []
+        self._log = open(self.log_path, "ab")
+        size = os.fstat(self._log.fileno()).st_size
+        # a crash can leave a partial digest at the end of the log
+        if size % DIGEST_SIZE:
+            size -= size % DIGEST_SIZE
+            self._log.truncate(size)
+        with open(self.log_path, "rb") as f:
+            if size // DIGEST_SIZE > self.log_limit:
+                self._merge_log(f)
+            else:
+                self._logged.update(read_digests(f))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count + len(self._logged)
+
+    def __contains__(self, file_hash):
+        digest = to_digest(file_hash)
+        if digest is None:
+            return False
+        if digest in self._logged:
+            return True
+        return self._stored(digest)
+
+    def _map(self):
+        try:
+            self._file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._bits, _ = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            self._unmap()
+            raise ValueError("%s is not a hash store" % self.path)
+
+    def _unmap(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._file = self._mm = None
+        self._count = self._bits = 0
+
+    def _stored(self, digest):
+        if not self._count:
+            return False
+        bloom_start = HEADER.size + self._count * DIGEST_SIZE
+        for pos in _bloom_positions(digest, self._bits):
+            if not self._mm[bloom_start + (pos >> 3)] & 1 << (pos & 7):
+                return False
+        digests = _Digests(self._mm, self._count)
+        i = bisect_left(digests, digest)
+        return i < self._count and digests[i] == digest
+
+    def add(self, file_hash):
+        """Record file_hash, returning False if it was already stored"""
+        digest = to_digest(file_hash)
+        if digest is None:
+            raise ValueError("Not a SHA-256 hash: %r" % (file_hash,))
+        if digest in self._logged or self._stored(digest):
+            return False
+        self._logged.add(digest)
+        self._pending.append(digest)
+        if len(self._logged) >= self.log_limit:
+            self.compact()
+        elif len(self._pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Append the pending hashes to the log and fsync it"""
+        if not self._pending:
+            return
+        self._log.write(b"".join(self._pending))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._pending = []
+
+    def compact(self):
+        """Merge the log into the sorted digests"""
+        self.flush()
+        if not self._logged:
+            return
+        self._merge([sorted(self._logged)], len(self._logged))
+
+    def _merge_log(self, f):
+        """Merge a log too long to hold in memory, read from f, in sorted runs"""
+        runs = []
+        try:
+            total = sort_runs(read_digests(f), os.path.dirname(self.path), runs)
+            self._merge([read_digests(run) for run in runs], total)
+        finally:
+            for run in runs:
+                run.close()
+
+    def _merge(self, logged, capacity):
+        stored = _Digests(self._mm, self._count) if self._count else []
+        write_store(self.path, heapq.merge(iter(stored), *logged), self._count + capacity)
+
+        self._unmap()
+        self._map()
+        self._log.truncate(0)
+        self._logged = set()
+
+    def remove(self, file_hashes):
+        """Forget file_hashes, rewriting the sorted digests"""
+        digests = {d for d in map(to_digest, file_hashes) if d is not None}
+        self.compact()
+        if not self._count:
+            return
+        remaining = (d for d in _Digests(self._mm, self._count) if d not in digests)
+        write_store(self.path, remaining, self._count)
+        self._unmap()
+        self._map()
+
+    def close(self):
+        if self._log is None:
+            return
+        self.flush()
+        # merging rewrites every digest, so wait until the log is worth it
+        if len(self._logged) > max(self.batch_size, self._count // 8):
+            self.compact()
+        self._log.close()
+        self._log = None
+        self._unmap()
@@ -0,0 +1,122 @@
+"""
+Minimal inotify binding through ctypes, so watching needs nothing beyond libc.
+
+    with Inotify() as notify:
+        wd = notify.add_watch("/photos", IN_CLOSE_WRITE | IN_MOVED_TO)
+        for event in notify.read(timeout=1.0):
+            ...
+
+Only Linux has inotify; available() tells whether it can be used.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from collections import namedtuple
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+_EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+Event = namedtuple("Event", "wd mask cookie name")
+
+_libc = None
+
+
+def _load():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        for name, argtypes in (("inotify_init1", [ctypes.c_int]),
+                               ("inotify_add_watch", [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]),
+                               ("inotify_rm_watch", [ctypes.c_int, ctypes.c_int])):
+            func = getattr(libc, name)
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
+def available():
+    try:
+        return hasattr(_load(), "inotify_init1")
+    except OSError:
+        return False
+
+
+def _check(result, what):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "%s: %s" % (what, os.strerror(err)))
+    return result
+
+
+def parse_events(data):
+    """The events packed in a buffer read from an inotify fd"""
+    events = []
+    pos = 0
+    while pos + _EVENT.size <= len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+        pos += _EVENT.size
+        name = data[pos:pos + length].rstrip(b"\0")
+        pos += length
+        events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+    return events
+
+
+class Inotify:
+    """An inotify instance"""
+
+    def __init__(self):
+        libc = _load()
+        self._libc = libc
+        self.fd = _check(libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK), "inotify_init1")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Watch path, returning its watch descriptor; watching it again returns the same one"""
+        return _check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask), "inotify_add_watch %s" % path)
+
+    def rm_watch(self, wd):
+        # the kernel already dropped the watches of deleted folders
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """The events available within timeout seconds (None: wait for some), or []"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            return parse_events(os.read(self.fd, READ_SIZE))
+        except BlockingIOError:
+            return []
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,233 @@
+"""
+Write-ahead journal of the transfers deduplicate makes into target_root.
+
+The journal is a file of JSON lines in target_root/.dedupe_journal:
+
+    {"op": "run", "scan_root": ..., "mode": ...}   a run starts
+    {"op": "resume"}                               an interrupted run is picked up again
+    {"op": "plan", "id": 7, "src": ..., "dst": ..., "hash": ...}
+    {"op": "done", "id": 7}                        the transfer finished
+    {"op": "fail", "id": 7}                        it didn't, and left nothing behind
+    {"op": "dir", "dirpath": ...}                  every file of a scanned folder is placed
+    {"op": "undo", "id": 7}                        the transfer was reverted
+    {"op": "end"}                                  the run finished, or was undone
+
+A plan record is fsynced before its transfer starts. Workers waiting at the
+same time share one fsync, so the cost is paid per batch rather than per
+file. The other records are only flushed: losing one is repaired by settle(),
+which looks at both ends of every planned transfer that has no outcome.
+
+A run without an end record was interrupted. The next run over the same
+scan_root in the same mode resumes it, skipping the folders it finished, and
+any other run is refused until it is resumed or undone. A new run truncates
+the journal, which therefore only ever describes the last run: the one --undo
+reverts.
+"""
+
+import json
+import os
+import threading
+
+import exif
+
+JOURNAL_FILE = ".dedupe_journal"
+
+
+def read_records(path):
+    """The records of a journal, ignoring a line torn by a crash"""
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class Run:
+    """
+    The state of the last run in a journal, as read from the file.
+
+    Transfers planned and folders finished from then on are only written to
+    the file, so memory doesn't grow with the number of files a run places.
+    """
+
+    def __init__(self, records=(), scan_root=None, mode=None):
+        self.reset(scan_root, mode)
+        self.ended = scan_root is None
+
+        for record in records:
+            op = record.get("op")
+            if op == "run":
+                self.reset(record.get("scan_root"), record.get("mode"))
+            elif op == "plan":
+                self.plans[record["id"]] = record
+            elif op in ("done", "fail", "undo"):
+                self.outcomes[record["id"]] = op
+            elif op == "dir":
+                self.dirs.add(record["dirpath"])
+            elif op == "end":
+                self.ended = True
+
+    def reset(self, scan_root, mode):
+        self.scan_root = scan_root
+        self.mode = mode
+        self.ended = False
+        self.plans = {}
+        self.outcomes = {}
+        self.dirs = set()
+
+    def pending(self):
+        """Planned transfers with no recorded outcome, in the order they were planned"""
+        return [plan for i, plan in sorted(self.plans.items()) if i not in self.outcomes]
+
+    def done(self):
+        """Finished transfers that are not undone yet, in the order they were planned"""
+        return [plan for i, plan in sorted(self.plans.items()) if self.outcomes.get(i) == "done"]
+
+
+def settle(plan):
+    """
+    Work out what became of a planned transfer that has no outcome recorded.
+
+    A dst that is src itself, linked by a move or hardlink, or that has the
+    content of src (by the hash in the plan, or of src) is complete, and a
+    move is finished by unlinking src. A dst holding the start of src is a
+    copy cut short, and is removed. Anything else at dst was there before the
+    transfer, which then failed, and both files are left alone. A dst whose
+    source is gone is taken as complete. Returns True if the transfer is now
+    complete, False if it left nothing behind.
+    """
+    src, dst = plan["src"], plan["dst"]
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    try:
+        src_stat = os.stat(src)
+    except FileNotFoundError:
+        return True
+
+    if os.path.samestat(src_stat, dst_stat):
+        complete = True
+    elif src_stat.st_size == dst_stat.st_size:
+        expected = plan.get("hash") or exif.calculate_file_hash(src)
+        complete = expected is not None and exif.calculate_file_hash(dst) == expected
+    else:
+        if dst_stat.st_size < src_stat.st_size and _starts_with(src, dst):
+            os.unlink(dst)
+        return False
+
+    if not complete:
+        return False
+    if plan["mode"] == "move":
+        os.unlink(src)
+    return True
+
+
+def _starts_with(path, prefix_path, chunk_size=1024 * 1024):
+    """Whether the content of prefix_path is the start of that of path"""
+    with open(path, "rb") as f, open(prefix_path, "rb") as prefix:
+        while True:
+            expected = prefix.read(chunk_size)
+            if not expected:
+                return True
+            if f.read(len(expected)) != expected:
+                return False
+
+
+class Journal:
+    """Appends records to the journal of target_root; see the module docstring"""
+
+    def __init__(self, target_root):
+        self.path = os.path.join(target_root, JOURNAL_FILE)
+        self.run = Run(read_records(self.path))
+        self._next_id = max(self.run.plans, default=0) + 1
+        self._lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def unfinished(self, scan_root, mode):
+        """Whether the last run was interrupted; raises ValueError if it isn't the same as this one"""
+        if self.run.ended:
+            return False
+        if os.path.abspath(self.run.scan_root) != os.path.abspath(scan_root) or self.run.mode != mode:
+            raise ValueError("%s has an unfinished %s run from %s; run it again to resume it, or revert it "
+                             "with --undo" % (os.path.dirname(self.path), self.run.mode, self.run.scan_root))
+        return True
+
+    def start(self, scan_root, mode):
+        """Start a run, or resume the last one; returns True when resuming"""
+        scan_root = os.path.abspath(scan_root)
+        resume = self.unfinished(scan_root, mode)
+        if resume:
+            self._file = open(self.path, "a")
+            self._write({"op": "resume"})
+        else:
+            self.run = Run(scan_root=scan_root, mode=mode)
+            self._file = open(self.path, "w")
+            self._write({"op": "run", "scan_root": scan_root, "mode": mode})
+        self.sync()
+        return resume
+
+    def reopen(self):
+        """Open the journal to append to the last run, as --undo does"""
+        self._file = open(self.path, "a")
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._written += 1
+            return self._written
+
+    def sync(self, upto=None):
+        """fsync the journal, unless another thread already did since record `upto` was written"""
+        with self._lock:
+            if self._synced >= (self._written if upto is None else upto):
+                return
+            written = self._written
+            os.fsync(self._file.fileno())
+            self._synced = written
+
+    def plan(self, src, dst, mode, file_hash=None):
+        """Record a transfer about to start; returns (id, seq) where seq is passed to sync()"""
+        with self._lock:
+            op_id = self._next_id
+            self._next_id += 1
+        record = {"op": "plan", "id": op_id, "src": src, "dst": dst, "mode": mode}
+        if file_hash is not None:
+            record["hash"] = file_hash
+        return op_id, self._write(record)
+
+    def outcome(self, op_id, op):
+        """Record "done", "fail" or "undo" for a planned transfer"""
+        if op_id in self.run.plans:
+            # a transfer of the run read from the journal, being settled or undone
+            self.run.outcomes[op_id] = op
+        self._write({"op": op, "id": op_id})
+
+    def dir_done(self, dirpath):
+        self._write({"op": "dir", "dirpath": dirpath})
+
+    def end(self):
+        self.run.ended = True
+        self._write({"op": "end"})
+        self.sync()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
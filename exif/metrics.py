@@ -0,0 +1,187 @@
+"""
+Timings and counters of a run, shared by collect_exif_data, find_duplicates
+and deduplicate.
+
+The code being measured reports into one process-wide Metrics:
+
+    with metrics.phase("hash"):      wall and CPU time of a phase, summed over calls
+    metrics.timed_iter("load", it)   the same for the time spent producing the items of it
+    metrics.count("bytes_read", n)   a counter
+    metrics.observe("exiftool", dt)  one latency sample of a histogram
+
+Phases can run on several threads at once and contain each other, so their
+wall times can add up to more than the run took. CPU time is that of the
+calling thread. Histograms have power-of-two buckets from 1 ms to 16 s.
+
+The tools take --stats json, which prints everything to stderr when the run
+ends, and --profile PATH, which runs them under cProfile, writes the pstats
+data to PATH and a summary sorted by cumulative time to PATH.txt. cProfile
+only sees the main thread; the phases above cover the worker threads.
+"""
+
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+FORMATS = ("json",)
+BUCKETS = tuple(0.001 * 2 ** i for i in range(15))
+PROFILE_SUMMARY_LINES = 40
+
+
+class Histogram:
+    """Latency samples counted in BUCKETS"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        labels = ["<=%gms" % (bound * 1000) for bound in BUCKETS] + [">%gms" % (BUCKETS[-1] * 1000)]
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {label: n for label, n in zip(labels, self.buckets) if n},
+        }
+
+
+class Metrics:
+    """Phases, counters and histograms of one run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.perf_counter()
+            self.started_cpu = time.process_time()
+            self.phases = defaultdict(lambda: [0, 0.0, 0.0])
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+
+    def _add(self, name, wall, cpu):
+        with self._lock:
+            totals = self.phases[name]
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    @contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed_iter(self, name, iterable):
+        """Yield the items of iterable, counting the time spent in producing them as phase `name`"""
+        it = iter(iterable)
+        wall = cpu = 0.0
+        try:
+            while True:
+                started, started_cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    wall += time.perf_counter() - started
+                    cpu += time.thread_time() - started_cpu
+                yield item
+        finally:
+            self._add(name, wall, cpu)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.histograms[name].observe(seconds)
+
+    def as_dict(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                "elapsed": elapsed,
+                "cpu": time.process_time() - self.started_cpu,
+                "phases": {name: {"calls": calls, "wall": wall, "cpu": cpu}
+                           for name, (calls, wall, cpu) in sorted(self.phases.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "rates": {name + "_per_second": n / elapsed for name, n in sorted(self.counters.items())},
+                "histograms": {name: h.as_dict() for name, h in sorted(self.histograms.items())},
+            }
+
+
+_metrics = Metrics()
+
+
+def get():
+    return _metrics
+
+
+def phase(name):
+    return _metrics.phase(name)
+
+
+def timed_iter(name, iterable):
+    return _metrics.timed_iter(name, iterable)
+
+
+def count(name, n=1):
+    _metrics.count(name, n)
+
+
+def observe(name, seconds):
+    _metrics.observe(name, seconds)
+
+
+def add_arguments(parser):
+    parser.add_argument("--stats", choices=FORMATS,
+                        help="Print the time spent in each phase, counters and exiftool latencies to stderr")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Run under cProfile, writing pstats data to PATH and a summary to PATH.txt")
+
+
+@contextmanager
+def reporting(args):
+    """Around the run of a tool: profile it with --profile, and print --stats when it ends"""
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield _metrics
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            with open(args.profile + ".txt", "w") as fp:
+                pstats.Stats(profiler, stream=fp).sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+        if args.stats == "json":
+            json.dump(_metrics.as_dict(), sys.stderr, indent=2)
+            sys.stderr.write("\n")
@@ -0,0 +1,395 @@
+"""
+In-process reader for the few tags scan needs, for JPEG, NEF and HEIC files.
+
+Every field from_exif_entry() reads sits in the first few tens of kilobytes of
+these files, so parsing the headers here reads a handful of small blocks per
+file instead of handing the whole directory to exiftool. (The PyPI `exif`
+package can't be used for this: this repo's own `exif` package shadows it.)
+
+read_tags() returns a dict shaped like an exiftool -j record, so the entries it
+produces, and the .exif_data files written from them, are the same as with
+exiftool. That only holds where exiftool's answer is unambiguous, so anything
+else raises Unsupported and the file is left to exiftool:
+
+- makes other than NATIVE_MAKES, whose maker notes may hold a ShutterCount or
+  SerialNumber this reader doesn't decode
+- files without an EXIF DateTimeOriginal, which exiftool may find in XMP or
+  QuickTime metadata instead
+- empty strings, conflicting serial numbers, and anything malformed
+"""
+
+import json
+import os
+import re
+import struct
+
+from exif import metrics
+
+HEADER_SIZE = 64 * 1024
+MAX_VALUE_SIZE = 1024 * 1024
+
+NATIVE_MAKES = ("Apple", "NIKON CORPORATION", "NIKON")
+
+# TIFF field types and their sizes in bytes
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+INT_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 13: "I"}
+
+TAG_SUBFILE_TYPE = 0x00fe
+TAG_IMAGE_WIDTH = 0x0100
+TAG_IMAGE_HEIGHT = 0x0101
+TAG_MAKE = 0x010f
+TAG_SUB_IFDS = 0x014a
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_MAKER_NOTE = 0x927c
+TAG_SERIAL_NUMBER = 0xa431
+
+NIKON_SERIAL_NUMBER = 0x001d
+NIKON_SERIAL_NUMBER_OLD = 0x00a0
+NIKON_SHUTTER_COUNT = 0x00a7
+
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+
+# strings exiftool -j writes as JSON numbers
+JSON_NUMBER = re.compile(r"^-?(\d|[1-9]\d{1,14})(\.\d{1,16})?(e[-+]?\d{1,3})?$", re.IGNORECASE)
+
+
+class Unsupported(Exception):
+    """The file has to be read by exiftool"""
+
+
+def format_file_size(size):
+    """FileSize the way exiftool prints it"""
+    if size < 2000:
+        return "%d bytes" % size
+    if size < 10000:
+        return "%.1f kB" % (size / 1000)
+    if size < 2000000:
+        return "%.0f kB" % (size / 1000)
+    if size < 10000000:
+        return "%.1f MB" % (size / 1000000)
+    if size < 2000000000:
+        return "%.0f MB" % (size / 1000000)
+    if size < 10000000000:
+        return "%.1f GB" % (size / 1000000000)
+    return "%.0f GB" % (size / 1000000000)
+
+
+def _json_value(value):
+    """value as it comes back from exiftool's JSON output"""
+    return json.loads(value) if JSON_NUMBER.match(value) else value
+
+
+class _Source:
+    """Random access to a file, serving reads within its first HEADER_SIZE bytes from memory"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.head = fp.read(HEADER_SIZE)
+        self.bytes_read = len(self.head)
+
+    def read_at(self, offset, length):
+        if offset < 0 or length < 0 or length > MAX_VALUE_SIZE:
+            raise Unsupported("bad offset")
+        if offset + length <= len(self.head):
+            return self.head[offset:offset + length]
+        self.fp.seek(offset)
+        data = self.fp.read(length)
+        self.bytes_read += len(data)
+        if len(data) < length:
+            raise Unsupported("truncated file")
+        return data
+
+
+class _Tiff:
+    """A TIFF structure starting at `offset` in the file: a plain TIFF, or the EXIF block of a JPEG or HEIC"""
+
+    def __init__(self, src, offset):
+        self.src = src
+        self.offset = offset
+        header = src.read_at(offset, 8)
+        if header[:4] == b"II*\0":
+            self.endian = "<"
+        elif header[:4] == b"MM\0*":
+            self.endian = ">"
+        else:
+            raise Unsupported("no TIFF header")
+        self.first_ifd = struct.unpack(self.endian + "I", header[4:])[0]
+
+    def ifd(self, pos):
+        """{tag: (type, count, data)} of the IFD at pos; data is the value, or its offset in the file"""
+        (count,) = struct.unpack(self.endian + "H", self.src.read_at(self.offset + pos, 2))
+        raw = self.src.read_at(self.offset + pos + 2, count * 12)
+
+        entries = {}
+        for i in range(count):
+            tag, typ, n, value = struct.unpack_from(self.endian + "HHI4s", raw, i * 12)
+            if typ not in TYPE_SIZES:
+                continue
+            length = TYPE_SIZES[typ] * n
+            if length > 4:
+                entries[tag] = (typ, n, self.offset + struct.unpack(self.endian + "I", value)[0])
+            else:
+                entries[tag] = (typ, n, value[:length])
+        return entries
+
+    def _data(self, entry):
+        typ, n, data = entry
+        if isinstance(data, int):
+            return self.src.read_at(data, TYPE_SIZES[typ] * n)
+        return data
+
+    def ints(self, entry):
+        if entry is None:
+            return []
+        typ, n, _ = entry
+        if typ not in INT_FORMATS:
+            raise Unsupported("not an integer")
+        return list(struct.unpack(self.endian + INT_FORMATS[typ] * n, self._data(entry)))
+
+    def string(self, entry):
+        """An ASCII value as exiftool prints it, None if it's missing"""
+        if entry is None:
+            return None
+        if entry[0] != 2:
+            raise Unsupported("not a string")
+        try:
+            value = self._data(entry).split(b"\0", 1)[0].decode("utf-8").rstrip(" ")
+        except UnicodeDecodeError:
+            raise Unsupported("not UTF-8")
+        if not value:
+            raise Unsupported("empty string")
+        return value
+
+
+def _nikon_maker_note(tiff, entry):
+    """(SerialNumber, ShutterCount) from a Nikon type 3 maker note"""
+    start = entry[2]
+    if not isinstance(start, int) or tiff.src.read_at(start, 7) != b"Nikon\0\x02":
+        raise Unsupported("unknown Nikon maker note")
+
+    maker_note = _Tiff(tiff.src, start + 10)
+    ifd = maker_note.ifd(maker_note.first_ifd)
+    if NIKON_SERIAL_NUMBER_OLD in ifd:
+        raise Unsupported("second SerialNumber")
+
+    shutter_count = maker_note.ints(ifd.get(NIKON_SHUTTER_COUNT))
+    return maker_note.string(ifd.get(NIKON_SERIAL_NUMBER)), shutter_count[0] if shutter_count else None
+
+
+def _exif_tags(tiff):
+    """The tags from_exif_entry reads, except ImageSize, plus IFD0 for callers that need it"""
+    ifd0 = tiff.ifd(tiff.first_ifd)
+    make = tiff.string(ifd0.get(TAG_MAKE))
+    if make not in NATIVE_MAKES:
+        raise Unsupported("make %s" % make)
+
+    exif_ifd_pos = tiff.ints(ifd0.get(TAG_EXIF_IFD))
+    if not exif_ifd_pos:
+        raise Unsupported("no EXIF IFD")
+    exif_ifd = tiff.ifd(exif_ifd_pos[0])
+
+    timestamp = tiff.string(exif_ifd.get(TAG_DATE_TIME_ORIGINAL))
+    if timestamp is None:
+        raise Unsupported("no DateTimeOriginal")
+
+    tags = {"DateTimeOriginal": timestamp, "Make": make}
+    serial_number = tiff.string(exif_ifd.get(TAG_SERIAL_NUMBER))
+
+    if make.startswith("NIKON") and TAG_MAKER_NOTE in exif_ifd:
+        maker_serial_number, shutter_count = _nikon_maker_note(tiff, exif_ifd[TAG_MAKER_NOTE])
+        if serial_number and maker_serial_number and serial_number != maker_serial_number:
+            raise Unsupported("conflicting SerialNumber")
+        serial_number = serial_number or maker_serial_number
+        if shutter_count is not None:
+            tags["ShutterCount"] = shutter_count
+
+    if serial_number is not None:
+        tags["SerialNumber"] = _json_value(serial_number)
+    return tags, ifd0
+
+
+def _read_jpeg(src):
+    tiff = None
+    pos = 2
+    while True:
+        header = src.read_at(pos, 4)
+        if header[0] != 0xff:
+            raise Unsupported("bad JPEG marker")
+        marker = header[1]
+        if marker == 0xff:
+            pos += 1
+            continue
+        if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+            pos += 2
+            continue
+        if marker in (0xda, 0xd9):
+            raise Unsupported("no SOF before the image data")
+
+        (length,) = struct.unpack(">H", header[2:])
+        if marker == 0xe1 and tiff is None and src.read_at(pos + 4, 6) == b"Exif\0\0":
+            tiff = _Tiff(src, pos + 10)
+        elif marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", src.read_at(pos + 5, 4))
+            break
+        pos += 2 + length
+
+    if tiff is None:
+        raise Unsupported("no EXIF")
+    tags, _ = _exif_tags(tiff)
+    return tags, (width, height)
+
+
+def _read_tiff(src):
+    """NEF and other TIFF-based raw files, sized by their full-resolution image"""
+    tiff = _Tiff(src, 0)
+    tags, ifd0 = _exif_tags(tiff)
+
+    for ifd in [ifd0] + [tiff.ifd(pos) for pos in tiff.ints(ifd0.get(TAG_SUB_IFDS))]:
+        if tiff.ints(ifd.get(TAG_SUBFILE_TYPE)) == [0]:
+            width = tiff.ints(ifd.get(TAG_IMAGE_WIDTH))
+            height = tiff.ints(ifd.get(TAG_IMAGE_HEIGHT))
+            if width and height:
+                return tags, (width[0], height[0])
+    raise Unsupported("no full-resolution image")
+
+
+def _boxes(src, start, end):
+    """(type, payload start, end) of the ISO BMFF boxes between start and end"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", src.read_at(pos, 8))
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", src.read_at(pos + 8, 8))
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise Unsupported("bad box")
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _uint(data, pos, size):
+    if size == 0:
+        return 0, pos
+    return int.from_bytes(data[pos:pos + size], "big"), pos + size
+
+
+def _read_heic(src, file_size):
+    meta = next((b for b in _boxes(src, 0, file_size) if b[0] == b"meta"), None)
+    if meta is None:
+        raise Unsupported("no meta box")
+
+    primary = None
+    exif_items = set()
+    locations = {}
+    properties = []
+    associations = {}
+
+    # meta is a full box: skip its version and flags
+    for box_type, start, end in _boxes(src, meta[1] + 4, meta[2]):
+        if box_type in (b"pitm", b"iinf", b"iloc"):
+            data = src.read_at(start, end - start)
+            version = data[0]
+
+        if box_type == b"pitm":
+            primary, _ = _uint(data, 4, 2 if version == 0 else 4)
+
+        elif box_type == b"iinf":
+            _, pos = _uint(data, 4, 2 if version == 0 else 4)
+            for entry_type, entry_start, entry_end in _boxes(src, start + pos, end):
+                entry = data[entry_start - start:entry_end - start]
+                if entry_type != b"infe" or entry[0] < 2:
+                    continue
+                item_id, pos = _uint(entry, 4, 2 if entry[0] == 2 else 4)
+                if entry[pos + 2:pos + 6] == b"Exif":
+                    exif_items.add(item_id)
+
+        elif box_type == b"iloc":
+            offset_size, length_size = data[4] >> 4, data[4] & 15
+            base_offset_size, index_size = data[5] >> 4, (data[5] & 15 if version in (1, 2) else 0)
+            count, pos = _uint(data, 6, 2 if version < 2 else 4)
+            for _ in range(count):
+                item_id, pos = _uint(data, pos, 2 if version < 2 else 4)
+                method = 0
+                if version in (1, 2):
+                    method, pos = _uint(data, pos, 2)
+                    method &= 15
+                pos += 2  # data_reference_index
+                base_offset, pos = _uint(data, pos, base_offset_size)
+                extent_count, pos = _uint(data, pos, 2)
+                extents = []
+                for _ in range(extent_count):
+                    _, pos = _uint(data, pos, index_size)
+                    extent_offset, pos = _uint(data, pos, offset_size)
+                    extent_length, pos = _uint(data, pos, length_size)
+                    extents.append((base_offset + extent_offset, extent_length))
+                locations[item_id] = (method, extents)
+
+        elif box_type == b"iprp":
+            for child_type, child_start, child_end in _boxes(src, start, end):
+                if child_type == b"ipco":
+                    properties = list(_boxes(src, child_start, child_end))
+                elif child_type == b"ipma":
+                    ipma = src.read_at(child_start, child_end - child_start)
+                    count, pos = _uint(ipma, 4, 4)
+                    for _ in range(count):
+                        item_id, pos = _uint(ipma, pos, 2 if ipma[0] < 1 else 4)
+                        n, pos = _uint(ipma, pos, 1)
+                        indexes = []
+                        for _ in range(n):
+                            if ipma[3] & 1:
+                                index, pos = _uint(ipma, pos, 2)
+                                indexes.append(index & 0x7fff)
+                            else:
+                                index, pos = _uint(ipma, pos, 1)
+                                indexes.append(index & 0x7f)
+                        associations[item_id] = indexes
+
+    if len(exif_items) != 1:
+        raise Unsupported("no single Exif item")
+    method, extents = locations.get(exif_items.pop(), (None, []))
+    if method != 0 or len(extents) != 1:
+        raise Unsupported("Exif item not in one extent")
+    exif_offset = extents[0][0]
+    (tiff_offset,) = struct.unpack(">I", src.read_at(exif_offset, 4))
+    tags, _ = _exif_tags(_Tiff(src, exif_offset + 4 + tiff_offset))
+
+    for index in associations.get(primary, []):
+        if 0 < index <= len(properties) and properties[index - 1][0] == b"ispe":
+            start = properties[index - 1][1]
+            return tags, struct.unpack(">II", src.read_at(start + 4, 8))
+    raise Unsupported("no image size")
+
+
+def read_tags(path):
+    """
+    The tags of one file as exiftool -j would report them.
+
+    Raises Unsupported if the file has to be read by exiftool instead.
+    """
+    with open(path, "rb") as fp:
+        file_size = os.fstat(fp.fileno()).st_size
+        src = _Source(fp)
+        magic = src.head[:12]
+
+        try:
+            if magic[:2] == b"\xff\xd8":
+                tags, dimensions = _read_jpeg(src)
+            elif magic[:4] in (b"II*\0", b"MM\0*"):
+                tags, dimensions = _read_tiff(src)
+            elif magic[4:8] == b"ftyp":
+                tags, dimensions = _read_heic(src, file_size)
+            else:
+                raise Unsupported("unknown file type")
+        except (struct.error, IndexError, ValueError) as e:
+            raise Unsupported("malformed file: %s" % e)
+        finally:
+            metrics.count("bytes_read", src.bytes_read)
+
+    tags["FileName"] = os.path.basename(path)
+    tags["FileSize"] = format_file_size(file_size)
+    tags["ImageSize"] = "%dx%d" % dimensions
+    return tags
@@ -0,0 +1,179 @@
+"""
+Perceptual hashes for finding resized, re-encoded or stripped copies of photos.
+
+A re-exported copy of a photo has a different SHA-256, and without its EXIF
+it lands in noexif where uniq_str() can't match it either. A difference hash
+(dHash) survives all of that: the image is shrunk to 9x8 grey pixels and each
+bit records whether a pixel is brighter than its right neighbour. Copies of the
+same picture end up a few bits apart.
+
+Hashes are cached per folder in .phash_data next to .exif_data, keyed by the
+same (size, mtime_ns, inode) as .exif_stat, so only new or changed images are
+decoded again. Near-duplicates are clustered with a BK-tree, which prunes the
+search by the triangle inequality instead of comparing every pair.
+
+Decoding needs NumPy and Pillow, which are optional; available() tells whether
+they are installed.
+"""
+
+import json
+import os
+
+import exif
+from exif import metrics
+
+try:
+    import numpy as np
+    from PIL import Image, ImageOps
+except ImportError:
+    np = Image = ImageOps = None
+
+PHASH_FILE_NAME = ".phash_data"
+HASH_SIZE = 8
+DEFAULT_MAX_DISTANCE = 8
+VIDEO_EXTS = ("mov", "mp4")
+
+
+def available():
+    return np is not None and Image is not None
+
+
+def is_still_image(filename):
+    return "." in filename and filename.rsplit(".", 1)[1].lower() not in VIDEO_EXTS
+
+
+def dhash(path, hash_size=HASH_SIZE):
+    """The hash_size**2 bit difference hash of an image, or None if it can't be decoded"""
+    try:
+        with metrics.phase("phash"), Image.open(path) as img:
+            # JPEGs can be decoded straight at a fraction of their size
+            img.draft("L", (hash_size * 8, hash_size * 8))
+            img = ImageOps.exif_transpose(img).convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+            pixels = np.asarray(img, dtype=np.int16)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def load_phash_file(phash_file_path):
+    """{filename: [size, mtime_ns, inode, hash]} from a folder's .phash_data"""
+    try:
+        with open(phash_file_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_phash_file(phash_file_path, hashes):
+    tmp_path = phash_file_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(hashes, f, sort_keys=True)
+    os.replace(tmp_path, phash_file_path)
+
+
+def folder_hashes(dirpath, filenames, service):
+    """
+    {filename: hash} for the still images among filenames, decoding only those
+    not in the folder's .phash_data. Images that can't be decoded map to None.
+    """
+    phash_file_path = os.path.join(dirpath, PHASH_FILE_NAME)
+    cached = load_phash_file(phash_file_path)
+
+    current = {}
+    stale = []
+    for name in filenames:
+        if not is_still_image(name):
+            continue
+        try:
+            key = exif.stat_key(os.stat(os.path.join(dirpath, name)))
+        except OSError:
+            continue
+        if cached.get(name, [None])[:3] == key:
+            current[name] = cached[name]
+        else:
+            stale.append((name, key))
+
+    for (name, key), value in zip(stale, service.map((os.path.join(dirpath, name) for name, _ in stale), dhash)):
+        current[name] = key + [None if value is None else "%016x" % value]
+
+    if current != cached:
+        try:
+            save_phash_file(phash_file_path, current)
+        except OSError:
+            pass  # read-only folder: hash again next time
+
+    return {name: None if current[name][3] is None else int(current[name][3], 16)
+            for name in filenames if name in current}
+
+
+class BKTree:
+    """A metric tree over Hamming distance; each node holds the items sharing its hash"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Items whose hash is within radius of value"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            d = hamming(value, node_value)
+            if d <= radius:
+                found.extend(items)
+            for child_distance, child in children.items():
+                if d - radius <= child_distance <= d + radius:
+                    stack.append(child)
+        return found
+
+
+def clusters(hashed, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Group (item, hash) pairs whose hashes are within max_distance of each other, transitively.
+
+    Returns the lists of items of every cluster with more than one member, in
+    the order their first items appear in `hashed`.
+    """
+    parent = list(range(len(hashed)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    tree = BKTree()
+    for i, (_, value) in enumerate(hashed):
+        for j in tree.search(value, max_distance):
+            a, b = find(i), find(j)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        tree.add(value, i)
+
+    members = {}
+    for i in range(len(hashed)):
+        members.setdefault(find(i), []).append(hashed[i][0])
+    return [items for items in members.values() if len(items) > 1]
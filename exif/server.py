@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Local server answering "is this already in the library?" over a Unix socket.
+
+The server loads a library once, from its .exif_data files or a catalog. It
+keeps the uniq_str() of every ExifEntry and the SHA-256 of every NoExifFile in
+memory, with the paths holding each one. Clients then send batches of lookups,
+so an ingest service can check an upload without running find_duplicates over
+everything.
+
+    python -m exif.server serve /photos --socket /run/photos.sock [--catalog library.db]
+    python -m exif.server query --socket /run/photos.sock upload1.jpg upload2.mov
+
+The protocol is one JSON object per line in each direction. A request is
+
+    {"lookups": [{"path": "/uploads/a.jpg"},
+                 {"metadata": {"FileName": "b.jpg", "DateTimeOriginal": ..., ...}},
+                 {"hash": "<sha256>"}]}
+
+and the reply holds one result per lookup, in order:
+
+    {"results": [{"duplicate": true, "matches": ["/photos/2023/a.jpg"]}, ...]}
+
+A path is read by exif.native or, failing that, by exiftool. Files without an
+EXIF timestamp are hashed, the way scan and find_duplicates treat them.
+Metadata must look like exiftool -j output, including FileName and FileSize.
+A lookup that can't be answered gets {"error": "..."} instead.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+from collections import defaultdict
+
+import exif
+from exif import exiftool, native
+from exif.catalog import Catalog
+from exif.hashing import HashService
+from exif.walk import load_tree
+
+
+class Index:
+    """The paths of every ExifEntry key and NoExifFile hash in a library"""
+
+    def __init__(self):
+        self.keys = defaultdict(list)
+        self.hashes = defaultdict(list)
+
+    def __len__(self):
+        return sum(len(p) for p in self.keys.values()) + sum(len(p) for p in self.hashes.values())
+
+    @classmethod
+    def build(cls, entries, service=None):
+        """Index entries, hashing the NoExifFiles among them that have no hash yet"""
+        index = cls()
+        noexif_files = []
+        for e in entries:
+            if isinstance(e, exif.NoExifFile):
+                noexif_files.append(e)
+            else:
+                index.keys[e.uniq_str()].append(e.path())
+
+        if service is not None:
+            service.hash_files(noexif_files)
+        for f in noexif_files:
+            if f.file_hash is not None:
+                index.hashes[f.file_hash].append(f.path())
+        return index
+
+    def match(self, entry):
+        """The library paths matching an ExifEntry or a hashed NoExifFile"""
+        if isinstance(entry, exif.NoExifFile):
+            return list(self.hashes.get(entry.file_hash, ()))
+        return list(self.keys.get(entry.uniq_str(), ()))
+
+
+def read_entries(paths):
+    """
+    ({path: entry}, {path: error}) for files, read natively where possible and
+    otherwise by exiftool, with the same commands as a scan.
+    """
+    entries = {}
+    errors = {}
+    fallback = []
+    for path in paths:
+        try:
+            entries[path] = exif.from_exif_entry(native.read_tags(path), os.path.dirname(path))
+        except (native.Unsupported, OSError):
+            fallback.append(path)
+
+    if fallback:
+        try:
+            for record in exiftool.extract_files(fallback):
+                path = record.get("SourceFile")
+                if "Error" in record:
+                    print("%s: %s" % (path, record["Error"]))
+                    errors[path] = record["Error"]
+                else:
+                    entries[path] = exif.from_exif_entry(record, os.path.dirname(path))
+        except (exiftool.ExifToolError, OSError) as e:
+            # the paths left out are answered with an error
+            print("Error running exiftool: %s" % e)
+    return entries, errors
+
+
+def answer(index, lookups):
+    """The result of each lookup of a request"""
+    paths = [item["path"] for item in lookups if isinstance(item, dict) and "path" in item]
+    by_path, errors = read_entries(paths) if paths else ({}, {})
+
+    results = []
+    for item in lookups:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("A lookup must be an object")
+            if "hash" in item:
+                entry = exif.NoExifFile(file_hash=item["hash"])
+            elif "metadata" in item:
+                entry = exif.from_exif_entry(item["metadata"], "")
+                if isinstance(entry, exif.NoExifFile) and not entry.has_hash():
+                    raise ValueError("No DateTimeOriginal: look the file up by path or hash instead")
+            elif "path" in item:
+                entry = by_path.get(item["path"])
+                if entry is None:
+                    error = errors.get(item["path"])
+                    raise ValueError("Can't read %s%s" % (item["path"], ": " + error if error else ""))
+                if isinstance(entry, exif.NoExifFile) and entry.file_hash is None:
+                    raise ValueError("Can't hash %s" % item["path"])
+            else:
+                raise ValueError("A lookup needs a path, metadata or hash")
+        except (KeyError, ValueError) as e:
+            results.append({"error": str(e)})
+            continue
+
+        matches = [m for m in index.match(entry) if m != item.get("path")]
+        results.append({"duplicate": bool(matches), "matches": matches})
+    return results
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request.get("lookups"), list):
+                    raise ValueError("A request needs a list of lookups")
+                reply = {"results": answer(self.server.index, request["lookups"])}
+            except (ValueError, TypeError, AttributeError) as e:
+                reply = {"error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    """Serves lookups against an Index on a Unix socket, one thread per client"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, index):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # left over from a server that didn't shut down
+        self.index = index
+        super().__init__(socket_path, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class Client:
+    """Sends batches of lookups to a Server"""
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self._rfile = self.sock.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._rfile.close()
+        self.sock.close()
+
+    def lookup(self, lookups):
+        """The results of a batch of lookups, see the module docstring"""
+        self.sock.sendall(json.dumps({"lookups": lookups}).encode() + b"\n")
+        line = self._rfile.readline()
+        if not line:
+            raise ConnectionError("The server closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise ValueError(reply["error"])
+        return reply["results"]
+
+    def lookup_paths(self, paths):
+        return self.lookup([{"path": os.path.abspath(p)} for p in paths])
+
+    def lookup_metadata(self, records):
+        return self.lookup([{"metadata": r} for r in records])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m exif.server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Load a library and answer lookups")
+    serve_parser.add_argument("dir", help="Root folder of the library")
+    serve_parser.add_argument("--socket", required=True, help="Path of the Unix socket to listen on")
+    serve_parser.add_argument("--catalog", help="Load entries from this catalog database instead of .exif_data")
+
+    query_parser = subparsers.add_parser("query", help="Ask a server whether files are already in its library")
+    query_parser.add_argument("--socket", required=True, help="Path of the server's Unix socket")
+    query_parser.add_argument("files", nargs="+", help="Files to look up")
+
+    args = parser.parse_args()
+
+    if args.command == "query":
+        with Client(args.socket) as client:
+            for path, result in zip(args.files, client.lookup_paths(args.files)):
+                if "error" in result:
+                    print("%s: %s" % (path, result["error"]))
+                elif result["duplicate"]:
+                    print("%s: duplicate of %s" % (path, ", ".join(result["matches"])))
+                else:
+                    print("%s: new" % path)
+        return
+
+    if not os.path.exists(args.dir):
+        print("Error: Path does not exist: %s" % args.dir)
+        sys.exit(1)
+
+    with HashService() as service:
+        if args.catalog:
+            with Catalog(args.catalog) as catalog:
+                index = Index.build(catalog.iter_entries(os.path.abspath(args.dir)), service)
+        else:
+            index = Index.build(load_tree(args.dir), service)
+    print("Loaded %d keys and %d hashes from %s" % (len(index.keys), len(index.hashes), args.dir))
+
+    with Server(args.socket, index) as server:
+        print("Listening on %s" % args.socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            exiftool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Sharded scanning of a library spread over several storage nodes.
+
+Each node scans its own subtree into a manifest: every entry with its dedup
+key, sorted by key. NoExif files are hashed on the node holding them, so the
+key of every entry is known without reading the file again. A merge then
+walks any number of manifests side by side with a k-way merge, meets every
+copy of a photo at the same point, and writes a plan of the files each node
+places into the target. No node reads another node's files, and the merge only
+holds one key's entries at a time.
+
+    python -m exif.shard scan /photos -o nas1.manifest --node nas1
+    python -m exif.shard merge nas1.manifest nas2.manifest -o plan.jsonl
+    deduplicate.py --plan plan.jsonl --node nas1 /target      (on nas1, then on nas2)
+
+A manifest is gzipped JSON lines. The first line is a header
+
+    {"manifest": 1, "node": "nas1", "root": "/photos", "entries": 1234}
+
+and every other line is [key, entry], where entry is the as_dict() of an
+ExifEntry or NoExifFile with Dirpath relative to root. Keys are "exif:" and
+the uniq_str() of an ExifEntry, or "hash:" and the SHA-256 of a NoExifFile.
+These manifests describe a source tree; they are unrelated to the
+--target-manifest of deduplicate, which lists the files of a target.
+
+The plan is JSON lines too: a header {"plan": 1, "nodes": {name: root}} and
+one {"node": ..., "entry": ..., "copies": [...]} per file to place, entry
+holding the absolute Dirpath on its node and copies the "node:path" of the
+duplicates left out. Of the copies of a photo, the one in the manifest given
+first to merge is kept, and within a manifest the first by path.
+
+Applying the plan goes through deduplicate, one node at a time, since the
+journal and the hash store of a target describe a single run.
+"""
+
+import argparse
+import gzip
+import heapq
+import itertools
+import json
+import os
+import sys
+from operator import itemgetter
+
+import exif
+from exif.catalog import Catalog
+from exif.hashing import HashService, DEFAULT_WORKERS, DEFAULT_DEVICE_LIMIT
+from exif.walk import load_tree
+
+MANIFEST_VERSION = 1
+PLAN_VERSION = 1
+
+
+def entry_key(entry):
+    """The key copies of entry share across nodes, or None for a NoExifFile that couldn't be hashed"""
+    if isinstance(entry, exif.NoExifFile):
+        return None if entry.file_hash is None else "hash:" + entry.file_hash
+    return "exif:" + entry.uniq_str()
+
+
+def write_manifest(path, root, entries, node=None, service=None):
+    """Write the entries below root to a manifest, hashing the NoExifFiles among them; returns the count"""
+    root = os.path.abspath(root)
+    entries = list(entries)
+    if service is not None:
+        service.hash_files([e for e in entries if isinstance(e, exif.NoExifFile)])
+
+    records = []
+    for entry in entries:
+        key = entry_key(entry)
+        if key is None:
+            print("Leaving out %s: can't hash it" % entry.path())
+            continue
+        record = entry.as_dict()
+        record["Dirpath"] = os.path.relpath(entry.dirpath, root)
+        records.append((key, record["Dirpath"], record["FileName"], record))
+    records.sort(key=itemgetter(0, 1, 2))
+
+    header = {"manifest": MANIFEST_VERSION, "node": node or os.path.basename(root), "root": root,
+              "entries": len(records)}
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt") as fp:
+        fp.write(json.dumps(header) + "\n")
+        for key, _, _, record in records:
+            fp.write(json.dumps([key, record], separators=(",", ":")) + "\n")
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class Manifest:
+    """A manifest being read: its header, then (key, entry) in key order"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = gzip.open(path, "rt")
+        try:
+            header = json.loads(self._fp.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("manifest") != MANIFEST_VERSION:
+            self._fp.close()
+            raise ValueError("%s is not a manifest" % path)
+        self.node = header["node"]
+        self.root = header["root"]
+        self.count = header["entries"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._fp.close()
+
+    def __iter__(self):
+        for line in self._fp:
+            key, record = json.loads(line)
+            yield key, exif.from_exif_entry(record, os.path.normpath(os.path.join(self.root, record["Dirpath"])))
+
+
+def _tagged(manifest):
+    for key, entry in manifest:
+        yield key, manifest.node, entry
+
+
+def merge(manifests):
+    """Yield (key, [(node, entry), ...]) for every key of the manifests, in key order"""
+    nodes = [m.node for m in manifests]
+    if len(set(nodes)) != len(nodes):
+        raise ValueError("Every manifest must come from a different node: %s" % ", ".join(nodes))
+
+    # heapq.merge keeps the manifests' order among equal keys, which makes the first copy the one kept
+    streams = [_tagged(m) for m in manifests]
+    for key, group in itertools.groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        yield key, [(node, entry) for _, node, entry in group]
+
+
+def write_plan(path, manifests, on_duplicates=None):
+    """
+    Merge manifests into a plan at path, returning (files to place, duplicates left out).
+
+    on_duplicates, if given, is called with the [(node, entry), ...] of every
+    key that has more than one copy.
+    """
+    placed = skipped = 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        fp.write(json.dumps({"plan": PLAN_VERSION, "nodes": {m.node: m.root for m in manifests}}) + "\n")
+        for key, copies in merge(manifests):
+            (node, entry), rest = copies[0], copies[1:]
+            record = {"node": node, "entry": entry.as_dict()}
+            if rest:
+                record["copies"] = ["%s:%s" % (n, e.path()) for n, e in rest]
+                if on_duplicates is not None:
+                    on_duplicates(copies)
+            fp.write(json.dumps(record) + "\n")
+            placed += 1
+            skipped += len(rest)
+    os.replace(tmp_path, path)
+    return placed, skipped
+
+
+def read_plan(path, node):
+    """The root of node and the entries of the plan it places, sorted by folder"""
+    with open(path) as fp:
+        try:
+            header = json.loads(fp.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("plan") != PLAN_VERSION:
+            raise ValueError("%s is not a plan" % path)
+        if node not in header["nodes"]:
+            raise ValueError("%s has no node %s, only %s" % (path, node, ", ".join(sorted(header["nodes"]))))
+
+        entries = []
+        for line in fp:
+            record = json.loads(line)
+            if record["node"] == node:
+                entries.append(exif.from_exif_entry(record["entry"], record["entry"]["Dirpath"]))
+    entries.sort(key=lambda e: (e.dirpath, e.filename))
+    return header["nodes"][node], entries
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m exif.shard")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan_parser = subparsers.add_parser("scan", help="Write the manifest of a folder scanned by collect_exif_data")
+    scan_parser.add_argument("dir", help="Root folder of this node's part of the library")
+    scan_parser.add_argument("-o", "--output", required=True, help="Manifest file to write")
+    scan_parser.add_argument("--node", help="Name of this node in plans (default: the folder's name)")
+    scan_parser.add_argument("--catalog", help="Read entries from this catalog database instead of .exif_data")
+    scan_parser.add_argument("--hash-workers", type=int, default=DEFAULT_WORKERS,
+                             help="Number of files to hash in parallel")
+    scan_parser.add_argument("--device-limit", type=int, default=DEFAULT_DEVICE_LIMIT,
+                             help="Number of files to read at once from a single device")
+
+    merge_parser = subparsers.add_parser("merge", help="Find duplicates across manifests and write a plan")
+    merge_parser.add_argument("manifests", nargs="+", help="Manifests, in order of preference for the copy kept")
+    merge_parser.add_argument("-o", "--output", required=True, help="Plan file to write")
+    merge_parser.add_argument("--cross-node", action="store_true",
+                              help="Only print duplicates that are on more than one node")
+
+    args = parser.parse_args()
+
+    if args.command == "scan":
+        if not os.path.exists(args.dir):
+            print("Error: Path does not exist: %s" % args.dir)
+            sys.exit(1)
+        with HashService(args.hash_workers, args.device_limit) as service:
+            if args.catalog:
+                with Catalog(args.catalog) as catalog:
+                    count = write_manifest(args.output, args.dir, catalog.iter_entries(os.path.abspath(args.dir)),
+                                           args.node, service)
+            else:
+                count = write_manifest(args.output, args.dir, load_tree(args.dir), args.node, service)
+        print("Wrote %d entries to %s" % (count, args.output))
+        return
+
+    def print_duplicates(copies):
+        if args.cross_node and len({node for node, _ in copies}) == 1:
+            return
+        print()
+        print("Duplcates:")
+        for node, entry in copies:
+            print("%s:%s" % (node, entry.path()))
+
+    manifests = []
+    try:
+        for path in args.manifests:
+            manifests.append(Manifest(path))
+        placed, skipped = write_plan(args.output, manifests, print_duplicates)
+    except (OSError, ValueError) as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+    finally:
+        for m in manifests:
+            m.close()
+    print("Wrote a plan placing %d files and leaving out %d duplicates to %s" % (placed, skipped, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Index of the files and folders below a deduplicate target.
+
+Placing a photo used to cost an os.path.exists() for its folder, possibly an
+os.makedirs(), and an os.path.exists() for the file itself. On an NFS-mounted
+target each of those is a network round trip. TargetIndex lists the target
+once up front, or loads a manifest saved by a previous run, and answers those
+questions locally, recording every file and folder as it is placed.
+
+The paths are kept in a throwaway SQLite database in the local temp folder
+(or `tmp_dir`), not in memory, so a target of any size costs the same memory.
+
+A manifest is trusted as it is, so it should only be used for a target that
+nothing else writes to. Destinations are still created with O_EXCL, so a stale
+manifest can never cause a file to be overwritten.
+"""
+
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+
+SCAN_BATCH = 1024
+
+
+class TargetIndex:
+    """
+    The relative paths of every file and folder below root.
+
+    Files are added and discarded from the transfer workers' callbacks, so
+    every method is thread-safe. Call close() to remove the database.
+    """
+
+    def __init__(self, root, files=(), dirs=(), tmp_dir=None):
+        self.root = root
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="exif-target-", dir=tmp_dir)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self._tmpdir.name, "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE files (path BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE dirs (path BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._insert("files", files)
+        self._insert("dirs", itertools.chain([""], dirs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+        self._tmpdir.cleanup()
+
+    def _insert(self, table, paths):
+        # paths are stored as bytes, which also holds names that aren't valid UTF-8
+        rows = ((os.fsencode(path),) for path in paths)
+        with self._lock:
+            self.db.executemany("INSERT OR IGNORE INTO %s VALUES (?)" % table, rows)
+
+    def _flush(self, files, dirs):
+        """Insert the listed files and dirs, and empty both lists"""
+        self._insert("files", files)
+        self._insert("dirs", dirs)
+        del files[:], dirs[:]
+
+    def _has(self, table, rel):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM %s WHERE path = ?" % table,
+                                   (os.fsencode(rel),)).fetchone() is not None
+
+    def _paths(self, table):
+        with self._lock:
+            cursor = self.db.execute("SELECT path FROM %s ORDER BY path" % table)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(SCAN_BATCH)
+            if not rows:
+                return
+            for path, in rows:
+                yield os.fsdecode(path)
+
+    @classmethod
+    def scan(cls, root, tmp_dir=None):
+        """List everything below root with one os.scandir() per folder"""
+        index = cls(root, tmp_dir=tmp_dir)
+        stack = [""]
+        files = []
+        dirs = []
+        while stack:
+            rel = stack.pop()
+            try:
+                with os.scandir(os.path.join(root, rel)) as it:
+                    for entry in it:
+                        path = os.path.join(rel, entry.name)
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            dirs.append(path)
+                            stack.append(path)
+                        else:
+                            files.append(path)
+            except OSError:
+                continue
+            if len(files) + len(dirs) >= SCAN_BATCH:
+                index._flush(files, dirs)
+        index._flush(files, dirs)
+        return index
+
+    @classmethod
+    def load(cls, root, manifest_path, tmp_dir=None):
+        """Load a manifest written by save(), or scan root if there is none"""
+        try:
+            fp = open(manifest_path, errors="surrogateescape")
+        except FileNotFoundError:
+            return cls.scan(root, tmp_dir)
+
+        index = cls(root, tmp_dir=tmp_dir)
+        files = []
+        dirs = []
+        with fp:
+            for line in fp:
+                path = line.rstrip("\n")
+                if path.endswith("/"):
+                    dirs.append(path[:-1])
+                elif path:
+                    files.append(path)
+                if len(files) + len(dirs) >= SCAN_BATCH:
+                    index._flush(files, dirs)
+        index._flush(files, dirs)
+        return index
+
+    def save(self, manifest_path):
+        """Write the manifest, one relative path per line and folders ending in /"""
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", errors="surrogateescape") as fp:
+            for path in self._paths("dirs"):
+                if path:
+                    fp.write(path + "/\n")
+            for path in self._paths("files"):
+                fp.write(path + "\n")
+        os.replace(tmp_path, manifest_path)
+
+    def files(self):
+        """The relative paths of the files, sorted"""
+        return list(self._paths("files"))
+
+    def dirs(self):
+        """The relative paths of the folders, sorted, starting with "" for root"""
+        return list(self._paths("dirs"))
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def exists(self, path):
+        """Whether a file or folder is at path, which must be below root"""
+        rel = self._relative(path)
+        return rel == "." or self._has("files", rel) or self._has("dirs", rel)
+
+    def makedirs(self, path):
+        """os.makedirs(path), skipped when the index already has the folder"""
+        rel = self._relative(path)
+        if rel == "." or self._has("dirs", rel):
+            return
+        os.makedirs(path, exist_ok=True)
+        parents = []
+        while rel and not self._has("dirs", rel):
+            parents.append(rel)
+            rel = os.path.dirname(rel)
+        self._insert("dirs", parents)
+
+    def add(self, path):
+        """Record a file placed at path"""
+        self._insert("files", [self._relative(path)])
+
+    def discard(self, path):
+        """Forget a file, e.g. after a failed copy removed it again"""
+        with self._lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (os.fsencode(self._relative(path)),))
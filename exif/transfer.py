@@ -0,0 +1,165 @@
+"""
+Parallel copy/move of files into the target tree.
+
+Each transfer creates its destination with O_EXCL, so "already exists" is
+answered by the same syscall that starts the copy instead of a separate
+os.path.exists() round trip. The available strategies are:
+
+copy      copy_file_range(), which lets the kernel (or an NFS/SMB server) copy
+          without passing the data through user space, falling back to a
+          plain read/write loop where it isn't supported
+reflink   FICLONE, sharing the source's extents on btrfs/XFS, falling back to copy
+hardlink  a second name for the source on the same filesystem, falling back to copy
+move      link and unlink the source, falling back to copy and unlink across filesystems
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exif import metrics
+
+MODES = ("copy", "reflink", "hardlink", "move")
+DEFAULT_WORKERS = 4
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning "this strategy doesn't work here", as opposed to a real I/O error;
+# EMLINK is a source that already has as many hard links as the filesystem allows
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.ETXTBSY,
+               errno.EMLINK}
+
+
+def _copy_fd(src_fd, dst_fd, size):
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+
+    with open(src_fd, "rb", closefd=False) as src, open(dst_fd, "wb", closefd=False) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    return size
+
+
+def _copy(src, dst, reflink=False):
+    """Copy src to a new file dst, raising FileExistsError if dst exists"""
+    with open(src, "rb") as src_fp:
+        size = os.fstat(src_fp.fileno()).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            if reflink:
+                try:
+                    fcntl.ioctl(dst_fd, FICLONE, src_fp.fileno())
+                    return size
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED and e.errno != errno.ENOTTY:
+                        raise
+            return _copy_fd(src_fp.fileno(), dst_fd, size)
+        except BaseException:
+            os.unlink(dst)
+            raise
+        finally:
+            os.close(dst_fd)
+
+
+def transfer_file(src, dst, mode="copy"):
+    """
+    Place src at dst using the given strategy, returning the number of bytes.
+
+    Raises FileExistsError, without touching either file, if dst already exists.
+    """
+    with metrics.phase("transfer"):
+        size = _transfer(src, dst, mode)
+    metrics.count("files_written")
+    metrics.count("bytes_written", size)
+    return size
+
+
+def _transfer(src, dst, mode):
+    if mode == "reflink":
+        return _copy(src, dst, reflink=True)
+
+    if mode in ("hardlink", "move"):
+        size = os.stat(src).st_size
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            _copy(src, dst)
+        if mode == "move":
+            os.unlink(src)
+        return size
+
+    return _copy(src, dst)
+
+
+class Transferrer:
+    """
+    A pool of workers running transfer_file().
+
+    submit() blocks once a few transfers per worker are queued, so a fast scan
+    can't pile up an unbounded backlog. Counters of the files and bytes placed
+    so far feed report().
+    """
+
+    def __init__(self, mode="copy", workers=DEFAULT_WORKERS):
+        if mode not in MODES:
+            raise ValueError("Unknown transfer mode %s" % mode)
+        self.mode = mode
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers * 4)
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _run(self, src, dst, before):
+        if before is not None:
+            before()
+        size = transfer_file(src, dst, self.mode)
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        return size
+
+    def submit(self, src, dst, before=None):
+        """
+        Schedule a transfer; the Future's result is the number of bytes placed.
+
+        `before`, if given, is called on the worker just before the transfer starts.
+        """
+        self._slots.acquire()
+        future = self._executor.submit(self._run, src, dst, before)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return "Transferred %d files, %.1f MB in %.1fs (%.1f MB/s, mode %s)" % (
+            self.files, self.bytes / 1e6, elapsed, self.bytes / 1e6 / elapsed, self.mode)
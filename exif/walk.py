@@ -0,0 +1,76 @@
+"""
+Directory walker shared by scan, find_duplicates and deduplicate.
+
+Unlike filtering the output of os.walk, ignored folders (those containing an
+.exif_ignore file) and thumbnail/preview caches are pruned before they are
+listed, so nothing below them is ever read.
+"""
+
+import os
+
+import exif
+from exif import metrics
+
+PRUNED_WORDS = ("thumb", "preview")
+
+
+def is_pruned(name):
+    """Thumbnail and preview folders only hold copies of photos found elsewhere"""
+    name = name.lower()
+    return any(word in name for word in PRUNED_WORDS)
+
+
+def walk(top, visit=None):
+    """
+    Yield (dirpath, files) for top and every folder below it, top-down.
+
+    files is the list of os.DirEntry objects for everything in the folder that
+    is not a directory. DirEntry caches its stat() result, so callers should
+    use it instead of calling os.stat() again. Symlinked folders are not
+    followed, the same as os.walk().
+
+    `visit(dirpath)` is called before each folder is listed, ignored ones
+    included; if it returns False the folder is skipped.
+    """
+    if is_pruned(top):
+        return
+
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        if visit is not None and not visit(dirpath):
+            continue
+        try:
+            with metrics.phase("walk"), os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        metrics.count("dirs_walked")
+
+        files = []
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if not is_dir:
+                files.append(entry)
+            elif not entry.is_symlink() and not is_pruned(entry.name):
+                subdirs.append(entry.path)
+
+        if any(entry.name == exif.EXIF_IGNORE_NAME for entry in files):
+            # ignore this folder and everything below it
+            continue
+
+        yield dirpath, files
+        stack.extend(reversed(subdirs))
+
+
+def load_tree(root):
+    """Every entry in the .exif_data files below root"""
+    for dirpath, files in walk(root):
+        if any(f.name == exif.EXIF_FILE_NAME for f in files):
+            with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+                yield from exif.load_exif_file(fp, os.path.abspath(dirpath))
@@ -0,0 +1,213 @@
+"""
+Watching a library for changes, for collect_exif_data --watch.
+
+Watcher puts an inotify watch on every folder walk() visits, before it is
+listed so no file created in between is missed, and turns the events into
+batches of work. A batch is taken once events have stopped arriving for
+`settle` seconds, so a folder being imported is rescanned once rather than
+for every file copied into it, or after `max_wait` seconds when they keep
+arriving. A batch holds the folders to rescan, with their files listed the way
+walk() lists them, and the folders that are gone. Folders created or moved in
+are walked and watched as they appear. A folder holding an .exif_ignore stays
+watched without the folders below it, so it is walked once the file is
+removed. If the kernel's event queue overflows, every folder is listed again.
+
+Library keeps the entries of every folder and the paths of every ExifEntry
+key, so a new arrival can be matched against the whole library at once.
+"""
+
+import errno
+import os
+import time
+from collections import defaultdict
+
+import exif
+from exif import inotify
+from exif.walk import walk, is_pruned
+
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE
+              | inotify.IN_CREATE | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
+DEFAULT_SETTLE = 2.0
+DEFAULT_MAX_WAIT = 60.0
+
+
+def list_files(dirpath):
+    """The non-directory entries of dirpath like walk() yields them, or None if it is gone or ignored"""
+    try:
+        with os.scandir(dirpath) as it:
+            files = [entry for entry in it if not entry.is_dir()]
+    except OSError:
+        return None
+    if any(entry.name == exif.EXIF_IGNORE_NAME for entry in files):
+        return None
+    return files
+
+
+class Watcher:
+    """
+    Inotify watches over the folders below root.
+
+    `is_relevant(filename)` picks the files whose changes matter; changes to
+    anything else, such as the .exif_data files scanning writes, are ignored.
+    """
+
+    def __init__(self, root, is_relevant, settle=DEFAULT_SETTLE, max_wait=DEFAULT_MAX_WAIT):
+        self.root = root
+        self.is_relevant = is_relevant
+        self.settle = settle
+        self.max_wait = max_wait
+        self.notify = inotify.Inotify()
+        self.dirs = {}  # wd -> dirpath
+        self.wds = {}  # dirpath -> wd
+        self.ignored = set()  # watched folders walk() didn't yield, as they hold an .exif_ignore
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.notify.close()
+
+    def watch_tree(self, top):
+        """Watch top and the folders below it, yielding (dirpath, files) as walk() does"""
+        for dirpath, files in walk(top, self._watch):
+            self.ignored.discard(dirpath)
+            yield dirpath, files
+
+    def _watch(self, dirpath):
+        try:
+            wd = self.notify.add_watch(dirpath, WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise OSError(e.errno, "Out of inotify watches, raise fs.inotify.max_user_watches")
+            return False
+        self.dirs[wd] = dirpath
+        self.wds[dirpath] = wd
+        # until walk() yields it, which it doesn't if the folder is ignored
+        self.ignored.add(dirpath)
+        return True
+
+    def forget_tree(self, top, keep_top=False):
+        """Stop watching the folders below top, and top itself unless keep_top, returning their paths"""
+        prefix = top.rstrip(os.sep) + os.sep
+        gone = [d for d in self.wds if d == top or d.startswith(prefix)]
+        for dirpath in gone:
+            self.ignored.discard(dirpath)
+            if keep_top and dirpath == top:
+                continue
+            wd = self.wds.pop(dirpath)
+            del self.dirs[wd]
+            self.notify.rm_watch(wd)
+        return gone
+
+    def batches(self):
+        """Yield (changed, removed) forever: {dirpath: files} to rescan and the dirpaths that are gone"""
+        while True:
+            dirty, created, gone = set(), set(), set()
+            overflow = False
+            events = self.notify.read()
+            deadline = time.monotonic() + self.max_wait
+            while events:
+                for event in events:
+                    overflow |= self._classify(event, dirty, created, gone)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = self.notify.read(min(self.settle, remaining))
+
+            removed = []
+            for dirpath in gone:
+                removed.extend(self.forget_tree(dirpath))
+
+            changed = {}
+            if overflow:
+                created = {self.root}
+                dirty = set(self.wds)
+            for top in created:
+                changed.update(self.watch_tree(top))
+            for dirpath in dirty:
+                if dirpath in changed or dirpath not in self.wds:
+                    continue
+                files = list_files(dirpath)
+                if dirpath in self.ignored:
+                    if files is not None:
+                        # its .exif_ignore was removed
+                        changed.update(self.watch_tree(dirpath))
+                elif files is None:
+                    # ignored from now on, or gone, which the folder's own event then reports
+                    removed.extend(self.forget_tree(dirpath, keep_top=True))
+                    self.ignored.add(dirpath)
+                else:
+                    changed[dirpath] = files
+
+            if changed or removed:
+                yield changed, removed
+
+    def _classify(self, event, dirty, created, gone):
+        """Sort one event into the sets of folders to rescan, walk or forget; True on queue overflow"""
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            return True
+        dirpath = self.dirs.get(event.wd)
+        if dirpath is None:
+            return False
+
+        if event.mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED):
+            gone.add(dirpath)
+        elif event.mask & inotify.IN_ISDIR:
+            path = os.path.join(dirpath, event.name)
+            if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                if not is_pruned(event.name):
+                    created.add(path)
+            else:
+                gone.add(path)
+        elif self.is_relevant(event.name):
+            dirty.add(dirpath)
+        return False
+
+
+class Library:
+    """The entries of every folder, and the paths holding each ExifEntry key"""
+
+    def __init__(self):
+        self.dirs = {}
+        self.keys = defaultdict(set)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.dirs.values())
+
+    def update(self, dirpath, entries):
+        """Replace the entries of dirpath, returning those that are new or changed"""
+        old = self.dirs.pop(dirpath, {})
+        for entry in old.values():
+            self._discard(entry)
+
+        new = {e.filename: e for e in entries}
+        self.dirs[dirpath] = new
+        added = []
+        for entry in new.values():
+            if isinstance(entry, exif.ExifEntry):
+                self.keys[entry.uniq_str()].add(entry.path())
+            previous = old.get(entry.filename)
+            if previous is None or previous.as_dict() != entry.as_dict():
+                added.append(entry)
+        return added
+
+    def forget(self, dirpath):
+        for entry in self.dirs.pop(dirpath, {}).values():
+            self._discard(entry)
+
+    def _discard(self, entry):
+        if isinstance(entry, exif.ExifEntry):
+            paths = self.keys.get(entry.uniq_str())
+            if paths is not None:
+                paths.discard(entry.path())
+                if not paths:
+                    del self.keys[entry.uniq_str()]
+
+    def duplicates_of(self, entry):
+        """The other paths in the library with the same key as entry"""
+        if not isinstance(entry, exif.ExifEntry):
+            return []
+        return sorted(self.keys.get(entry.uniq_str(), set()) - {entry.path()})
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for exiftool, used by the tests.
+
+A file whose first line is a JSON object is treated as an image and the keys of
+that object are reported as its tags. Only the subset of the exiftool command
+line used by this repo is understood: -j, -n, -ext, -TAG filters, -fast/-fast2,
+-echoN and -stay_open batch mode.
+"""
+
+import json
+import os
+import sys
+
+KNOWN_TYPES = {"nef", "jpg", "jpeg", "heic", "heif", "mov", "mp4", "png", "tif", "tiff", "dng", "cr2"}
+NO_VALUE_OPTIONS = {"-j", "-json", "-n", "-fast", "-fast2", "-q", "-r"}
+
+
+def format_file_size(size):
+    """Same formatting as exiftool's ConvertFileSize with SI units"""
+    if size < 2000:
+        return "%d bytes" % size
+    if size < 10000:
+        return "%.1f kB" % (size / 1000)
+    if size < 2000000:
+        return "%.0f kB" % (size / 1000)
+    if size < 10000000:
+        return "%.1f MB" % (size / 1000000)
+    if size < 2000000000:
+        return "%.0f MB" % (size / 1000000)
+    if size < 10000000000:
+        return "%.1f GB" % (size / 1000000000)
+    return "%.0f GB" % (size / 1000000000)
+
+
+def read_tags(path):
+    with open(path, "rb") as fp:
+        first_line = fp.readline(65536)
+    if not first_line.startswith(b"{"):
+        return {}
+    try:
+        tags = json.loads(first_line)
+    except ValueError:
+        return {}
+    return tags if isinstance(tags, dict) else {}
+
+
+def describe(path, numeric):
+    size = os.path.getsize(path)
+    record = {
+        "SourceFile": path,
+        "FileName": os.path.basename(path),
+        "Directory": os.path.dirname(path) or ".",
+        "FileSize": size if numeric else format_file_size(size),
+    }
+    record.update(read_tags(path))
+    return record
+
+
+def run(args):
+    """Execute one command line, returning (stdout, stderr) text"""
+    numeric = False
+    exts = set()
+    tags = []
+    echo_after = []
+    paths = []
+
+    it = iter(args)
+    for arg in it:
+        if arg in NO_VALUE_OPTIONS:
+            numeric = numeric or arg == "-n"
+        elif arg == "-ext":
+            exts.add(next(it).lower().lstrip("."))
+        elif arg.startswith("-echo"):
+            text = next(it)
+            if arg in ("-echo3", "-echo4"):
+                echo_after.append((arg, text))
+        elif arg.startswith("-"):
+            tags.append(arg[1:])
+        else:
+            paths.append(arg)
+
+    records = []
+    errors = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                full = os.path.join(path, name)
+                ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+                if not os.path.isfile(full) or ext not in (exts or KNOWN_TYPES):
+                    continue
+                records.append(describe(full, numeric))
+        elif os.path.isfile(path):
+            records.append(describe(path, numeric))
+        else:
+            errors.append("Error: File not found - %s" % path)
+
+    if tags:
+        wanted = {t.lower() for t in tags}
+        records = [{k: v for k, v in r.items() if k == "SourceFile" or k.lower() in wanted} for r in records]
+
+    out = json.dumps(records, indent=2) + "\n" if records else ""
+    err = "".join(e + "\n" for e in errors)
+    if not records and not errors:
+        err += "No matching files\n"
+
+    for option, text in echo_after:
+        if option == "-echo3":
+            out += text + "\n"
+        else:
+            err += text + "\n"
+    return out, err
+
+
+def stay_open():
+    args = []
+    for line in sys.stdin:
+        arg = line.rstrip("\n")
+        if arg == "-stay_open":
+            continue
+        if arg == "False":
+            break
+        if arg.startswith("-execute"):
+            out, err = run(args)
+            args = []
+            sys.stdout.write(out + "{ready%s}\n" % arg[len("-execute"):])
+            sys.stdout.flush()
+            sys.stderr.write(err)
+            sys.stderr.flush()
+        else:
+            args.append(arg)
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:4] == ["-stay_open", "True", "-@", "-"]:
+        stay_open()
+        return
+
+    out, err = run(args)
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    sys.exit(1 if "Error" in err else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,41 @@ import os
 import sys
 import json
 import exif
+from exif import cascade, folders, metrics, phash
+from exif.catalog import Catalog
+from exif.grouping import make_grouper, STORES, DEFAULT_MEMORY_BUDGET
+from exif.hashing import HashService, DEFAULT_WORKERS, DEFAULT_DEVICE_LIMIT
+from exif.walk import walk
 from collections import defaultdict
 
 
 def load_exif_files(dirname):
-    for dirpath, _, filenames in os.walk(dirname):
-        if exif.EXIF_FILE_NAME in filenames:
+    for dirpath, files in walk(dirname):
+        if any(f.name == exif.EXIF_FILE_NAME for f in files):
             with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
-                  for e in exif.load_exif_file(fp):
+                  for e in exif.load_exif_file(fp, dirpath):
                       yield e, os.path.join(dirpath, e.filename)
 
 
-def raw_dupe(exif, paths):
+def load_catalog(catalog_path, dirname):
+    with Catalog(catalog_path) as catalog:
+        for e in catalog.iter_entries(dirname):
+            yield e, e.path()
+
+
+def is_cache(path):
+    return "thumb" in path.lower() or "preview" in path.lower()
+
+
+def catalog_duplicates(catalog, dirname):
+    """The paths of each group of photos with the same key, queried through the catalog's key index"""
+    for group in catalog.duplicate_groups(dirname):
+        paths = [e.path() for e in group if not is_cache(e.path())]
+        if len(paths) > 1:
+            yield paths
+
+
+def raw_dupe(paths):
     if len(paths) != 2:
         return False
 
@@ -25,60 +48,135 @@ def raw_dupe(exif, paths):
     return paths[0][:-3] == paths[1][:-3] and {paths[0][-3:].lower(), paths[1][-3:].lower()} == img_exts
 
 
+def report(args):
+    """Print the duplicates, similar images and related folders below args.dir"""
+    if args.store == "external":
+        # both sort as entries are loaded, so each gets half the budget
+        budget = args.memory_budget * 1024 * 1024 // 2
+        photo_groups = make_grouper(args.store, budget, args.spill_dir)
+        folder_dict = folders.ExternalFolders(budget, args.spill_dir)
+    else:
+        photo_groups = make_grouper(args.store)
+        folder_dict = defaultdict(set)
+    noexif_files = []
+    # for --perceptual: the images of every folder, and the key each one is matched on exactly
+    folder_images = defaultdict(list)
+    exact_keys = {}
+
+    entries = load_catalog(args.catalog, args.dir) if args.catalog else load_exif_files(args.dir)
+    for e, path in metrics.timed_iter("load", entries):
+        if is_cache(path):
+            continue
+
+        folder = folder_dict[os.path.dirname(path)]
+        if args.perceptual:
+            folder_images[os.path.dirname(path)].append(os.path.basename(path))
+        if isinstance(e, exif.NoExifFile):
+            # grouped below without hashing files that can't have a duplicate
+            noexif_files.append(e)
+            continue
+
+        if not args.catalog:
+            photo_groups.add(e, path)
+        folder.add(("exif", e.uniq_str()))
+        if args.perceptual:
+            exact_keys[path] = ("exif", e.uniq_str())
+
+    with HashService(args.hash_workers, args.device_limit) as service:
+        noexif_groups = cascade.duplicate_groups(noexif_files, service=service)
+
+        hashed_images = []
+        for dirpath, filenames in folder_images.items():
+            for name, value in phash.folder_hashes(dirpath, filenames, service).items():
+                if value is not None:
+                    hashed_images.append((os.path.join(dirpath, name), value))
+    if args.catalog:
+        with Catalog(args.catalog) as catalog:
+            catalog.update_hashes(noexif_files)
+            photo_duplicates = list(catalog_duplicates(catalog, args.dir))
+    else:
+        photo_duplicates = photo_groups.duplicate_groups()
+    duplicate_ids = {id(f) for group in noexif_groups for f in group}
+    for f in noexif_files:
+        key = ("noexif", f.file_hash) if id(f) in duplicate_ids else ("file", f.path())
+        folder_dict[os.path.dirname(f.path())].add(key)
+        if args.perceptual:
+            exact_keys[f.path()] = key
+
+    for v in photo_duplicates:
+        if args.ignore_raw_dupes and raw_dupe(v):
+            continue
+
+        print()
+        print("Duplcates:")
+        for i in v:
+            print(i)
+
+    for group in noexif_groups:
+        print()
+        print("Duplcates:")
+        for f in group:
+            print(f.path())
+
+    for group in phash.clusters(hashed_images, args.phash_distance):
+        # copies that are all exact duplicates of each other were reported above
+        if len({exact_keys.get(path, path) for path in group}) == 1:
+            continue
+
+        print()
+        print("Similar images:")
+        for path in group:
+            print(path)
+
+    if args.store == "external":
+        relations = folder_dict.relations(args.similar)
+    else:
+        relations = folders.folder_relations(folder_dict, args.similar)
+    for relation, path1, path2, similarity in metrics.timed_iter("folders", relations):
+        if relation == folders.SAME:
+            print("These two folders are the same:")
+        elif relation == folders.SUBSET:
+            print("All the files in 1 are also in 2")
+        else:
+            print("These two folders are %.0f%% the same:" % (similarity * 100))
+        print(path1)
+        print(path2)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("dir", help="Root folder to scan")
     parser.add_argument("-i", "--ignore-raw-dupes", action="store_true", help="Ignore raw NEF files that look like duplicates next to their corresponding JPEG")
+    parser.add_argument("-c", "--catalog", help="Read entries from this catalog database instead of walking the folder, "
+                                                "and find duplicate photos through its key index")
+    parser.add_argument("--hash-workers", type=int, default=DEFAULT_WORKERS, help="Number of files to hash in parallel")
+    parser.add_argument("--device-limit", type=int, default=DEFAULT_DEVICE_LIMIT, help="Number of files to read at once from a single device")
+    parser.add_argument("--similar", type=float, metavar="THRESHOLD",
+                        help="Also report folders whose contents overlap by at least this fraction (0-1)")
+    parser.add_argument("-p", "--perceptual", action="store_true",
+                        help="Also report resized or re-encoded copies of images, by perceptual hash (needs numpy and Pillow)")
+    parser.add_argument("--phash-distance", type=int, default=phash.DEFAULT_MAX_DISTANCE,
+                        help="Number of differing bits, out of 64, up to which images count as copies")
+    parser.add_argument("--store", choices=STORES, default="dict",
+                        help="How to group photos: dict of entries, columnar packed keys for very large libraries, "
+                             "or external, sorting on disk for libraries larger than memory")
+    parser.add_argument("--memory-budget", type=int, metavar="MB", default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        help="Memory the external store sorts photo keys and folder keys in before spilling "
+                             "runs to disk")
+    parser.add_argument("--spill-dir", help="Folder for the external store's runs (default: the temp folder)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     if not os.path.exists(args.dir):
         print("Error: Path does not exist: %s" % args.dir)
         sys.exit(1)
 
-    photo_dict = defaultdict(list)
-    folder_dict = defaultdict(set)
-
-    for e, path in load_exif_files(args.dir):
-        if "thumb" in path.lower() or "preview" in path.lower():
-            continue
-
-        photo_dict[e].append(path)
-        folder_dict[os.path.dirname(path)].add(e)
-
-    for k, v in photo_dict.items():
-        if args.ignore_raw_dupes and raw_dupe(k, v):
-            continue
+    if args.perceptual and not phash.available():
+        print("Error: --perceptual needs numpy and Pillow")
+        sys.exit(1)
 
-        if len(v) > 1:
-            print()
-            print("Duplcates:")
-            for i in v:
-                print(i)
-
-    for i, t in enumerate(folder_dict.items()):
-        path, images = t
-        path_keys = list(folder_dict.keys())
-        for k in range(i+1, len(path_keys)):
-            path1, set1 = path, images
-            path2, set2 = path_keys[k], folder_dict[path_keys[k]]
-
-            if set1 == set2:
-                print("These two folders are the same:")
-                print(path1)
-                print(path2)
-                continue
-
-            if (set1 - set2) == set():
-                print("All the files in 1 are also in 2")
-                print(path1)
-                print(path2)
-                continue
-
-            if (set2 - set1) == set():
-                print("All the files in 1 are also in 2")
-                print(path2)
-                print(path1)
-                continue
+    with metrics.reporting(args):
+        report(args)
 
 
 if __name__ == "__main__":
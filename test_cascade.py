@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import pytest
+import hashlib
+import os
+import tempfile
+import exif
+from exif import cascade
+
+
+@pytest.fixture
+def files():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        def make(name, content):
+            with open(os.path.join(temp_dir, name), "wb") as fp:
+                fp.write(content)
+            return exif.from_exif_entry({"FileName": name, "FileSize": "%d bytes" % len(content)}, temp_dir)
+        yield make
+
+
+class TestDeferredHash:
+    """Test that NoExifFile hashes are only calculated when needed"""
+
+    def test_from_exif_entry_defers_hash(self, files):
+        """from_exif_entry no longer reads the file"""
+        f = files("video.mov", b"content")
+        assert not f.has_hash()
+        assert "deferred" in str(f)
+        assert "FileHash" not in f.as_dict()
+
+    def test_hash_calculated_on_access(self, files):
+        """Accessing file_hash hashes the full file once"""
+        f = files("video.mov", b"content")
+        assert f.file_hash == hashlib.sha256(b"content").hexdigest()
+        assert f.has_hash()
+        assert f.as_dict()["FileHash"] == f.file_hash
+
+    def test_known_hash_is_kept(self):
+        """A FileHash from .exif_data is used as is"""
+        f = exif.from_exif_entry({"FileName": "missing.mov", "FileHash": "abc123"}, "/nonexistent")
+        assert f.has_hash()
+        assert f.file_hash == "abc123"
+
+
+class TestDuplicateGroups:
+    """Test the size, partial hash, full hash cascade"""
+
+    def test_unique_sizes_are_not_read(self, files):
+        """Files with a size no other file has are never hashed"""
+        a = files("a.mov", b"a" * 10)
+        b = files("b.mov", b"b" * 20)
+
+        assert cascade.duplicate_groups([a, b]) == []
+        assert not a.has_hash()
+        assert not b.has_hash()
+
+    def test_identical_files_are_grouped(self, files):
+        """Files with the same content end up in one group with full hashes"""
+        a = files("a.mov", b"x" * 100)
+        b = files("b.mov", b"y" * 100)
+        c = files("c.mov", b"x" * 100)
+        d = files("d.mov", b"z" * 50)
+
+        groups = cascade.duplicate_groups([a, b, c, d])
+
+        assert groups == [[a, c]]
+        assert a.file_hash == hashlib.sha256(b"x" * 100).hexdigest()
+        assert not d.has_hash()
+
+    def test_partial_hash_mismatch_skips_full_hash(self, files):
+        """Large files that differ at the start are not hashed in full"""
+        a = files("a.mov", b"a" + b"0" * 99)
+        b = files("b.mov", b"b" + b"0" * 99)
+
+        assert cascade.duplicate_groups([a, b], edge=10) == []
+        assert not a.has_hash()
+        assert not b.has_hash()
+
+    def test_full_hash_separates_middle_differences(self, files):
+        """Large files that only differ in the middle are told apart by the full hash"""
+        a = files("a.mov", b"0" * 50 + b"a" + b"0" * 49)
+        b = files("b.mov", b"0" * 50 + b"b" + b"0" * 49)
+        c = files("c.mov", b"0" * 50 + b"a" + b"0" * 49)
+
+        assert cascade.duplicate_groups([a, b, c], edge=10) == [[a, c]]
+        assert a.has_hash() and b.has_hash()
+
+    def test_groups_in_order_of_first_appearance(self, files):
+        """Groups are returned in the order their first member was given"""
+        a = files("a.mov", b"y" * 20)
+        b = files("b.mov", b"x" * 10)
+        c = files("c.mov", b"x" * 10)
+        d = files("d.mov", b"y" * 20)
+
+        assert cascade.duplicate_groups([a, b, c, d]) == [[a, d], [b, c]]
+
+    def test_partial_hash_of_small_file_is_full_hash(self, files):
+        """Files no larger than twice the edge are read whole"""
+        f = files("a.mov", b"small file")
+        digest = cascade.partial_file_hash(f.path(), len(b"small file"))
+        assert digest == exif.calculate_file_hash(f.path())
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
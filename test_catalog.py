@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import pytest
+import json
+import os
+import tempfile
+import exif
+from exif.catalog import Catalog
+
+
+def write_exif_data(dirpath, records):
+    os.makedirs(dirpath, exist_ok=True)
+    with open(os.path.join(dirpath, exif.EXIF_FILE_NAME), "w") as fp:
+        for r in records:
+            fp.write(json.dumps(r) + "\n")
+
+
+def photo(name, timestamp, make="Apple"):
+    return {"FileName": name, "DateTimeOriginal": timestamp, "ShutterCount": "None", "SerialNumber": "None",
+            "Make": make, "FileSize": "2.0 MB", "ImageSize": "4032x3024"}
+
+
+@pytest.fixture
+def library():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_exif_data(os.path.join(temp_dir, "a"), [
+            photo("IMG_1.jpg", "2023:01:01 12:00:00"),
+            photo("IMG_2.jpg", "2023:01:01 12:00:01"),
+            {"FileName": "clip.mov", "FileHash": "ab" * 32, "FileSize": "10 MB"},
+        ])
+        write_exif_data(os.path.join(temp_dir, "b"), [
+            photo("copy.jpg", "2023:01:01 12:00:00"),
+            {"FileName": "clip.mov", "FileHash": "ab" * 32, "FileSize": "10 MB"},
+            {"FileName": "other.mov", "FileSize": "1 MB"},
+        ])
+        write_exif_data(os.path.join(temp_dir, "ab"), [
+            photo("IMG_2.jpg", "2023:01:01 12:00:01"),
+        ])
+        yield temp_dir
+
+
+@pytest.fixture
+def catalog(library):
+    with Catalog(os.path.join(library, "catalog.db")) as catalog:
+        catalog.import_tree(library)
+        yield catalog
+
+
+class TestCatalog:
+    """Test the SQLite catalog of entries"""
+
+    def test_import_tree(self, library, catalog):
+        """Every .exif_data entry ends up in the catalog"""
+        entries = list(catalog.iter_entries())
+        assert len(entries) == 7
+        assert sum(isinstance(e, exif.ExifEntry) for e in entries) == 4
+        assert all(os.path.isabs(e.dirpath) for e in entries)
+
+    def test_iter_entries_subtree(self, library, catalog):
+        """iter_entries(root) only returns entries at or below root, not siblings sharing a prefix"""
+        entries = list(catalog.iter_entries(os.path.join(library, "a")))
+        assert {e.filename for e in entries} == {"IMG_1.jpg", "IMG_2.jpg", "clip.mov"}
+
+    def test_deferred_hash_is_null(self, library, catalog):
+        """A NoExifFile without a known hash stays deferred"""
+        other = [e for e in catalog.iter_entries() if e.filename == "other.mov"][0]
+        assert not other.has_hash()
+
+    def test_duplicate_groups(self, library, catalog):
+        """Entries with the same key are grouped by the index"""
+        groups = [sorted(e.path() for e in g) for g in catalog.duplicate_groups()]
+        assert sorted(groups) == sorted([
+            [os.path.join(library, "a", "IMG_1.jpg"), os.path.join(library, "b", "copy.jpg")],
+            [os.path.join(library, "a", "IMG_2.jpg"), os.path.join(library, "ab", "IMG_2.jpg")],
+        ])
+
+    def test_duplicate_groups_order(self, library, catalog):
+        """Groups come in the order the grouping stores give them"""
+        from exif.grouping import DictGrouper
+        grouper = DictGrouper()
+        for e in catalog.iter_entries():
+            if isinstance(e, exif.ExifEntry):
+                grouper.add(e, e.path())
+        assert [[e.path() for e in g] for g in catalog.duplicate_groups()] == list(grouper.duplicate_groups())
+
+    def test_find_duplicates_from_catalog(self, library, catalog, monkeypatch, capsys):
+        """find_duplicates --catalog, which groups photos in SQL, reports what a walk reports"""
+        import sys
+        import find_duplicates
+        for dirname, name, content in [("a", "clip.mov", b"clip"), ("b", "clip.mov", b"clip"), ("b", "other.mov", b"other")]:
+            with open(os.path.join(library, dirname, name), "wb") as fp:
+                fp.write(content)
+        catalog.db.commit()
+        monkeypatch.setattr(sys, "argv", ["find_duplicates.py", library])
+        find_duplicates.main()
+        walked = capsys.readouterr().out
+
+        monkeypatch.setattr(sys, "argv", ["find_duplicates.py", "--catalog", catalog.path, library])
+        find_duplicates.main()
+        from_catalog = capsys.readouterr().out
+
+        # a walk lists folders in directory order, the catalog sorted by path
+        def blocks(out):
+            return sorted(sorted(block.strip().split("\n")) for block in out.split("\n\n") if block.strip())
+        assert blocks(from_catalog) == blocks(walked)
+        assert walked.count("Duplcates:") == 3
+
+    def test_duplicate_groups_subtree(self, library, catalog):
+        """Duplicates outside root are not reported"""
+        groups = list(catalog.duplicate_groups(os.path.join(library, "a")))
+        assert groups == []
+
+    def test_hash_groups(self, library, catalog):
+        """NoExifFiles with the same hash are grouped"""
+        groups = list(catalog.hash_groups())
+        assert len(groups) == 1
+        assert {f.dirpath for f in groups[0]} == {os.path.join(library, "a"), os.path.join(library, "b")}
+
+    def test_replace_dir(self, library, catalog):
+        """replace_dir drops the previous rows of a directory"""
+        dirpath = os.path.join(library, "b")
+        catalog.replace_dir(dirpath, [exif.ExifEntry(filename="new.jpg", dirpath=dirpath, timestamp="2024:01:01 00:00:00")])
+        assert [e.filename for e in catalog.iter_entries(dirpath)] == ["new.jpg"]
+
+    def test_update_hashes(self, library, catalog):
+        """Hashes calculated later are written back"""
+        other = [e for e in catalog.iter_entries() if e.filename == "other.mov"][0]
+        other.file_hash = "cd" * 32
+        catalog.update_hashes([other])
+        other = [e for e in catalog.iter_entries() if e.filename == "other.mov"][0]
+        assert other.file_hash == "cd" * 32
+
+    def test_export_round_trip(self, library, catalog):
+        """Exported .exif_data files load back to the same entries"""
+        dirpath = os.path.join(library, "a")
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+            before = [e.as_dict() for e in exif.load_exif_file(fp, os.path.abspath(dirpath))]
+        os.unlink(os.path.join(dirpath, exif.EXIF_FILE_NAME))
+
+        assert catalog.export_tree(dirpath) == 1
+
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+            after = [e.as_dict() for e in exif.load_exif_file(fp, os.path.abspath(dirpath))]
+        assert after == before
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import json
+import tempfile
+import collect_exif_data
+import exif
+from exif import exiftool
+
+
+@pytest.fixture
+def library(write_photo):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(12):
+            dirpath = os.path.join(temp_dir, "event%02d" % i)
+            os.makedirs(dirpath)
+            for j in range(3):
+                write_photo(dirpath, "IMG_%d.jpg" % j, {"DateTimeOriginal": "2023:01:%02d 12:00:%02d" % (i + 1, j), "Make": "Apple"})
+
+        ignored = os.path.join(temp_dir, "event03", "ignored")
+        os.makedirs(os.path.join(ignored, "child"))
+        open(os.path.join(ignored, exif.EXIF_IGNORE_NAME), "w").close()
+        write_photo(ignored, "skip.jpg", {"DateTimeOriginal": "2023:02:01 12:00:00"})
+        write_photo(os.path.join(ignored, "child"), "skip.jpg", {"DateTimeOriginal": "2023:02:01 12:00:00"})
+        yield temp_dir
+
+
+class TestParallelScan:
+    """Test scanning directories on a thread pool"""
+
+    def test_output_matches_serial_scan(self, library, fake_pool, capsys):
+        """--jobs prints exactly what a serial scan prints, in the same order"""
+        collect_exif_data.scan(library, strict=True, jobs=1)
+        serial = capsys.readouterr().out
+
+        for dirpath, _, filenames in os.walk(library):
+            if exif.EXIF_FILE_NAME in filenames:
+                os.unlink(os.path.join(dirpath, exif.EXIF_FILE_NAME))
+
+        collect_exif_data.scan(library, strict=True, jobs=4)
+        parallel = capsys.readouterr().out
+
+        assert parallel == serial
+        assert "Exif count: 36" in parallel
+
+    def test_writes_each_exif_file(self, library, fake_pool):
+        """Every scanned directory gets its .exif_data, ignored trees get none"""
+        collect_exif_data.scan(library, strict=False, jobs=4)
+
+        for i in range(12):
+            exif_file = os.path.join(library, "event%02d" % i, exif.EXIF_FILE_NAME)
+            with open(exif_file) as fp:
+                assert len(fp.readlines()) == 3
+
+        ignored = os.path.join(library, "event03", "ignored")
+        assert not os.path.exists(os.path.join(ignored, exif.EXIF_FILE_NAME))
+        assert not os.path.exists(os.path.join(ignored, "child", exif.EXIF_FILE_NAME))
+
+    def test_scan_dirs_preserves_order(self, library, fake_pool):
+        """scan_dirs yields directories in the order they were given"""
+        dirs = [(os.path.join(library, d), list(os.scandir(os.path.join(library, d))))
+                for d in sorted(os.listdir(library), reverse=True)]
+
+        results = [(dirpath, dir_entries()) for dirpath, dir_entries in collect_exif_data.scan_dirs(dirs, False, 3)]
+
+        assert [dirpath for dirpath, _ in results] == [dirpath for dirpath, _ in dirs]
+        for dirpath, dir_entries in results:
+            assert {e.dirpath for e in dir_entries} == {dirpath}
+
+
+class TestIncrementalScan:
+    """Test that rescans only pass added or changed files to exiftool"""
+
+    @pytest.fixture
+    def event_dir(self, write_photo, fake_pool, monkeypatch):
+        calls = []
+        run_exiftool = collect_exif_data.run_exiftool
+
+        def recording_run_exiftool(dirpath, paths, *args):
+            calls.append(sorted(os.path.basename(p) for p in paths))
+            return run_exiftool(dirpath, paths, *args)
+
+        monkeypatch.setattr(collect_exif_data, "run_exiftool", recording_run_exiftool)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for j in range(3):
+                write_photo(temp_dir, "IMG_%d.jpg" % j, {"DateTimeOriginal": "2023:01:01 12:00:%02d" % j, "Make": "Apple"})
+            collect_exif_data.scan_one(temp_dir, list(os.scandir(temp_dir)), False)
+            calls.clear()
+            yield temp_dir, calls
+
+    def rescan(self, dirpath):
+        return {e.filename: e for e in collect_exif_data.scan_one(dirpath, list(os.scandir(dirpath)), False)}
+
+    def test_records_stats(self, event_dir):
+        """The first scan records a stat key for every image"""
+        dirpath, _ = event_dir
+        stats = exif.load_stat_file(os.path.join(dirpath, exif.EXIF_STAT_NAME))
+        assert sorted(stats) == ["IMG_0.jpg", "IMG_1.jpg", "IMG_2.jpg"]
+        assert stats["IMG_0.jpg"] == exif.stat_key(os.stat(os.path.join(dirpath, "IMG_0.jpg")))
+
+    def test_unchanged_dir_skips_exiftool(self, event_dir):
+        """A rescan of an unchanged directory never runs exiftool"""
+        dirpath, calls = event_dir
+        entries = self.rescan(dirpath)
+        assert len(entries) == 3
+        assert calls == []
+
+    def test_edited_file_is_reextracted(self, event_dir, write_photo):
+        """A file edited in place is re-extracted on its own"""
+        dirpath, calls = event_dir
+        path = write_photo(dirpath, "IMG_1.jpg", {"DateTimeOriginal": "2024:06:01 08:00:00", "Make": "Apple"})
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+
+        entries = self.rescan(dirpath)
+
+        assert calls == [["IMG_1.jpg"]]
+        assert entries["IMG_1.jpg"].timestamp == "2024:06:01 08:00:00"
+        assert entries["IMG_0.jpg"].timestamp == "2023:01:01 12:00:00"
+
+    def test_added_and_removed_files(self, event_dir, write_photo):
+        """New files are extracted, removed files are dropped without exiftool"""
+        dirpath, calls = event_dir
+        write_photo(dirpath, "IMG_9.jpg", {"DateTimeOriginal": "2023:01:01 13:00:00", "Make": "Apple"})
+        os.unlink(os.path.join(dirpath, "IMG_0.jpg"))
+
+        entries = self.rescan(dirpath)
+
+        assert calls == [["IMG_9.jpg"]]
+        assert sorted(entries) == ["IMG_1.jpg", "IMG_2.jpg", "IMG_9.jpg"]
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+            assert [e.filename for e in exif.load_exif_file(fp, dirpath)] == sorted(entries)
+
+        calls.clear()
+        os.unlink(os.path.join(dirpath, "IMG_1.jpg"))
+        assert sorted(self.rescan(dirpath)) == ["IMG_2.jpg", "IMG_9.jpg"]
+        assert calls == []
+
+    def test_exif_data_without_stats_is_trusted(self, event_dir, write_photo):
+        """.exif_data written before stats were recorded is kept, new files are added"""
+        dirpath, calls = event_dir
+        os.unlink(os.path.join(dirpath, exif.EXIF_STAT_NAME))
+        write_photo(dirpath, "IMG_9.jpg", {"DateTimeOriginal": "2023:01:01 13:00:00", "Make": "Apple"})
+
+        entries = self.rescan(dirpath)
+
+        assert calls == [["IMG_9.jpg"]]
+        assert len(entries) == 4
+        assert os.path.exists(os.path.join(dirpath, exif.EXIF_STAT_NAME))
+
+    def test_entries_for_other_files_are_dropped(self, event_dir):
+        """Sidecars an old .exif_data lists are dropped and the file rewritten, without exiftool"""
+        dirpath, calls = event_dir
+        for name in ("IMG_0.xmp", "notes.txt"):
+            open(os.path.join(dirpath, name), "w").close()
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME), "a") as fp:
+            fp.write(json.dumps({"FileName": "IMG_0.xmp", "FileSize": "0 bytes"}) + "\n")
+            fp.write(json.dumps({"FileName": "notes.txt", "FileSize": "0 bytes"}) + "\n")
+
+        entries = self.rescan(dirpath)
+
+        assert calls == []
+        assert sorted(entries) == ["IMG_0.jpg", "IMG_1.jpg", "IMG_2.jpg"]
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+            assert [e.filename for e in exif.load_exif_file(fp, dirpath)] == sorted(entries)
+
+
+class TestExtractionProfile:
+    """Test the exiftool commands used to extract a directory"""
+
+    @pytest.fixture
+    def commands(self, fake_pool, monkeypatch):
+        calls = []
+        execute_iter = fake_pool.execute_iter
+
+        def recording_execute_iter(*args):
+            records = []
+            calls.append((args, records))
+            for record in execute_iter(*args):
+                records.append(record)
+                yield record
+
+        monkeypatch.setattr(fake_pool, "execute_iter", recording_execute_iter)
+        return calls
+
+    def test_only_consumed_tags_are_requested(self, commands, write_photo):
+        """Records hold just the tags from_exif_entry reads"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_photo(temp_dir, "IMG_0.jpg", {"DateTimeOriginal": "2023:01:01 12:00:00", "Make": "Apple",
+                                                "LensModel": "iPhone back camera", "ISO": 50})
+            list(collect_exif_data.run_exiftool(temp_dir, [temp_dir]))
+
+        args, [record] = commands[0]
+        assert "-fast" in args
+        assert sorted(record) == ["DateTimeOriginal", "FileName", "FileSize", "Make", "SourceFile"]
+
+    def test_directory_is_limited_to_supported_formats(self, commands, write_photo):
+        """Unsupported files are skipped by exiftool, and videos are read with -fast2"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_photo(temp_dir, "b.jpg", {"DateTimeOriginal": "2023:01:01 12:00:00"})
+            write_photo(temp_dir, "a.mov", {})
+            write_photo(temp_dir, "c.png", {})
+            entries = list(collect_exif_data.scan_dir(temp_dir, os.listdir(temp_dir)))
+
+        assert [e.filename for e in entries] == ["b.jpg", "a.mov"]
+        (image_command, _), (video_command, _) = commands
+        assert [image_command[i + 1] for i, a in enumerate(image_command) if a == "-ext"] == list(exiftool.IMAGE_FORMATS)
+        assert [video_command[i + 1] for i, a in enumerate(video_command) if a == "-ext"] == list(exiftool.VIDEO_FORMATS)
+        assert "-fast2" in video_command and "-fast2" not in image_command
+
+    def test_one_command_without_videos(self, commands, write_photo):
+        """A folder of images alone is extracted with a single exiftool command"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_photo(temp_dir, "a.jpg", {"DateTimeOriginal": "2023:01:01 12:00:00"})
+            write_photo(temp_dir, "b.JPG", {"DateTimeOriginal": "2023:01:01 12:00:01"})
+            entries = list(collect_exif_data.scan_dir(temp_dir, os.listdir(temp_dir)))
+
+        assert sorted(e.filename for e in entries) == ["a.jpg", "b.JPG"]
+        (command, _), = commands
+        assert "-fast" in command
+
+    def test_files_keep_their_order(self, commands, write_photo):
+        """Explicit files come back images first, each in the order given"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            names = ["z.mov", "a.jpg", "m.mp4"]
+            for name in names:
+                write_photo(temp_dir, name, {})
+            entries = list(collect_exif_data.scan_files(temp_dir, names))
+
+        assert [e.filename for e in entries] == ["a.jpg", "z.mov", "m.mp4"]
+        assert len(commands) == 2
+
+    def test_error_leaves_folder_untouched(self, fake_pool, monkeypatch, write_photo, capsys):
+        """An exiftool Error in the video pass raises before any entry is returned or written"""
+        execute_iter = fake_pool.execute_iter
+
+        def failing_execute_iter(*args):
+            for record in execute_iter(*args):
+                if record["FileName"].endswith(".mov"):
+                    record = {"SourceFile": record["SourceFile"], "FileName": record["FileName"],
+                              "Error": "File format error"}
+                yield record
+
+        monkeypatch.setattr(fake_pool, "execute_iter", failing_execute_iter)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_photo(temp_dir, "a.jpg", {"DateTimeOriginal": "2023:01:01 12:00:00"})
+            write_photo(temp_dir, "b.mov", {})
+            with pytest.raises(exiftool.FileErrors) as e:
+                collect_exif_data.scan_one(temp_dir, list(os.scandir(temp_dir)), False)
+            assert e.value.errors == {os.path.join(temp_dir, "b.mov"): "File format error"}
+            assert not os.path.exists(os.path.join(temp_dir, exif.EXIF_FILE_NAME))
+
+            monkeypatch.setattr("sys.argv", ["collect_exif_data.py", temp_dir])
+            with pytest.raises(SystemExit):
+                collect_exif_data.main()
+            assert "b.mov: File format error" in capsys.readouterr().out
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import tempfile
+import exif
+import deduplicate
+from exif.hashstore import HashStore
+from exif.journal import Journal, settle
+
+
+def make_entry(dirpath, name, timestamp="2023:01:01 12:00:00", make="Apple", content=b"photo"):
+    with open(os.path.join(dirpath, name), "wb") as fp:
+        fp.write(content)
+    return exif.ExifEntry(filename=name, dirpath=dirpath, timestamp=timestamp, make=make,
+                          shutter_count="None", serial_number="None")
+
+
+def make_noexif(dirpath, name, content):
+    with open(os.path.join(dirpath, name), "wb") as fp:
+        fp.write(content)
+    return exif.NoExifFile(filename=name, dirpath=dirpath, file_hash=None)
+
+
+@pytest.fixture
+def roots():
+    with tempfile.TemporaryDirectory() as scan_root, tempfile.TemporaryDirectory() as target_root:
+        yield scan_root, target_root
+
+
+class TestTargetPath:
+    """Test where photos are placed"""
+
+    def test_shutter_count_identifier(self):
+        """A valid shutter count identifies the photo"""
+        entry = exif.ExifEntry(filename="DSC_1.NEF", timestamp="2023:04:05 06:07:08", shutter_count="1234", make="Nikon")
+        assert deduplicate.target_path(entry, "/t") == os.path.join("/t", "2023", "04", "05", "06-07-08-1234.nef")
+
+    def test_make_identifier(self):
+        """Without a shutter count the make is used, and / dates are accepted"""
+        entry = exif.ExifEntry(filename="IMG_1.HEIC", timestamp="2023/04/05 06:07:08", shutter_count="None", make="Apple")
+        assert deduplicate.target_path(entry, "/t") == os.path.join("/t", "2023", "04", "05", "06-07-08-Apple.heic")
+
+
+class TestSeenKeys:
+    """Test the disk-backed seen-key set"""
+
+    def test_add_and_contains(self, roots):
+        """add() reports whether the key is new"""
+        seen = deduplicate.SeenKeys(roots[1])
+        try:
+            assert seen.add("a")
+            assert not seen.add("a")
+            assert "a" in seen
+            assert "b" not in seen
+        finally:
+            seen.close()
+
+    def test_local_temp_folder_by_default(self, roots, monkeypatch):
+        """Without a folder the database goes to the temp folder"""
+        monkeypatch.setattr(tempfile, "tempdir", roots[0])
+        seen = deduplicate.SeenKeys()
+        assert len(os.listdir(roots[0])) == 1
+        seen.close()
+        assert os.listdir(roots[0]) == []
+
+    def test_cleans_up(self, roots):
+        """close() removes the temporary database"""
+        seen = deduplicate.SeenKeys(roots[1])
+        seen.close()
+        assert os.listdir(roots[1]) == []
+
+
+class TestDeduplicator:
+    """Test placing entries as they are streamed in"""
+
+    def test_first_entry_of_each_key_is_placed(self, roots, capsys):
+        """Later entries with an already placed key are skipped silently"""
+        scan_root, target_root = roots
+        first = make_entry(scan_root, "a.jpg", content=b"first")
+        copy = make_entry(scan_root, "b.jpg", content=b"second")
+        other = make_entry(scan_root, "c.jpg", timestamp="2023:01:01 12:00:01")
+
+        with deduplicate.Deduplicator(target_root, scan_root) as d:
+            assert d.place(first)
+            assert not d.place(copy)
+            assert d.place(other)
+        assert d.placed_count == 2
+
+        dest = deduplicate.target_path(first, target_root)
+        with open(dest, "rb") as fp:
+            assert fp.read() == b"first"
+        assert "b.jpg" not in capsys.readouterr().out
+
+    def test_existing_destination_is_kept(self, roots, capsys):
+        """A file already at the destination is not overwritten"""
+        scan_root, target_root = roots
+        entry = make_entry(scan_root, "a.jpg")
+        dest = deduplicate.target_path(entry, target_root)
+        os.makedirs(os.path.dirname(dest))
+        open(dest, "w").close()
+
+        with deduplicate.Deduplicator(target_root, scan_root) as d:
+            d.place(entry)
+        assert d.placed_count == 0
+        assert "is already copied" in capsys.readouterr().out
+        with open(dest, "rb") as fp:
+            assert fp.read() == b""
+
+    def test_noexif_files_are_deduplicated_by_hash(self, roots):
+        """NoExifFiles are copied once per content hash and recorded in the hash file"""
+        scan_root, target_root = roots
+        a = make_noexif(scan_root, "a.mov", b"same")
+        b = make_noexif(scan_root, "b.mov", b"same")
+        c = make_noexif(scan_root, "c.mov", b"different")
+
+        with deduplicate.Deduplicator(target_root, scan_root) as d:
+            d.place_all([a, b, c])
+        assert d.copied_count == 2
+
+        with HashStore(os.path.join(target_root, "noexif")) as hashes:
+            assert len(hashes) == 2
+            assert a.file_hash in hashes and c.file_hash in hashes
+
+    def test_move(self, roots):
+        """--force moves instead of copying"""
+        scan_root, target_root = roots
+        entry = make_entry(scan_root, "a.jpg")
+
+        with deduplicate.Deduplicator(target_root, scan_root, force_move=True) as d:
+            d.place(entry)
+
+        assert not os.path.exists(entry.path())
+        assert os.path.exists(deduplicate.target_path(entry, target_root))
+
+    def test_manifest(self, roots, capsys):
+        """The target manifest is saved on close and used by the next run"""
+        scan_root, target_root = roots
+        entry = make_entry(scan_root, "a.jpg")
+        manifest = os.path.join(scan_root, "manifest")
+
+        with deduplicate.Deduplicator(target_root, scan_root, manifest=manifest) as d:
+            d.place(entry)
+        capsys.readouterr()
+
+        os.remove(deduplicate.target_path(entry, target_root))
+        with deduplicate.Deduplicator(target_root, scan_root, manifest=manifest) as d:
+            assert not d.place(entry)
+        assert "is already copied" in capsys.readouterr().out
+
+    def test_parallel_transfers(self, roots):
+        """Every entry is placed when several transfers run at once"""
+        from exif.transfer import Transferrer
+        scan_root, target_root = roots
+        entries = [make_entry(scan_root, "%d.jpg" % i, timestamp="2023:01:01 12:00:%02d" % i) for i in range(20)]
+        noexif = [make_noexif(scan_root, "%d.mov" % i, b"%d" % (i % 5)) for i in range(10)]
+
+        with deduplicate.Deduplicator(target_root, scan_root, transferrer=Transferrer("copy", 4)) as d:
+            d.place_all(entries + noexif)
+
+        assert d.placed_count == 20
+        assert d.copied_count == 5
+        with HashStore(os.path.join(target_root, "noexif")) as hashes:
+            assert len(hashes) == 5
+
+    def test_force_with_link_is_refused(self, roots, monkeypatch, capsys):
+        """--force moves, so asking for a link mode as well is an error rather than ignored"""
+        import sys
+        scan_root, target_root = roots
+        make_entry(scan_root, "a.jpg")
+        monkeypatch.setattr(sys, "argv", ["deduplicate.py", "--force", "--link", "hardlink", scan_root, target_root])
+        with pytest.raises(SystemExit):
+            deduplicate.main()
+        assert "--link" in capsys.readouterr().err
+        assert os.path.exists(os.path.join(scan_root, "a.jpg"))
+        assert os.listdir(target_root) == []
+
+    def test_scratch_databases_stay_out_of_target(self, roots):
+        """The seen keys and the target index go to tmp_dir, not into the target"""
+        scan_root, target_root = roots
+        entry = make_entry(scan_root, "a.jpg")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with deduplicate.Deduplicator(target_root, scan_root, tmp_dir=tmp_dir) as d:
+                assert len(os.listdir(tmp_dir)) == 2
+                d.place_all([entry])
+            assert os.listdir(tmp_dir) == []
+        assert os.listdir(target_root) == ["2023"]
+
+    def test_unhashable_file_is_skipped(self, roots):
+        """A NoExifFile that can't be read is skipped with a message, without blocking anything"""
+        scan_root, target_root = roots
+        missing = exif.NoExifFile(filename="gone.mov", dirpath=scan_root, file_hash=None)
+        readable = make_noexif(scan_root, "b.mov", b"video")
+
+        with deduplicate.Deduplicator(target_root, scan_root) as d:
+            assert not d.place(missing)
+            assert d.place(readable)
+        assert d.claimed == set()
+        assert os.path.exists(os.path.join(target_root, "noexif", "b.mov"))
+
+
+class TestJournal:
+    """Test the journal of transfers into the target"""
+
+    def test_undo_move(self, roots):
+        """--undo moves moved files back and forgets their hashes"""
+        scan_root, target_root = roots
+        os.mkdir(os.path.join(scan_root, "sub"))
+        entry = make_entry(os.path.join(scan_root, "sub"), "a.jpg")
+        noexif = make_noexif(scan_root, "a.mov", b"video")
+
+        with deduplicate.Deduplicator(target_root, scan_root, force_move=True, journal=Journal(target_root)) as d:
+            d.place_all([entry, noexif])
+        assert not os.path.exists(entry.path())
+
+        deduplicate.undo(target_root)
+        assert os.path.exists(entry.path())
+        assert os.path.exists(noexif.path())
+        assert not os.path.exists(os.path.join(target_root, "2023"))
+        with HashStore(os.path.join(target_root, "noexif")) as hashes:
+            assert noexif.file_hash not in hashes
+
+    def test_resume(self, roots):
+        """An interrupted run is resumed, skipping the folders it finished"""
+        scan_root, target_root = roots
+        entry = make_entry(scan_root, "a.jpg")
+
+        with pytest.raises(KeyboardInterrupt):
+            with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+                d.place_all([entry])
+                raise KeyboardInterrupt
+
+        with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+            assert d.resumed
+            assert d.journal.run.dirs == {scan_root}
+
+        with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+            assert not d.resumed
+
+    def test_live_run_keeps_no_transfers(self, roots):
+        """Transfers are only written to the journal, not kept in memory for the whole run"""
+        scan_root, target_root = roots
+        entries = [make_entry(scan_root, "%d.jpg" % i, timestamp="2023:01:01 12:00:%02d" % i) for i in range(5)]
+
+        with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+            d.place_all(entries)
+            d.transferrer.close()
+            assert d.journal.run.plans == {}
+            assert d.journal.run.outcomes == {}
+            assert d.journal.run.dirs == set()
+        assert len(Journal(target_root).run.done()) == 5
+        assert Journal(target_root).run.dirs == {scan_root}
+
+    def test_unfinished_transfers_are_settled(self, roots):
+        """On resume a copy cut short is removed, and a move that got as far as the link is finished"""
+        scan_root, target_root = roots
+        copied = make_entry(scan_root, "a.jpg", content=b"full content")
+        partial = os.path.join(target_root, "a.jpg")
+        with open(partial, "wb") as fp:
+            fp.write(b"full")
+        moved = make_entry(scan_root, "b.jpg")
+        linked = os.path.join(target_root, "b.jpg")
+        os.link(moved.path(), linked)
+
+        journal = Journal(target_root)
+        journal.start(scan_root, "copy")
+        journal.plan(copied.path(), partial, "copy")
+        journal.plan(moved.path(), linked, "move")
+        journal.close()
+
+        with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+            assert d.resumed
+            assert not os.path.exists(partial)
+            assert os.path.exists(copied.path())
+            assert os.path.exists(linked)
+            assert not os.path.exists(moved.path())
+
+    def test_other_run_is_refused(self, roots, capsys, monkeypatch):
+        """A run from another root leaves an interrupted one alone, and the interrupted run still resumes"""
+        import sys
+        scan_root, target_root = roots
+        copied = make_entry(scan_root, "a.jpg", content=b"full content")
+        partial = os.path.join(target_root, "a.jpg")
+        with open(partial, "wb") as fp:
+            fp.write(b"full")
+
+        journal = Journal(target_root)
+        journal.start(os.path.relpath(scan_root), "copy")
+        journal.plan(copied.path(), partial, "copy")
+        journal.close()
+
+        with tempfile.TemporaryDirectory() as other_root:
+            monkeypatch.setattr(sys, "argv", ["deduplicate.py", other_root, target_root])
+            with pytest.raises(SystemExit):
+                deduplicate.main()
+            assert "unfinished copy run" in capsys.readouterr().out
+            with pytest.raises(ValueError):
+                deduplicate.Deduplicator(target_root, scan_root, force_move=True, journal=Journal(target_root))
+        assert os.path.exists(partial)
+
+        with deduplicate.Deduplicator(target_root, scan_root, journal=Journal(target_root)) as d:
+            assert d.resumed
+            assert not os.path.exists(partial)
+
+    def test_resume_from_catalog(self, roots, monkeypatch):
+        """With --catalog a folder is only done once its NoExif files are placed too"""
+        import json
+        import sys
+        from exif.catalog import Catalog
+        scan_root, target_root = roots
+        for i, name in enumerate(["a", "b"]):
+            dirpath = os.path.join(scan_root, name)
+            os.mkdir(dirpath)
+            make_entry(dirpath, "%s.jpg" % name, content=b"photo %d" % i)
+            make_noexif(dirpath, "%s.mov" % name, b"video %d" % i)
+            with open(os.path.join(dirpath, exif.EXIF_FILE_NAME), "w") as fp:
+                fp.write(json.dumps({"FileName": "%s.jpg" % name, "DateTimeOriginal": "2023:01:0%d 12:00:00" % (i + 1),
+                                     "Make": "Apple", "FileSize": "7 bytes"}) + "\n")
+                fp.write(json.dumps({"FileName": "%s.mov" % name, "FileSize": "7 bytes"}) + "\n")
+        catalog_path = os.path.join(scan_root, "catalog.db")
+        with Catalog(catalog_path) as catalog:
+            catalog.import_tree(scan_root)
+        argv = ["deduplicate.py", "--catalog", catalog_path, scan_root, target_root]
+        monkeypatch.setattr(sys, "argv", argv)
+
+        place_all = deduplicate.Deduplicator.place_all
+        calls = []
+
+        def interrupted(self, entries):
+            # the first folder goes through, the run is cut short at the second
+            if calls:
+                raise KeyboardInterrupt
+            calls.append(entries)
+            place_all(self, entries)
+
+        monkeypatch.setattr(deduplicate.Deduplicator, "place_all", interrupted)
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                deduplicate.main()
+            assert sorted(e.filename for e in calls[0]) == ["a.jpg", "a.mov"]
+        finally:
+            monkeypatch.setattr(deduplicate.Deduplicator, "place_all", place_all)
+
+        deduplicate.main()
+        placed = sorted(f for _, _, files in os.walk(target_root) for f in files if f.endswith((".jpg", ".mov")))
+        assert placed == ["12-00-00-Apple.jpg", "12-00-00-Apple.jpg", "a.mov", "b.mov"]
+
+    def test_settle_leaves_other_files_alone(self, roots):
+        """A different file already at dst, even of the same size, is neither taken as done nor removed"""
+        scan_root, target_root = roots
+        src = make_entry(scan_root, "a.jpg", content=b"our photo").path()
+        dst = os.path.join(target_root, "a.jpg")
+        with open(dst, "wb") as fp:
+            fp.write(b"the other")
+        shorter = os.path.join(target_root, "b.jpg")
+        with open(shorter, "wb") as fp:
+            fp.write(b"other")
+
+        assert not settle({"src": src, "dst": dst, "mode": "move"})
+        assert not settle({"src": src, "dst": shorter, "mode": "copy"})
+        assert os.path.exists(src)
+        with open(dst, "rb") as fp:
+            assert fp.read() == b"the other"
+        assert os.path.exists(shorter)
+
+    def test_settle_finishes_matching_copy(self, roots):
+        """A dst with the content of src is complete, and a move then removes src"""
+        scan_root, target_root = roots
+        src = make_entry(scan_root, "a.jpg", content=b"our photo").path()
+        dst = os.path.join(target_root, "a.jpg")
+        with open(dst, "wb") as fp:
+            fp.write(b"our photo")
+
+        assert settle({"src": src, "dst": dst, "mode": "move", "hash": exif.calculate_file_hash(dst)})
+        assert not os.path.exists(src)
+        assert os.path.exists(dst)
+
+
+class TestStreamEntries:
+    """Test the background scanning stage"""
+
+    def test_yields_in_order(self):
+        """Entries come out in the order they were produced"""
+        assert list(deduplicate.stream_entries(lambda: iter(range(100)), maxsize=4)) == list(range(100))
+
+    def test_reraises_scan_errors(self):
+        """An exception on the scanning thread is raised in the consumer"""
+        def failing():
+            yield 1
+            raise ValueError("scan failed")
+
+        stream = deduplicate.stream_entries(failing)
+        assert next(stream) == 1
+        with pytest.raises(ValueError):
+            next(stream)
+
+    def test_consumer_starts_before_scan_finishes(self):
+        """The first entry is available while the scan is still running"""
+        import threading
+        release = threading.Event()
+
+        def slow():
+            yield "first"
+            release.wait(5)
+            yield "second"
+
+        stream = deduplicate.stream_entries(slow)
+        assert next(stream) == "first"
+        release.set()
+        assert list(stream) == ["second"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
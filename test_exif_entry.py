@@ -320,5 +320,45 @@ class TestExifEntryBugsAndIssues:
 
         os.unlink(f.name)
 
+class TestCompactEntries:
+    """Test the memory-lean layout of entries"""
+
+    def test_no_instance_dict(self):
+        """Entries use __slots__ instead of a per-instance dict"""
+        entry = exif.ExifEntry(filename="a.jpg", timestamp="2023:01:01 12:00:00")
+        noexif = exif.NoExifFile(filename="a.mov", file_hash="ab")
+        for e in (entry, noexif):
+            assert not hasattr(e, "__dict__")
+            with pytest.raises(AttributeError):
+                e.unknown = 1
+
+    def test_repeated_strings_are_shared(self):
+        """Folders, makes and extensions built separately end up as one string object"""
+        a, b = ("".join(["/photos/", "2023"]) for _ in range(2))
+        make_a, make_b = ("".join(["NIKON ", "CORPORATION"]) for _ in range(2))
+        assert a is not b and make_a is not make_b
+
+        e1 = exif.ExifEntry(filename="a.NEF", dirpath=a, make=make_a)
+        e2 = exif.ExifEntry(filename="b.nef", dirpath=b, make=make_b)
+        assert e1.dirpath is e2.dirpath
+        assert e1.make is e2.make
+        assert e1.file_ext is e2.file_ext
+        assert exif.NoExifFile(filename="c.mov", dirpath=a).dirpath is e1.dirpath
+
+    def test_key_is_cached(self):
+        """uniq_str() is built once and equality is unchanged"""
+        e1 = exif.ExifEntry(filename="a.jpg", timestamp="2023:01:01 12:00:00", make="Apple", size="2.1 MB")
+        e2 = exif.ExifEntry(filename="b.jpg", timestamp="2023:01:01 12:00:00", make="Apple", size="2.1 MB")
+        assert e1.uniq_str() is e1.uniq_str()
+        assert e1 == e2 and hash(e1) == hash(e2)
+        assert e1 != exif.ExifEntry(filename="c.jpg", timestamp="2023:01:01 12:00:01", make="Apple", size="2.1 MB")
+
+    def test_non_string_values(self):
+        """Values that aren't strings, like a missing make, are kept as they are"""
+        entry = exif.ExifEntry(filename="a.jpg", timestamp="2023:01:01 12:00:00", make=None, size=123)
+        assert entry.make is None
+        assert entry.size == 123
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
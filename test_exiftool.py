@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+import pytest
+import json
+import os
+import tempfile
+import threading
+import exif
+from exif import exiftool
+
+from conftest import FAKE_EXIFTOOL
+
+
+@pytest.fixture
+def photo_dir(write_photo):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_photo(temp_dir, "a.jpg", {"DateTimeOriginal": "2023:01:01 12:00:00", "Make": "Apple"})
+        write_photo(temp_dir, "b.nef", {"DateTimeOriginal": "2023:01:02 12:00:00", "Make": "Nikon", "ShutterCount": 42})
+        yield temp_dir
+
+
+class TestExifTool:
+    """Test a single -stay_open exiftool worker"""
+
+    def test_execute_returns_json(self, photo_dir):
+        """Output of each command is framed by the {ready} marker"""
+        worker = exiftool.ExifTool(FAKE_EXIFTOOL)
+        try:
+            stdout, stderr = worker.execute("-j", photo_dir)
+            records = json.loads(stdout)
+            assert [r["FileName"] for r in records] == ["a.jpg", "b.nef"]
+            assert b"ready" not in stdout
+            assert b"ready" not in stderr
+        finally:
+            worker.close()
+
+    def test_process_is_reused(self, photo_dir):
+        """Consecutive commands are answered by the same process"""
+        worker = exiftool.ExifTool(FAKE_EXIFTOOL)
+        try:
+            worker.execute("-j", photo_dir)
+            pid = worker.proc.pid
+            worker.execute("-j", photo_dir)
+            assert worker.proc.pid == pid
+        finally:
+            worker.close()
+
+    def test_stderr_is_captured(self, photo_dir):
+        """Errors written to stderr are returned with the command"""
+        worker = exiftool.ExifTool(FAKE_EXIFTOOL)
+        try:
+            _, stderr = worker.execute("-j", os.path.join(photo_dir, "missing.jpg"))
+            assert b"File not found" in stderr
+        finally:
+            worker.close()
+
+    def test_close_stops_process(self, photo_dir):
+        """close() asks exiftool to leave -stay_open mode and waits for it"""
+        worker = exiftool.ExifTool(FAKE_EXIFTOOL)
+        worker.execute("-j", photo_dir)
+        proc = worker.proc
+        drainer = worker._drainer
+        worker.close()
+        assert proc.returncode == 0
+        assert not worker.running()
+        assert proc.stdin.closed and proc.stdout.closed and proc.stderr.closed
+        assert not drainer.is_alive()
+
+    def test_missing_executable(self):
+        """A missing exiftool binary is reported as ExifToolError"""
+        worker = exiftool.ExifTool(["/nonexistent/exiftool"])
+        with pytest.raises(exiftool.ExifToolError):
+            worker.execute("-j", ".")
+
+
+class TestStreaming:
+    """Test reading -j output one record at a time"""
+
+    EXIFTOOL_OUTPUT = (b'[{\n  "SourceFile": "a.jpg",\n  "Struct": {\n    "Make": "Apple"\n  }\n},\n'
+                       b'{\n  "SourceFile": "b.jpg",\n  "List": ["x", "}"]\n}]\n')
+
+    def test_iter_records(self):
+        """Records are decoded line by line, including nested objects"""
+        records = list(exiftool.iter_records(self.EXIFTOOL_OUTPUT.splitlines(keepends=True)))
+        assert records == json.loads(self.EXIFTOOL_OUTPUT)
+
+    def test_iter_records_indented(self):
+        """Indented arrays, as written by json.dumps, are read the same way"""
+        data = [{"SourceFile": str(i), "Nested": {"a": [1, {"b": 2}]}} for i in range(5)]
+        text = json.dumps(data, indent=2)
+        assert list(exiftool.iter_records(text.splitlines(keepends=True))) == data
+        assert list(exiftool.iter_records([])) == []
+
+    def test_iter_records_is_incremental(self):
+        """A record is yielded before the following lines are read"""
+        def lines():
+            yield from self.EXIFTOOL_OUTPUT.splitlines(keepends=True)[:6]
+            raise AssertionError("read too far")
+
+        assert next(exiftool.iter_records(lines()))["SourceFile"] == "a.jpg"
+
+    def test_iter_records_rejects_garbage(self):
+        """Output that isn't a JSON array is an error"""
+        with pytest.raises(ValueError):
+            list(exiftool.iter_records([b"Warning: not json\n"]))
+
+    def test_execute_iter(self, photo_dir):
+        """A worker streams records and stays usable after the caller stops early"""
+        worker = exiftool.ExifTool(FAKE_EXIFTOOL)
+        try:
+            records = worker.execute_iter("-j", photo_dir)
+            assert next(records)["FileName"] == "a.jpg"
+            records.close()
+
+            assert [r["FileName"] for r in worker.execute_iter("-j", photo_dir)] == ["a.jpg", "b.nef"]
+            stdout, _ = worker.execute("-j", photo_dir)
+            assert len(json.loads(stdout)) == 2
+        finally:
+            worker.close()
+
+    def test_pool_execute_iter(self, photo_dir):
+        """The pool returns the worker once the records have been read"""
+        pool = exiftool.ExifToolPool(1, FAKE_EXIFTOOL)
+        try:
+            assert len(list(pool.execute_iter("-j", photo_dir))) == 2
+            worker = pool._workers[0]
+            worker.proc.kill()
+            worker.proc.wait()
+            assert len(list(pool.execute_iter("-j", photo_dir))) == 2
+        finally:
+            pool.close()
+
+
+class TestExifToolPool:
+    """Test the shared pool of exiftool workers"""
+
+    def test_restarts_crashed_worker(self, photo_dir):
+        """A worker that died is restarted and the command retried"""
+        pool = exiftool.ExifToolPool(1, FAKE_EXIFTOOL)
+        try:
+            pool.execute("-j", photo_dir)
+            worker = pool._workers[0]
+            worker.proc.kill()
+            worker.proc.wait()
+
+            stdout, _ = pool.execute("-j", photo_dir)
+            assert len(json.loads(stdout)) == 2
+        finally:
+            pool.close()
+
+    def test_concurrent_execute(self, photo_dir):
+        """Several threads can share a pool"""
+        pool = exiftool.ExifToolPool(3, FAKE_EXIFTOOL)
+        results = []
+
+        def run():
+            stdout, _ = pool.execute("-j", photo_dir)
+            results.append(len(json.loads(stdout)))
+
+        try:
+            threads = [threading.Thread(target=run) for _ in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert results == [2] * 6
+        finally:
+            pool.close()
+
+    def test_get_pool_is_shared(self, fake_pool):
+        """get_pool() hands out a single pool and only ever grows it"""
+        assert exiftool.get_pool() is fake_pool
+        exiftool.get_pool(4)
+        assert fake_pool.size == 4
+        exiftool.get_pool(2)
+        assert fake_pool.size == 4
+
+    def test_scan_dir_uses_pool(self, photo_dir, fake_pool):
+        """collect_exif_data.scan_dir reads metadata through the shared pool"""
+        from collect_exif_data import scan_dir
+
+        entries = list(scan_dir(photo_dir, os.listdir(photo_dir)))
+        assert [e.filename for e in entries] == ["a.jpg", "b.nef"]
+        assert all(isinstance(e, exif.ExifEntry) for e in entries)
+        assert entries[1].shutter_count == "42"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import random
+import tempfile
+from exif import folders, grouping
+
+
+def pairwise(folder_dict):
+    """The pairwise comparison folder_relations replaced"""
+    result = []
+    items = list(folder_dict.items())
+    for i, (path1, set1) in enumerate(items):
+        for path2, set2 in items[i + 1:]:
+            if set1 == set2:
+                result.append((folders.SAME, path1, path2))
+            elif set1 <= set2:
+                result.append((folders.SUBSET, path1, path2))
+            elif set2 <= set1:
+                result.append((folders.SUBSET, path2, path1))
+    return result
+
+
+class TestFolderRelations:
+    """Test folder containment detection"""
+
+    def test_same_and_subset(self):
+        """Equal folders and folders inside others are reported"""
+        folder_dict = {
+            "/a": {"1", "2"},
+            "/b": {"1", "2", "3"},
+            "/c": {"2", "1"},
+            "/d": {"4"},
+        }
+        relations = [r[:3] for r in folders.folder_relations(folder_dict)]
+        assert relations == [
+            (folders.SUBSET, "/a", "/b"),
+            (folders.SAME, "/a", "/c"),
+            (folders.SUBSET, "/c", "/b"),
+        ]
+
+    def test_matches_pairwise_comparison(self):
+        """Same pairs, in the same order, as comparing every pair of folders"""
+        rng = random.Random(7)
+        folder_dict = {}
+        for i in range(300):
+            base = rng.randrange(20)
+            folder_dict["/f%d" % i] = {("exif", str(base * 10 + rng.randrange(6))) for _ in range(rng.randrange(1, 6))}
+
+        relations = [r[:3] for r in folders.folder_relations(folder_dict)]
+        assert relations == pairwise(folder_dict)
+        assert relations
+
+    def test_similar(self):
+        """Overlapping folders are reported above the threshold only"""
+        folder_dict = {
+            "/a": set("abcdefghij"),
+            "/b": set("abcdefghiz"),
+            "/c": set("abcdwxyz"),
+        }
+        assert list(folders.folder_relations(folder_dict)) == []
+
+        similar = list(folders.folder_relations(folder_dict, similar=0.8))
+        assert similar == [(folders.SIMILAR, "/a", "/b", 9 / 11)]
+
+    def test_disjoint_folders_are_not_compared(self):
+        """Folders sharing no keys produce nothing"""
+        folder_dict = {"/f%d" % i: {i} for i in range(1000)}
+        assert list(folders.folder_relations(folder_dict, similar=0.0)) == []
+
+
+class TestExternalFolders:
+    """Test the disk-backed folder keys of --store external"""
+
+    @pytest.mark.parametrize("use_numpy", [False] + ([True] if grouping.np is not None else []))
+    def test_matches_folder_relations(self, use_numpy):
+        """Same relations, in the same order, as folder_relations over the dict of sets"""
+        rng = random.Random(11)
+        folder_dict = {}
+        external = folders.ExternalFolders(memory_budget=2000, use_numpy=use_numpy)
+        for i in range(200):
+            base = rng.randrange(15)
+            keys = [("exif", str(base * 10 + rng.randrange(6))) for _ in range(rng.randrange(1, 8))]
+            folder_dict["/f%d" % i] = set(keys)
+            folder = external["/f%d" % i]
+            for key in keys:
+                # repeats within a folder count once, as in a set
+                folder.add(key)
+
+        expected = list(folders.folder_relations(folder_dict, similar=0.3))
+        assert expected
+        assert list(external.relations(similar=0.3)) == expected
+
+    def test_cleans_up(self):
+        """The spill folder is removed once the relations are read"""
+        with tempfile.TemporaryDirectory() as spill_dir:
+            external = folders.ExternalFolders(memory_budget=100, spill_dir=spill_dir)
+            for path in ("/a", "/b"):
+                for key in "xyz":
+                    external[path].add(key)
+            assert list(external.relations()) == [(folders.SAME, "/a", "/b", 1.0)]
+            assert os.listdir(spill_dir) == []
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import tempfile
+import exif
+from exif import grouping
+
+
+def entry(name, second, make="Apple"):
+    return exif.ExifEntry(filename=name, dirpath="/photos", timestamp="2023:01:01 12:00:%02d" % second, make=make,
+                          shutter_count="None", serial_number="None")
+
+
+ENTRIES = [
+    (entry("a.jpg", 5), "/photos/2023/a.jpg"),
+    (entry("b.jpg", 1), "/photos/2023/b.jpg"),
+    (entry("c.jpg", 5), "/backup/c.jpg"),
+    (entry("d.jpg", 2), "/photos/2023/d.jpg"),
+    (entry("e.jpg", 1), "/backup/e.jpg"),
+    (entry("f.jpg", 5), "/other/f.jpg"),
+    (entry("g.jpg", 1, make="Canon"), "/other/g.jpg"),
+]
+
+EXPECTED = [
+    ["/photos/2023/a.jpg", "/backup/c.jpg", "/other/f.jpg"],
+    ["/photos/2023/b.jpg", "/backup/e.jpg"],
+]
+
+
+def groupers():
+    yield "dict", grouping.DictGrouper()
+    yield "columnar-python", grouping.ColumnarGrouper(use_numpy=False)
+    if grouping.np is not None:
+        yield "columnar-numpy", grouping.ColumnarGrouper(use_numpy=True)
+    # a budget of a few records, so every sort spills several runs
+    yield "external-python", grouping.ExternalGrouper(memory_budget=800, use_numpy=False)
+    if grouping.np is not None:
+        yield "external-numpy", grouping.ExternalGrouper(memory_budget=200, use_numpy=True)
+
+
+class TestGroupers:
+    """Test that every store finds the same groups in the same order"""
+
+    @pytest.mark.parametrize("name,grouper", list(groupers()))
+    def test_duplicate_groups(self, name, grouper):
+        """Groups come in first-appearance order, paths in the order added"""
+        for e, path in ENTRIES:
+            grouper.add(e, path)
+        assert len(grouper) == len(ENTRIES)
+        assert list(grouper.duplicate_groups()) == EXPECTED
+
+    @pytest.mark.parametrize("name,grouper", list(groupers()))
+    def test_empty(self, name, grouper):
+        """No entries, no groups"""
+        assert list(grouper.duplicate_groups()) == []
+
+    def test_matches_dict_on_many_entries(self):
+        """The columnar store agrees with the dict on a larger random library"""
+        import random
+        rng = random.Random(1)
+        entries = [(entry("%d.jpg" % i, rng.randrange(60), make=rng.choice(["Apple", "NIKON", "SONY"])),
+                    "/photos/%d/%d.jpg" % (i % 7, i)) for i in range(2000)]
+
+        results = []
+        for _, grouper in groupers():
+            for e, path in entries:
+                grouper.add(e, path)
+            results.append(list(grouper.duplicate_groups()))
+        assert all(r == results[0] for r in results)
+
+    def test_numpy(self):
+        """The NumPy sort gives index ranges over the sorted order"""
+        pytest.importorskip("numpy")
+        grouper = grouping.ColumnarGrouper(use_numpy=True)
+        for e, path in ENTRIES:
+            grouper.add(e, path)
+        order, ranges = grouper.duplicate_ranges()
+        assert [order[start:end] for start, end in ranges] == [[0, 2, 5], [1, 4]]
+
+    def test_external_spills_and_cleans_up(self):
+        """Runs are written to the spill folder and removed once the groups are read"""
+        with tempfile.TemporaryDirectory() as spill_dir:
+            grouper = grouping.make_grouper("external", 1000, spill_dir)
+            for e, path in ENTRIES * 20:
+                grouper.add(e, path)
+            assert len(grouper._keys.runs) > 1
+
+            expected = grouping.DictGrouper()
+            for e, path in ENTRIES * 20:
+                expected.add(e, path)
+            assert list(grouper.duplicate_groups()) == list(expected.duplicate_groups())
+            assert os.listdir(spill_dir) == []
+
+    def test_external_odd_paths(self):
+        """Paths with newlines or undecodable bytes come back unchanged"""
+        grouper = grouping.ExternalGrouper(memory_budget=1000)
+        paths = ["/photos/new\nline.jpg", os.fsdecode(b"/photos/\xff.jpg")]
+        for path in paths:
+            grouper.add(entry("a.jpg", 1), path)
+        assert list(grouper.duplicate_groups()) == [paths]
+
+    def test_key_follows_uniq_str(self):
+        """Entries are grouped exactly when their uniq_str() is equal"""
+        a = exif.ExifEntry(filename="a.jpg", timestamp="ab", make="c")
+        b = exif.ExifEntry(filename="b.jpg", timestamp="a", make="bc")
+        assert a == b
+        assert grouping.pack_key(a.uniq_str()) == grouping.pack_key(b.uniq_str())
+
+    def test_unknown_store(self):
+        """Only the known stores can be made"""
+        with pytest.raises(ValueError):
+            grouping.make_grouper("btree")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import pytest
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import exif
+from exif import cascade, metrics
+from exif.hashing import HashService
+
+
+@pytest.fixture
+def paths():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        result = []
+        for i in range(20):
+            path = os.path.join(temp_dir, "file%02d.mov" % i)
+            with open(path, "wb") as fp:
+                fp.write(b"%d" % (i % 5) * (1000 + i % 5))
+            result.append(path)
+        yield result
+
+
+class TestCalculateFileHash:
+    """Test the adaptive read buffer"""
+
+    def test_read_size_is_clamped(self):
+        """Small files are read in one go, large files in bounded pieces"""
+        assert exif.read_size(10) == exif.MIN_READ_SIZE
+        assert exif.read_size(exif.MIN_READ_SIZE * 3) == exif.MIN_READ_SIZE * 3
+        assert exif.read_size(10 ** 12) == exif.MAX_READ_SIZE
+
+    def test_small_chunk_size(self, paths):
+        """An explicit chunk_size gives the same hash"""
+        assert exif.calculate_file_hash(paths[1], chunk_size=7) == exif.calculate_file_hash(paths[1])
+
+
+class TestHashService:
+    """Test the parallel hashing service"""
+
+    def test_submit_returns_future(self, paths):
+        """submit() hands back a Future with the full hash"""
+        with HashService(2) as service:
+            future = service.submit(paths[0])
+            with open(paths[0], "rb") as fp:
+                assert future.result() == hashlib.sha256(fp.read()).hexdigest()
+
+    def test_map_preserves_order(self, paths):
+        """map() streams results in the order the paths were given"""
+        with HashService(4) as service:
+            assert list(service.map(paths)) == [exif.calculate_file_hash(p) for p in paths]
+
+    def test_map_with_extra_arguments(self, paths):
+        """map() passes extra iterables as arguments, like the builtin"""
+        sizes = [os.path.getsize(p) for p in paths]
+        with HashService(4) as service:
+            result = list(service.map(paths, cascade.partial_file_hash, sizes, [10] * len(paths)))
+        assert result == [cascade.partial_file_hash(p, s, 10) for p, s in zip(paths, sizes)]
+
+    def test_device_limit(self, paths):
+        """No more than device_limit files of one device are read at once"""
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_hash(path):
+            with lock:
+                active.append(path)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(path)
+            return path
+
+        with HashService(8, device_limit=2) as service:
+            assert list(service.map(paths, slow_hash)) == paths
+        assert max(peak) <= 2
+
+    def test_hash_files(self, paths):
+        """hash_files() fills in deferred hashes of NoExifFiles"""
+        files = [exif.NoExifFile(os.path.basename(p), os.path.dirname(p), None) for p in paths]
+        files[0].file_hash = "known"
+
+        with HashService(4) as service:
+            service.hash_files(files)
+
+        assert files[0].file_hash == "known"
+        assert [f.file_hash for f in files[1:]] == [exif.calculate_file_hash(p) for p in paths[1:]]
+
+    def test_cascade_with_service(self, paths):
+        """duplicate_groups gives the same groups with and without a service"""
+        def load():
+            return [exif.NoExifFile(os.path.basename(p), os.path.dirname(p), None) for p in paths]
+
+        serial = [[f.path() for f in g] for g in cascade.duplicate_groups(load(), edge=100)]
+        with HashService(4) as service:
+            parallel = [[f.path() for f in g] for g in cascade.duplicate_groups(load(), edge=100, service=service)]
+
+        assert parallel == serial
+        assert len(serial) == 5
+
+
+class TestSavedHashes:
+    """Test that full hashes are kept in .exif_data between runs"""
+
+    @pytest.fixture
+    def scanned(self, fake_pool, write_photo):
+        import collect_exif_data
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_photo(temp_dir, "a.mov", {}, b"video a")
+            write_photo(temp_dir, "b.mov", {}, b"video b")
+            collect_exif_data.scan(temp_dir, False)
+            yield temp_dir
+
+    def load(self, dirpath):
+        with open(os.path.join(dirpath, exif.EXIF_FILE_NAME)) as fp:
+            return list(exif.load_exif_file(fp, dirpath))
+
+    def test_second_run_reads_nothing(self, scanned):
+        """Hashes calculated on the first run are loaded on the second instead of calculated again"""
+        metrics.get().reset()
+        with HashService(2) as service:
+            first = self.load(scanned)
+            service.hash_files(first)
+            assert metrics.get().counters["files_hashed"] == 2
+
+            second = self.load(scanned)
+            assert all(f.has_hash() for f in second)
+            service.hash_files(second)
+        assert metrics.get().counters["files_hashed"] == 2
+        assert [f.file_hash for f in second] == [f.file_hash for f in first]
+
+    def test_changed_file_is_not_saved(self, scanned):
+        """A file changed since it was scanned doesn't get its new hash stored against the old entry"""
+        with open(os.path.join(scanned, "a.mov"), "ab") as fp:
+            fp.write(b" edited")
+        with HashService(2) as service:
+            service.hash_files(self.load(scanned))
+
+        saved = {f.filename: f.has_hash() for f in self.load(scanned)}
+        assert saved == {"a.mov": False, "b.mov": True}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import pytest
+import hashlib
+import os
+import exif
+from exif import hashstore
+from exif.hashstore import HashStore
+
+
+def sha(i):
+    return hashlib.sha256(b"%d" % i).hexdigest()
+
+
+class TestHashStore:
+    """Test the binary hash store"""
+
+    def test_add_and_lookup(self, tmp):
+        """Added hashes are found before and after the store is reopened"""
+        with HashStore(tmp, batch_size=4) as store:
+            assert all(store.add(sha(i)) for i in range(10))
+            assert not store.add(sha(3))
+            assert sha(3) in store
+            assert sha(10) not in store
+
+        with HashStore(tmp) as store:
+            assert len(store) == 10
+            assert all(sha(i) in store for i in range(10))
+            assert not any(sha(i) in store for i in range(10, 1000))
+
+    def test_compaction(self, tmp):
+        """A large enough log is merged into the sorted digests on close"""
+        with HashStore(tmp, batch_size=4) as store:
+            for i in range(100):
+                store.add(sha(i))
+        assert os.path.getsize(os.path.join(tmp, hashstore.HASH_LOG_FILE)) == 0
+
+        with HashStore(tmp, batch_size=4) as store:
+            store.add(sha(100))
+            store.compact()
+            assert len(store) == 101
+            assert all(sha(i) in store for i in range(101))
+
+    def test_log_is_bounded(self, tmp):
+        """The log is merged during the run once it holds log_limit hashes"""
+        log_path = os.path.join(tmp, hashstore.HASH_LOG_FILE)
+        with HashStore(tmp, batch_size=4, log_limit=8) as store:
+            for i in range(50):
+                store.add(sha(i))
+                assert len(store._logged) < 8
+                assert os.path.getsize(log_path) < 8 * hashstore.DIGEST_SIZE
+            assert len(store) == 50
+            assert all(sha(i) in store for i in range(50))
+
+    def test_long_log_is_merged_on_open(self, tmp, monkeypatch):
+        """A log longer than log_limit, as left by a crash loop, is merged in sorted runs rather than loaded"""
+        monkeypatch.setattr(hashstore, "MIGRATE_CHUNK", 7)
+        with open(os.path.join(tmp, hashstore.HASH_LOG_FILE), "wb") as fp:
+            for i in list(range(40)) + [3]:
+                fp.write(bytes.fromhex(sha(i)))
+
+        with HashStore(tmp, batch_size=4, log_limit=8) as store:
+            assert store._logged == set()
+            assert os.path.getsize(store.log_path) == 0
+            assert len(store) == 40
+            assert all(sha(i) in store for i in range(40))
+
+    def test_log_survives_a_crash(self, tmp):
+        """Flushed batches are read back from the log, and a torn last digest is dropped"""
+        store = HashStore(tmp, batch_size=2)
+        store.add(sha(1))
+        store.add(sha(2))
+        store.add(sha(3))  # still pending when the process dies
+        with open(os.path.join(tmp, hashstore.HASH_LOG_FILE), "ab") as fp:
+            fp.write(b"\x01" * 5)
+
+        with HashStore(tmp) as reopened:
+            assert sha(1) in reopened and sha(2) in reopened
+            assert sha(3) not in reopened
+            assert len(reopened) == 2
+
+    def test_not_a_hash(self, tmp):
+        """Values that aren't SHA-256 hashes are never stored"""
+        with HashStore(tmp) as store:
+            assert None not in store
+            assert "abc" not in store
+            with pytest.raises(ValueError):
+                store.add("abc")
+
+    def test_migration(self, tmp, monkeypatch):
+        """file_hashes.txt is converted on first open, in sorted chunks"""
+        monkeypatch.setattr(hashstore, "MIGRATE_CHUNK", 7)
+        with open(os.path.join(tmp, exif.NOEXIF_HASH_FILE), "w") as fp:
+            for i in list(range(50)) + [3, 7]:
+                fp.write(sha(i) + "\n")
+            fp.write("\nnot a hash\n")
+
+        with HashStore(tmp) as store:
+            assert store.migrated == 50
+            assert len(store) == 50
+            assert all(sha(i) in store for i in range(50))
+
+        with HashStore(tmp) as store:
+            assert store.migrated == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
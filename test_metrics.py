@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import pytest
+import argparse
+import json
+import os
+import tempfile
+import exif
+from exif import cascade, exiftool, metrics, native
+
+
+@pytest.fixture
+def fresh():
+    metrics.get().reset()
+    yield metrics.get()
+    metrics.get().reset()
+
+
+class TestMetrics:
+    """Test the recording of phases, counters and histograms"""
+
+    def test_phases_and_counters(self, fresh):
+        """Each phase sums the calls made to it, and counters get a rate"""
+        for _ in range(3):
+            with metrics.phase("work"):
+                sum(range(1000))
+        metrics.count("files", 5)
+        metrics.count("files")
+
+        d = fresh.as_dict()
+        assert d["phases"]["work"]["calls"] == 3
+        assert d["phases"]["work"]["wall"] > 0
+        assert d["counters"] == {"files": 6}
+        assert d["rates"]["files_per_second"] > 0
+
+    def test_timed_iter(self, fresh):
+        """Only the time spent producing items counts, as one call"""
+        assert list(metrics.timed_iter("load", iter(range(5)))) == list(range(5))
+        assert fresh.as_dict()["phases"]["load"]["calls"] == 1
+
+    def test_histogram(self, fresh):
+        """Latencies fall into power-of-two buckets"""
+        for seconds in (0.0005, 0.003, 0.003, 100):
+            metrics.observe("exiftool", seconds)
+
+        h = fresh.as_dict()["histograms"]["exiftool"]
+        assert h["count"] == 4
+        assert h["min"] == 0.0005 and h["max"] == 100
+        assert h["buckets"] == {"<=1ms": 1, "<=4ms": 2, ">16384ms": 1}
+
+    def test_hashing_is_measured(self, fresh):
+        """calculate_file_hash reports the bytes it read"""
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"x" * 1000)
+            f.flush()
+            exif.calculate_file_hash(f.name)
+
+        d = fresh.as_dict()
+        assert d["counters"] == {"bytes_read": 1000, "files_hashed": 1}
+        assert d["phases"]["hash"]["calls"] == 1
+
+    def test_partial_and_native_reads_are_counted(self, fresh):
+        """Partial hashes and native header reads add to bytes_read too"""
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"x" * 1000)
+            f.flush()
+            cascade.partial_file_hash(f.name, 1000, edge=100)
+            assert fresh.counters["bytes_read"] == 200
+            with pytest.raises(native.Unsupported):
+                native.read_tags(f.name)
+            assert fresh.counters["bytes_read"] == 1200
+
+    def test_exiftool_json_is_timed(self, fresh):
+        """Parsing exiftool's streamed output counts as the json phase"""
+        lines = ["[{\n", '  "FileName": "a.jpg"\n', "},\n", '{"FileName": "b.jpg"\n', "}]\n"]
+        assert [r["FileName"] for r in exiftool.iter_records(lines)] == ["a.jpg", "b.jpg"]
+        assert fresh.as_dict()["phases"]["json"]["calls"] == 2
+
+
+class TestReporting:
+    """Test the --stats and --profile flags"""
+
+    def parse(self, *argv):
+        parser = argparse.ArgumentParser()
+        metrics.add_arguments(parser)
+        return parser.parse_args(argv)
+
+    def test_stats_json(self, fresh, capsys):
+        """--stats json prints the metrics to stderr"""
+        with metrics.reporting(self.parse("--stats", "json")):
+            metrics.count("files")
+
+        assert json.loads(capsys.readouterr().err)["counters"] == {"files": 1}
+
+    def test_profile(self, fresh, capsys):
+        """--profile writes pstats data and a readable summary"""
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "run.prof")
+            with metrics.reporting(self.parse("--profile", path)):
+                sorted(range(1000))
+
+            assert os.path.getsize(path) > 0
+            with open(path + ".txt") as fp:
+                assert "cumulative" in fp.read()
+        assert capsys.readouterr().err == ""
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import struct
+import collect_exif_data
+import exif
+import fake_exiftool
+from exif import native
+
+
+def ifd_bytes(entries, offset):
+    """A little-endian IFD starting at offset, followed by the values that don't fit in it"""
+    data_pos = offset + 2 + 12 * len(entries) + 4
+    head = struct.pack("<H", len(entries))
+    data = b""
+    for tag, value in sorted(entries):
+        if isinstance(value, list):
+            head += struct.pack("<HHII", tag, 4, 1, data_pos + len(data))
+            data += ifd_bytes(value, data_pos + len(data))
+            continue
+        if isinstance(value, str):
+            typ, raw = 2, value.encode() + b"\0"
+        elif isinstance(value, int):
+            typ, raw = 4, struct.pack("<I", value)
+        else:
+            typ, raw = 7, value
+        count = len(raw) if typ != 4 else 1
+        if len(raw) <= 4:
+            field = raw.ljust(4, b"\0")
+        else:
+            field = struct.pack("<I", data_pos + len(data))
+            data += raw
+        head += struct.pack("<HHI", tag, typ, count) + field
+    return head + b"\0\0\0\0" + data
+
+
+def tiff_bytes(entries):
+    return b"II*\0" + struct.pack("<I", 8) + ifd_bytes(entries, 8)
+
+
+def exif_tiff(make="Apple", timestamp="2023:04:05 06:07:08", exif_entries=(), ifd0_entries=()):
+    exif_ifd = [(native.TAG_DATE_TIME_ORIGINAL, timestamp)] + list(exif_entries)
+    return tiff_bytes([(native.TAG_MAKE, make), (native.TAG_EXIF_IFD, exif_ifd)] + list(ifd0_entries))
+
+
+def nikon_maker_note(serial_number="3012345", shutter_count=4321):
+    return b"Nikon\0\x02\x10\0\0" + tiff_bytes([(native.NIKON_SERIAL_NUMBER, serial_number),
+                                                 (native.NIKON_SHUTTER_COUNT, shutter_count)])
+
+
+def jpeg_bytes(tiff, width=4032, height=3024):
+    app1 = b"Exif\0\0" + tiff
+    sof = struct.pack(">BHHB", 8, height, width, 3) + b"\x01\x11\0\x02\x11\x01\x03\x11\x01"
+    return (b"\xff\xd8"
+            + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+            + b"\xff\xc0" + struct.pack(">H", len(sof) + 2) + sof
+            + b"\xff\xda\0\x02" + b"\0" * 100 + b"\xff\xd9")
+
+
+def box(box_type, payload):
+    return struct.pack(">I", len(payload) + 8) + box_type + payload
+
+
+def full_box(box_type, payload, version=0, flags=0):
+    return box(box_type, struct.pack(">I", version << 24 | flags) + payload)
+
+
+def heic_bytes(tiff, width=4032, height=3024):
+    exif_item = struct.pack(">I", 6) + b"Exif\0\0" + tiff
+
+    def meta(exif_offset):
+        infe = [full_box(b"infe", struct.pack(">HH", 1, 0) + b"hvc1", version=2),
+                full_box(b"infe", struct.pack(">HH", 2, 0) + b"Exif", version=2)]
+        iloc = full_box(b"iloc", bytes([0x44, 0x00]) + struct.pack(">H", 1)
+                        + struct.pack(">HHHII", 2, 0, 1, exif_offset, len(exif_item)))
+        ipco = box(b"ipco", full_box(b"ispe", struct.pack(">II", width, height)))
+        ipma = full_box(b"ipma", struct.pack(">IHB", 1, 1, 1) + bytes([0x81]))
+        return full_box(b"meta", full_box(b"hdlr", b"\0" * 20)
+                        + full_box(b"pitm", struct.pack(">H", 1))
+                        + full_box(b"iinf", struct.pack(">H", len(infe)) + b"".join(infe))
+                        + iloc
+                        + box(b"iprp", ipco + ipma))
+
+    ftyp = box(b"ftyp", b"heic\0\0\0\0mif1heic")
+    head = ftyp + meta(0)
+    return ftyp + meta(len(head) + 8) + box(b"mdat", exif_item)
+
+
+def write(dirpath, name, content):
+    path = os.path.join(dirpath, name)
+    with open(path, "wb") as fp:
+        fp.write(content)
+    return path
+
+
+class TestReadTags:
+    """Test the records read from file headers"""
+
+    def test_jpeg(self, tmp):
+        """A JPEG is sized by its SOF marker"""
+        content = jpeg_bytes(exif_tiff())
+        tags = native.read_tags(write(tmp, "IMG_1.JPG", content))
+        assert tags == {
+            "FileName": "IMG_1.JPG",
+            "FileSize": "%d bytes" % len(content),
+            "DateTimeOriginal": "2023:04:05 06:07:08",
+            "Make": "Apple",
+            "ImageSize": "4032x3024",
+        }
+
+    def test_nikon_jpeg(self, tmp):
+        """Nikon maker notes provide the serial number and shutter count"""
+        tiff = exif_tiff("NIKON CORPORATION", exif_entries=[(native.TAG_MAKER_NOTE, nikon_maker_note())])
+        tags = native.read_tags(write(tmp, "DSC_1.JPG", jpeg_bytes(tiff)))
+        assert tags["ShutterCount"] == 4321
+        assert tags["SerialNumber"] == 3012345
+
+    def test_nef(self, tmp):
+        """A NEF is sized by its full-resolution image, not the IFD0 thumbnail"""
+        raw = [(native.TAG_SUBFILE_TYPE, 0), (native.TAG_IMAGE_WIDTH, 6048), (native.TAG_IMAGE_HEIGHT, 4024)]
+        tiff = exif_tiff("NIKON CORPORATION",
+                         exif_entries=[(native.TAG_MAKER_NOTE, nikon_maker_note("0012345", 99))],
+                         ifd0_entries=[(native.TAG_SUBFILE_TYPE, 1), (native.TAG_IMAGE_WIDTH, 160),
+                                       (native.TAG_IMAGE_HEIGHT, 120), (native.TAG_SUB_IFDS, raw)])
+        tags = native.read_tags(write(tmp, "DSC_1.NEF", tiff + b"\0" * 100000))
+        assert tags["ImageSize"] == "6048x4024"
+        assert tags["SerialNumber"] == "0012345"
+        assert tags["ShutterCount"] == 99
+        assert tags["FileSize"] == "100 kB"
+
+    def test_heic(self, tmp):
+        """A HEIC has its EXIF in an item and its size in the primary item's ispe property"""
+        tags = native.read_tags(write(tmp, "IMG_1.HEIC", heic_bytes(exif_tiff(), 4032, 3024)))
+        assert tags["DateTimeOriginal"] == "2023:04:05 06:07:08"
+        assert tags["Make"] == "Apple"
+        assert tags["ImageSize"] == "4032x3024"
+
+    @pytest.mark.parametrize("content", [
+        jpeg_bytes(exif_tiff(make="Canon")),
+        jpeg_bytes(exif_tiff(exif_entries=[(native.TAG_SERIAL_NUMBER, "")])),
+        jpeg_bytes(exif_tiff("NIKON CORPORATION", exif_entries=[(native.TAG_SERIAL_NUMBER, "1"),
+                                                                 (native.TAG_MAKER_NOTE, nikon_maker_note("2"))])),
+        jpeg_bytes(exif_tiff())[:60],
+        b"\xff\xd8\xff\xc0",
+        b'{"DateTimeOriginal": "2023:01:01 00:00:00"}\n',
+        b"",
+    ], ids=["make", "empty", "conflict", "truncated", "no-length", "not-an-image", "empty-file"])
+    def test_unsupported(self, tmp, content):
+        """Other makes, ambiguous values and broken files are left to exiftool"""
+        with pytest.raises(native.Unsupported):
+            native.read_tags(write(tmp, "a.jpg", content))
+
+    @pytest.mark.parametrize("size", [0, 1999, 2000, 9999, 10000, 1999999, 2000000, 9999999, 10 ** 8, 5 * 10 ** 9, 10 ** 11])
+    def test_file_size_format(self, size):
+        """FileSize is formatted the way exiftool formats it"""
+        assert native.format_file_size(size) == fake_exiftool.format_file_size(size)
+
+
+class TestNativeScan:
+    """Test scanning with the native reader"""
+
+    def test_falls_back_to_exiftool(self, tmp, fake_pool, write_photo):
+        """Files the reader can't handle are passed to exiftool"""
+        write(tmp, "IMG_1.jpg", jpeg_bytes(exif_tiff()))
+        write_photo(tmp, "IMG_2.jpg", {"DateTimeOriginal": "2023:01:01 00:00:00", "Make": "Canon"})
+        write_photo(tmp, "clip.mov", {})
+
+        entries = {e.filename: e for e in collect_exif_data.scan_dir(tmp, os.listdir(tmp), use_native=True)}
+        assert entries["IMG_1.jpg"].timestamp == "2023:04:05 06:07:08"
+        assert entries["IMG_1.jpg"].dimensions == "4032x3024"
+        assert entries["IMG_2.jpg"].make == "Canon"
+        assert isinstance(entries["clip.mov"], exif.NoExifFile)
+
+    def test_same_exif_data_as_exiftool(self, tmp, fake_pool):
+        """A record from the reader round-trips through .exif_data like an exiftool record"""
+        path = write(tmp, "IMG_1.jpg", jpeg_bytes(exif_tiff()))
+        entry = exif.from_exif_entry(native.read_tags(path), tmp)
+        assert entry.as_dict() == {
+            "FileName": "IMG_1.jpg",
+            "Dirpath": tmp,
+            "DateTimeOriginal": "2023:04:05 06:07:08",
+            "ShutterCount": "None",
+            "SerialNumber": "None",
+            "Make": "Apple",
+            "FileSize": "%d bytes" % os.path.getsize(path),
+            "ImageSize": "4032x3024",
+        }
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
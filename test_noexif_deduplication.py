@@ -24,6 +24,16 @@ class TestNoExifFile:
         assert noexif.file_hash == "abc123def456"
         assert noexif.size == "10485760"
 
+    def test_failed_hash_is_not_retried(self, capsys):
+        """A file that can't be read is hashed once, and reported once"""
+        noexif = exif.NoExifFile(filename="gone.mov", dirpath="/nonexistent", file_hash=None)
+
+        assert noexif.file_hash is None
+        assert noexif.file_hash is None
+        assert noexif.has_hash()
+        assert capsys.readouterr().out.count("Error calculating hash") == 1
+        assert "FileHash" not in noexif.as_dict()
+
     def test_path_method(self):
         """Test the path() method"""
         noexif = exif.NoExifFile(
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import random
+from exif import phash
+from exif.hashing import HashService
+
+
+class TestClusters:
+    """Test near-duplicate clustering of hashes"""
+
+    def test_search_matches_brute_force(self):
+        """A BK-tree search finds exactly the hashes within the radius"""
+        rng = random.Random(1)
+        base = [rng.getrandbits(64) for _ in range(20)]
+        values = [b ^ (1 << rng.randrange(64)) * rng.randrange(2) for b in base for _ in range(10)]
+
+        tree = phash.BKTree()
+        for i, value in enumerate(values):
+            tree.add(value, i)
+
+        for radius in (0, 3, 10):
+            for value in values[::17]:
+                expected = [i for i, v in enumerate(values) if phash.hamming(v, value) <= radius]
+                assert sorted(tree.search(value, radius)) == expected
+
+    def test_clusters_are_transitive(self):
+        """Hashes chained within the distance end up in one cluster, in input order"""
+        hashed = [("c", 0b0111), ("x", 0xff00), ("a", 0b0000), ("b", 0b0011), ("y", 0xff01), ("z", 0xf0f0)]
+        assert phash.clusters(hashed, 2) == [["c", "a", "b"], ["x", "y"]]
+        assert phash.clusters(hashed, 0) == []
+
+
+class TestImageHashes:
+    """Test hashing of image files"""
+
+    @pytest.fixture(autouse=True)
+    def pillow(self):
+        pytest.importorskip("numpy")
+        pytest.importorskip("PIL")
+
+    def photo(self, seed=0, size=(256, 192)):
+        from PIL import Image, ImageFilter
+        rng = random.Random(seed)
+        img = Image.new("RGB", (32, 24))
+        img.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(32 * 24)])
+        return img.resize(size, Image.BILINEAR).filter(ImageFilter.GaussianBlur(4))
+
+    def test_resized_copy_is_similar(self, tmp):
+        """A smaller re-encoded copy stays within the distance, another picture doesn't"""
+        original = os.path.join(tmp, "a.jpg")
+        self.photo().save(original, quality=95)
+        copy = os.path.join(tmp, "b.jpg")
+        self.photo().resize((128, 96)).save(copy, quality=60)
+        other = os.path.join(tmp, "c.jpg")
+        self.photo(seed=1).save(other)
+
+        assert phash.hamming(phash.dhash(original), phash.dhash(copy)) <= phash.DEFAULT_MAX_DISTANCE
+        assert phash.hamming(phash.dhash(original), phash.dhash(other)) > phash.DEFAULT_MAX_DISTANCE
+
+    def test_undecodable(self, tmp):
+        """Files that aren't images hash to None"""
+        path = os.path.join(tmp, "a.jpg")
+        with open(path, "wb") as fp:
+            fp.write(b"not a jpeg")
+        assert phash.dhash(path) is None
+
+    def test_folder_hashes_are_cached(self, tmp, monkeypatch):
+        """Only new or changed images are decoded again"""
+        self.photo().save(os.path.join(tmp, "a.jpg"))
+        self.photo(seed=1).save(os.path.join(tmp, "b.jpg"))
+        names = ["a.jpg", "b.jpg", "clip.mov"]
+
+        with HashService() as service:
+            first = phash.folder_hashes(tmp, names, service)
+            assert list(first) == ["a.jpg", "b.jpg"]
+            assert os.path.exists(os.path.join(tmp, phash.PHASH_FILE_NAME))
+
+            decoded = []
+            dhash = phash.dhash
+            monkeypatch.setattr(phash, "dhash", lambda path: decoded.append(path) or dhash(path))
+            assert phash.folder_hashes(tmp, names, service) == first
+            assert decoded == []
+
+            self.photo(seed=2).save(os.path.join(tmp, "b.jpg"))
+            os.utime(os.path.join(tmp, "b.jpg"), ns=(1, 1))
+            second = phash.folder_hashes(tmp, names, service)
+            assert decoded == [os.path.join(tmp, "b.jpg")]
+            assert second["a.jpg"] == first["a.jpg"]
+            assert second["b.jpg"] != first["b.jpg"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
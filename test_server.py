@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import shutil
+import tempfile
+import threading
+import collect_exif_data
+from exif import server
+from exif.hashing import HashService
+
+TAGS = {"DateTimeOriginal": "2023:01:01 12:00:00", "Make": "Canon"}
+
+
+@pytest.fixture
+def library(fake_pool, write_photo):
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, "lib"))
+        os.mkdir(os.path.join(root, "uploads"))
+        write_photo(os.path.join(root, "lib"), "a.jpg", TAGS)
+        write_photo(os.path.join(root, "lib"), "clip.mov", {}, b"video")
+        collect_exif_data.scan(os.path.join(root, "lib"), False)
+        yield root
+
+
+@pytest.fixture
+def client(library):
+    with HashService() as service:
+        index = server.Index.build(server.load_tree(os.path.join(library, "lib")), service)
+    srv = server.Server(os.path.join(library, "sock"), index)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with server.Client(os.path.join(library, "sock")) as c:
+            yield c
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+class TestServer:
+    """Test lookups against a running server"""
+
+    def test_lookup_paths(self, library, client, write_photo):
+        """Uploads are matched by their EXIF key or, without one, by content hash"""
+        uploads = os.path.join(library, "uploads")
+        write_photo(uploads, "a.jpg", TAGS)
+        shutil.copy(os.path.join(library, "lib", "clip.mov"), os.path.join(uploads, "copy.mov"))
+        write_photo(uploads, "new.jpg", dict(TAGS, DateTimeOriginal="2024:01:01 00:00:00"))
+        write_photo(uploads, "new.mov", {}, b"other video")
+
+        results = client.lookup_paths([os.path.join(uploads, n) for n in ("a.jpg", "copy.mov", "new.jpg", "new.mov")])
+        assert [r["duplicate"] for r in results] == [True, True, False, False]
+        assert results[0]["matches"] == [os.path.join(library, "lib", "a.jpg")]
+        assert results[1]["matches"] == [os.path.join(library, "lib", "clip.mov")]
+
+    def test_lookup_metadata_and_hash(self, library, client):
+        """Metadata and hashes are looked up without reading any file"""
+        record = dict(TAGS, FileName="IMG_1.jpg", FileSize="%d bytes" % os.path.getsize(
+            os.path.join(library, "lib", "a.jpg")))
+        video_hash = server.exif.calculate_file_hash(os.path.join(library, "lib", "clip.mov"))
+
+        results = client.lookup([{"metadata": record}, {"hash": video_hash}, {"hash": "0" * 64}])
+        assert [r["duplicate"] for r in results] == [True, True, False]
+
+    def test_errors(self, library, client):
+        """Lookups that can't be answered get an error, without failing the rest of the batch"""
+        results = client.lookup([{"metadata": {"FileName": "a.mov"}}, {"path": "/does/not/exist.jpg"}, {},
+                                 {"hash": "0" * 64}])
+        assert all("error" in r for r in results[:3])
+        assert results[3] == {"duplicate": False, "matches": []}
+
+        with pytest.raises(ValueError):
+            client.lookup("not a list")
+
+    def test_exiftool_fallback_matches_scan(self, library, fake_pool, monkeypatch, write_photo):
+        """Paths exif.native can't read go through the scan's exiftool commands, and exiftool errors are reported"""
+        uploads = os.path.join(library, "uploads")
+        write_photo(uploads, "a.jpg", TAGS)
+        write_photo(uploads, "a.mov", {}, b"video")
+        calls = []
+        execute_iter = fake_pool.execute_iter
+
+        def recording_execute_iter(*args):
+            calls.append(args)
+            for record in execute_iter(*args):
+                if record["SourceFile"].endswith(".mov"):
+                    record = {"SourceFile": record["SourceFile"], "Error": "File format error"}
+                yield record
+
+        monkeypatch.setattr(fake_pool, "execute_iter", recording_execute_iter)
+        paths = [os.path.join(uploads, "a.jpg"), os.path.join(uploads, "a.mov")]
+        entries, errors = server.read_entries(paths)
+        assert list(entries) == paths[:1]
+        assert errors == {paths[1]: "File format error"}
+        assert [args[:2] for args in calls] == [("-j", "-fast"), ("-j", "-fast2")]
+        assert all("-DateTimeOriginal" in args for args in calls)
+
+        results = server.answer(server.Index(), [{"path": p} for p in paths])
+        assert results[1] == {"error": "Can't read %s: File format error" % paths[1]}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
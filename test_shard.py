@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import sys
+import tempfile
+import collect_exif_data
+import deduplicate
+from exif import shard
+from exif.hashing import HashService
+from exif.walk import load_tree
+
+TAGS = {"DateTimeOriginal": "2023:01:01 12:00:00", "Make": "Canon"}
+
+
+@pytest.fixture
+def nodes(fake_pool, write_photo):
+    """Two folders standing in for storage nodes, with a photo and a video on both"""
+    with tempfile.TemporaryDirectory() as root:
+        for name in ("nas1", "nas2"):
+            os.makedirs(os.path.join(root, name, "photos"))
+        write_photo(os.path.join(root, "nas1", "photos"), "a.jpg", TAGS)
+        write_photo(os.path.join(root, "nas1", "photos"), "clip.mov", {}, b"video")
+        write_photo(os.path.join(root, "nas2", "photos"), "copy.jpg", TAGS)
+        write_photo(os.path.join(root, "nas2", "photos"), "copy.mov", {}, b"video")
+        write_photo(os.path.join(root, "nas2", "photos"), "b.jpg", dict(TAGS, DateTimeOriginal="2024:02:02 10:00:00"))
+        write_photo(os.path.join(root, "nas2", "photos"), "other.mov", {}, b"other video")
+        for name in ("nas1", "nas2"):
+            collect_exif_data.scan(os.path.join(root, name), False)
+        yield root
+
+
+def scan_nodes(root, names=("nas1", "nas2")):
+    paths = []
+    with HashService() as service:
+        for name in names:
+            path = os.path.join(root, name + ".manifest")
+            shard.write_manifest(path, os.path.join(root, name), load_tree(os.path.join(root, name)), name, service)
+            paths.append(path)
+    return paths
+
+
+def make_plan(root, paths):
+    manifests = [shard.Manifest(p) for p in paths]
+    duplicates = []
+    try:
+        counts = shard.write_plan(os.path.join(root, "plan"), manifests, duplicates.append)
+    finally:
+        for m in manifests:
+            m.close()
+    return counts, duplicates
+
+
+class TestManifest:
+    """Test writing and reading node manifests"""
+
+    def test_sorted_by_key(self, nodes):
+        """A manifest lists every entry of the node in key order, with paths relative to its root"""
+        path, = scan_nodes(nodes, ["nas2"])
+        with shard.Manifest(path) as manifest:
+            assert manifest.node == "nas2"
+            assert manifest.count == 4
+            items = list(manifest)
+
+        keys = [key for key, _ in items]
+        assert keys == sorted(keys)
+        assert sum(key.startswith("hash:") for key in keys) == 2
+        assert {e.path() for _, e in items} == {os.path.join(nodes, "nas2", "photos", n)
+                                                for n in ("copy.jpg", "copy.mov", "b.jpg", "other.mov")}
+
+    def test_not_a_manifest(self, nodes):
+        """Anything else is refused"""
+        path = os.path.join(nodes, "plan")
+        with open(path, "w") as fp:
+            fp.write("{}\n")
+        with pytest.raises((ValueError, OSError)):
+            shard.Manifest(path)
+
+
+class TestMerge:
+    """Test merging manifests into a plan"""
+
+    def test_cross_node_duplicates(self, nodes):
+        """Copies on different nodes are found, and only the first manifest's copy is placed"""
+        (placed, skipped), duplicates = make_plan(nodes, scan_nodes(nodes))
+        assert (placed, skipped) == (4, 2)
+        assert sorted([node for node, _ in group] for group in duplicates) == [["nas1", "nas2"], ["nas1", "nas2"]]
+
+        nas1_root, nas1 = shard.read_plan(os.path.join(nodes, "plan"), "nas1")
+        assert nas1_root == os.path.join(nodes, "nas1")
+        assert sorted(e.filename for e in nas1) == ["a.jpg", "clip.mov"]
+        _, nas2 = shard.read_plan(os.path.join(nodes, "plan"), "nas2")
+        assert sorted(e.filename for e in nas2) == ["b.jpg", "other.mov"]
+        assert all(e.has_hash() for e in nas2 if e.filename.endswith(".mov"))
+
+    def test_order_decides_copy_kept(self, nodes):
+        """Giving nas2 first keeps its copies instead"""
+        (placed, skipped), _ = make_plan(nodes, scan_nodes(nodes, ["nas2", "nas1"]))
+        assert (placed, skipped) == (4, 2)
+        _, nas1 = shard.read_plan(os.path.join(nodes, "plan"), "nas1")
+        assert nas1 == []
+
+    def test_same_node_twice(self, nodes):
+        """Two manifests of one node can't be merged"""
+        path, = scan_nodes(nodes, ["nas1"])
+        with pytest.raises(ValueError):
+            make_plan(nodes, [path, path])
+
+    def test_unknown_node(self, nodes):
+        """Reading a plan for a node it doesn't have is an error"""
+        make_plan(nodes, scan_nodes(nodes))
+        with pytest.raises(ValueError):
+            shard.read_plan(os.path.join(nodes, "plan"), "nas3")
+
+
+class TestApplyPlan:
+    """Test placing a plan with deduplicate, one node after the other"""
+
+    def test_apply(self, nodes, monkeypatch):
+        """Each node places its share, and the target ends up with one copy of everything"""
+        make_plan(nodes, scan_nodes(nodes))
+        target = os.path.join(nodes, "target")
+        for name in ("nas1", "nas2"):
+            monkeypatch.setattr(sys, "argv", ["deduplicate.py", "--plan", os.path.join(nodes, "plan"),
+                                              "--node", name, target])
+            deduplicate.main()
+
+        placed = []
+        for dirpath, _, filenames in os.walk(target):
+            placed.extend(os.path.relpath(os.path.join(dirpath, f), target) for f in filenames
+                          if f.endswith((".jpg", ".mov")))
+        assert sorted(placed) == sorted([
+            os.path.join("2023", "01", "01", "12-00-00-Canon.jpg"),
+            os.path.join("2024", "02", "02", "10-00-00-Canon.jpg"),
+            os.path.join("noexif", "photos", "clip.mov"),
+            os.path.join("noexif", "photos", "other.mov"),
+        ])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
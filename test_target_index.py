@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import tempfile
+from exif.target_index import TargetIndex
+
+
+@pytest.fixture
+def target():
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(os.path.join(d, "2023", "01", "01"))
+        open(os.path.join(d, "2023", "01", "01", "a.jpg"), "w").close()
+        open(os.path.join(d, "top.txt"), "w").close()
+        yield d
+
+
+class TestTargetIndex:
+    """Test the disk-backed view of the target tree"""
+
+    def test_scan(self, target):
+        """Every file and folder below the root is listed"""
+        index = TargetIndex.scan(target)
+        assert index.exists(os.path.join(target, "2023", "01", "01", "a.jpg"))
+        assert index.exists(os.path.join(target, "2023", "01"))
+        assert index.exists(os.path.join(target, "top.txt"))
+        assert index.exists(target)
+        assert not index.exists(os.path.join(target, "2023", "01", "01", "b.jpg"))
+
+    def test_makedirs_records_parents(self, target):
+        """makedirs creates the folder and remembers it and its parents"""
+        index = TargetIndex.scan(target)
+        path = os.path.join(target, "2024", "02", "03")
+        index.makedirs(path)
+        assert os.path.isdir(path)
+        assert index.exists(path)
+        assert index.exists(os.path.join(target, "2024"))
+
+    def test_makedirs_skips_known_folders(self, target):
+        """A folder already in the index isn't checked on disk again"""
+        index = TargetIndex(target, dirs=["known"])
+        index.makedirs(os.path.join(target, "known"))
+        assert not os.path.exists(os.path.join(target, "known"))
+
+    def test_add_and_discard(self, target):
+        """Placed files are recorded, and can be forgotten again"""
+        index = TargetIndex.scan(target)
+        path = os.path.join(target, "new.jpg")
+        index.add(path)
+        assert index.exists(path)
+        index.discard(path)
+        assert not index.exists(path)
+
+    def test_manifest_round_trip(self, target):
+        """A saved manifest loads into the same index"""
+        index = TargetIndex.scan(target)
+        index.add(os.path.join(target, "2023", "b.jpg"))
+        manifest = os.path.join(target, "manifest")
+        index.save(manifest)
+
+        loaded = TargetIndex.load(target, manifest)
+        assert loaded.files() == index.files()
+        assert loaded.dirs() == index.dirs()
+        assert "2023/b.jpg" in loaded.files()
+
+    def test_undecodable_names(self, target):
+        """Names that aren't valid UTF-8 are indexed and saved as they are"""
+        name = os.fsdecode(b"caf\xe9.jpg")
+        open(os.path.join(target, name), "w").close()
+        index = TargetIndex.scan(target)
+        assert index.exists(os.path.join(target, name))
+        manifest = os.path.join(target, "manifest")
+        index.save(manifest)
+        assert name in TargetIndex.load(target, manifest).files()
+
+    def test_database_in_tmp_dir(self, target):
+        """The paths live in a database below tmp_dir, which close() removes, and never in the target"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index = TargetIndex.scan(target, tmp_dir)
+            assert len(os.listdir(tmp_dir)) == 1
+            assert sorted(os.listdir(target)) == ["2023", "top.txt"]
+            index.close()
+            assert os.listdir(tmp_dir) == []
+
+    def test_missing_manifest_scans(self, target):
+        """Without a manifest the target is listed"""
+        index = TargetIndex.load(target, os.path.join(target, "missing"))
+        assert index.exists(os.path.join(target, "top.txt"))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+from exif import transfer
+
+
+def write(path, content=b"photo data"):
+    with open(path, "wb") as fp:
+        fp.write(content)
+    return path
+
+
+def read(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+class TestTransferFile:
+    """Test the individual transfer strategies"""
+
+    @pytest.mark.parametrize("mode", ["copy", "reflink", "hardlink"])
+    def test_source_is_kept(self, tmp, mode):
+        """copy, reflink and hardlink leave the source in place"""
+        src = write(os.path.join(tmp, "a.jpg"), b"x" * 100000)
+        dst = os.path.join(tmp, "b.jpg")
+        assert transfer.transfer_file(src, dst, mode) == 100000
+        assert read(dst) == read(src)
+
+    def test_hardlink_shares_inode(self, tmp):
+        """hardlink gives the source a second name"""
+        src = write(os.path.join(tmp, "a.jpg"))
+        dst = os.path.join(tmp, "b.jpg")
+        transfer.transfer_file(src, dst, "hardlink")
+        assert os.stat(src).st_ino == os.stat(dst).st_ino
+
+    def test_move(self, tmp):
+        """move removes the source"""
+        src = write(os.path.join(tmp, "a.jpg"))
+        dst = os.path.join(tmp, "b.jpg")
+        transfer.transfer_file(src, dst, "move")
+        assert not os.path.exists(src)
+        assert read(dst) == b"photo data"
+
+    @pytest.mark.parametrize("mode", transfer.MODES)
+    def test_existing_destination(self, tmp, mode):
+        """An existing destination raises FileExistsError and neither file is touched"""
+        src = write(os.path.join(tmp, "a.jpg"))
+        dst = write(os.path.join(tmp, "b.jpg"), b"old")
+        with pytest.raises(FileExistsError):
+            transfer.transfer_file(src, dst, mode)
+        assert read(src) == b"photo data"
+        assert read(dst) == b"old"
+
+    @pytest.mark.parametrize("error", ["EXDEV", "EMLINK"])
+    def test_link_falls_back_to_copy(self, tmp, monkeypatch, error):
+        """hardlink copies when linking isn't possible, e.g. across filesystems or past the link limit"""
+        import errno
+
+        def unlinkable(src, dst):
+            raise OSError(getattr(errno, error), os.strerror(getattr(errno, error)))
+        monkeypatch.setattr(os, "link", unlinkable)
+
+        src = write(os.path.join(tmp, "a.jpg"))
+        dst = os.path.join(tmp, "b.jpg")
+        transfer.transfer_file(src, dst, "hardlink")
+        assert read(dst) == b"photo data"
+        assert os.stat(src).st_ino != os.stat(dst).st_ino
+
+    def test_failed_copy_leaves_no_file(self, tmp):
+        """A copy that fails halfway removes the partial destination"""
+        dst = os.path.join(tmp, "b.jpg")
+        with pytest.raises(FileNotFoundError):
+            transfer.transfer_file(os.path.join(tmp, "missing.jpg"), dst)
+        assert not os.path.exists(dst)
+
+
+class TestTransferrer:
+    """Test the transfer worker pool"""
+
+    def test_counts_files_and_bytes(self, tmp):
+        """Completed transfers feed the counters and the report"""
+        with transfer.Transferrer("copy", 4) as t:
+            futures = [t.submit(write(os.path.join(tmp, "%d" % i), b"x" * i), os.path.join(tmp, "%d.copy" % i))
+                       for i in range(1, 11)]
+        assert [f.result() for f in futures] == list(range(1, 11))
+        assert t.files == 10
+        assert t.bytes == 55
+        assert "10 files" in t.report()
+
+    def test_errors_are_reported_through_future(self, tmp):
+        """A failed transfer raises from its Future and isn't counted"""
+        src = write(os.path.join(tmp, "a.jpg"))
+        with transfer.Transferrer() as t:
+            future = t.submit(src, src)
+        with pytest.raises(FileExistsError):
+            future.result()
+        assert t.files == 0
+
+    def test_unknown_mode(self):
+        """Only the known strategies are accepted"""
+        with pytest.raises(ValueError):
+            transfer.Transferrer("symlink")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import tempfile
+import exif
+from exif.walk import walk
+
+
+def touch(*parts):
+    path = os.path.join(*parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+
+@pytest.fixture
+def tree():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        touch(temp_dir, "a", "1.jpg")
+        touch(temp_dir, "a", "b", "2.jpg")
+        touch(temp_dir, "c", "3.jpg")
+        touch(temp_dir, "ignored", exif.EXIF_IGNORE_NAME)
+        touch(temp_dir, "ignored", "child", "4.jpg")
+        touch(temp_dir, "ignoredsibling", "5.jpg")
+        touch(temp_dir, "Thumbnails", "6.jpg")
+        touch(temp_dir, "Lightroom Previews.lrdata", "0", "7.jpg")
+        yield temp_dir
+
+
+def relative(top, walked):
+    return [(os.path.relpath(dirpath, top), sorted(f.name for f in files)) for dirpath, files in walked]
+
+
+class TestWalk:
+    """Test the pruning directory walker"""
+
+    def test_same_order_as_os_walk(self, tree):
+        """Folders come out top-down in the same order as os.walk"""
+        expected = [os.path.relpath(dirpath, tree) for dirpath, _, _ in os.walk(tree)
+                    if "ignored" + os.sep not in dirpath + os.sep and "thumb" not in dirpath.lower()
+                    and "preview" not in dirpath.lower()]
+        assert [d for d, _ in relative(tree, walk(tree))] == expected
+
+    def test_prunes_ignored_trees(self, tree):
+        """A folder with .exif_ignore and everything below it is skipped"""
+        dirs = dict(relative(tree, walk(tree)))
+        assert "ignored" not in dirs
+        assert os.path.join("ignored", "child") not in dirs
+        assert dirs["ignoredsibling"] == ["5.jpg"]
+
+    def test_prunes_thumb_and_preview_trees(self, tree):
+        """Thumbnail and preview caches are never listed"""
+        dirs = dict(relative(tree, walk(tree)))
+        assert "Thumbnails" not in dirs
+        assert not any("Previews" in d for d in dirs)
+
+    def test_pruned_root(self, tree):
+        """Walking a preview folder itself yields nothing"""
+        assert list(walk(os.path.join(tree, "Lightroom Previews.lrdata"))) == []
+
+    def test_files_are_dir_entries(self, tree):
+        """Files come back as DirEntry objects with usable stat data"""
+        files = dict(walk(tree))[os.path.join(tree, "a")]
+        assert [f.name for f in files] == ["1.jpg"]
+        assert files[0].stat().st_size == 0
+
+    def test_missing_root(self):
+        """A root that can't be listed yields nothing"""
+        assert list(walk("/nonexistent/photos")) == []
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
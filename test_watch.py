@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import pytest
+import os
+import struct
+import exif
+from exif import inotify
+from exif.watch import Watcher, Library
+
+
+def entry(dirpath, name, timestamp="2023:01:01 12:00:00"):
+    return exif.ExifEntry(filename=name, dirpath=dirpath, timestamp=timestamp, make="Apple",
+                          shutter_count="None", serial_number="None")
+
+
+class TestLibrary:
+    """Test the in-memory index of a watched library"""
+
+    def test_update_returns_new_and_changed(self):
+        """Only entries that are new or differ from before are returned"""
+        library = Library()
+        assert len(library.update("/a", [entry("/a", "1.jpg"), entry("/a", "2.jpg")])) == 2
+        added = library.update("/a", [entry("/a", "1.jpg"), entry("/a", "2.jpg", "2024:01:01 00:00:00")])
+        assert [e.filename for e in added] == ["2.jpg"]
+        assert len(library) == 2
+
+    def test_duplicates(self):
+        """Entries with the same key are found across folders, and forgotten with their folder"""
+        library = Library()
+        library.update("/a", [entry("/a", "1.jpg")])
+        library.update("/b", [entry("/b", "1.jpg")])
+        assert library.duplicates_of(entry("/b", "1.jpg")) == [os.path.join("/a", "1.jpg")]
+
+        library.forget("/a")
+        assert library.duplicates_of(entry("/b", "1.jpg")) == []
+
+
+class TestInotify:
+    """Test the inotify binding and the watcher"""
+
+    @pytest.fixture(autouse=True)
+    def need_inotify(self):
+        if not inotify.available():
+            pytest.skip("no inotify")
+
+    def test_parse_events(self):
+        """Events are unpacked with their NUL-padded names"""
+        data = struct.pack("iIII", 1, inotify.IN_CLOSE_WRITE, 0, 8) + b"a.jpg\0\0\0"
+        data += struct.pack("iIII", 2, inotify.IN_IGNORED, 0, 0)
+        assert inotify.parse_events(data) == [inotify.Event(1, inotify.IN_CLOSE_WRITE, 0, "a.jpg"),
+                                              inotify.Event(2, inotify.IN_IGNORED, 0, "")]
+
+    def test_batches(self, tmp):
+        """Changed folders are listed for rescanning, new ones are watched and deleted ones forgotten"""
+        os.mkdir(os.path.join(tmp, "a"))
+        os.mkdir(os.path.join(tmp, "gone"))
+        with Watcher(tmp, lambda name: name.endswith(".jpg"), settle=0.1) as watcher:
+            assert sorted(d for d, _ in watcher.watch_tree(tmp)) == sorted(
+                [tmp, os.path.join(tmp, "a"), os.path.join(tmp, "gone")])
+            batches = watcher.batches()
+
+            open(os.path.join(tmp, "a", "1.jpg"), "w").close()
+            open(os.path.join(tmp, "a", ".exif_data"), "w").close()
+            os.makedirs(os.path.join(tmp, "new", "sub"))
+            os.rmdir(os.path.join(tmp, "gone"))
+
+            changed, removed = next(batches)
+            assert sorted(changed) == sorted(
+                [os.path.join(tmp, "a"), os.path.join(tmp, "new"), os.path.join(tmp, "new", "sub")])
+            assert sorted(f.name for f in changed[os.path.join(tmp, "a")]) == [".exif_data", "1.jpg"]
+            assert removed == [os.path.join(tmp, "gone")]
+            assert os.path.join(tmp, "new", "sub") in watcher.wds
+
+            # changes to files that aren't relevant don't make a batch
+            open(os.path.join(tmp, "a", ".exif_stat"), "w").close()
+            open(os.path.join(tmp, "a", "2.jpg"), "w").close()
+            changed, removed = next(batches)
+            assert list(changed) == [os.path.join(tmp, "a")]
+
+    def test_watched_before_listed(self, tmp, monkeypatch):
+        """A file created while a folder is being listed still makes a batch"""
+        import contextlib
+        os.mkdir(os.path.join(tmp, "a"))
+        scandir = os.scandir
+
+        def late_scandir(path):
+            with scandir(path) as it:
+                entries = list(it)
+            if path == os.path.join(tmp, "a"):
+                open(os.path.join(path, "late.jpg"), "w").close()
+            return contextlib.nullcontext(iter(entries))
+
+        with Watcher(tmp, lambda name: name.endswith(".jpg"), settle=0.1) as watcher:
+            monkeypatch.setattr(os, "scandir", late_scandir)
+            listed = dict(watcher.watch_tree(tmp))
+            monkeypatch.setattr(os, "scandir", scandir)
+            assert listed[os.path.join(tmp, "a")] == []
+
+            changed, _ = next(watcher.batches())
+            assert [f.name for f in changed[os.path.join(tmp, "a")]] == ["late.jpg"]
+
+    def test_ignore_file_removed(self, tmp):
+        """A folder with an .exif_ignore stays watched, and is walked once the file is gone"""
+        ignored = os.path.join(tmp, "ignored")
+        os.makedirs(os.path.join(ignored, "sub"))
+        open(os.path.join(ignored, exif.EXIF_IGNORE_NAME), "w").close()
+        is_relevant = lambda name: name.endswith(".jpg") or name == exif.EXIF_IGNORE_NAME
+        with Watcher(tmp, is_relevant, settle=0.1) as watcher:
+            assert [d for d, _ in watcher.watch_tree(tmp)] == [tmp]
+            batches = watcher.batches()
+
+            os.remove(os.path.join(ignored, exif.EXIF_IGNORE_NAME))
+            changed, removed = next(batches)
+            assert sorted(changed) == [ignored, os.path.join(ignored, "sub")]
+            assert removed == []
+
+            open(os.path.join(ignored, exif.EXIF_IGNORE_NAME), "w").close()
+            changed, removed = next(batches)
+            assert changed == {}
+            assert sorted(removed) == [ignored, os.path.join(ignored, "sub")]
+            assert ignored in watcher.wds and os.path.join(ignored, "sub") not in watcher.wds
+
+            os.remove(os.path.join(ignored, exif.EXIF_IGNORE_NAME))
+            changed, _ = next(batches)
+            assert sorted(changed) == [ignored, os.path.join(ignored, "sub")]
+
+    def test_trickle_is_flushed(self, tmp):
+        """Events arriving faster than settle don't hold a batch back past max_wait"""
+        import threading
+        import time
+        stop = threading.Event()
+
+        def trickle():
+            for i in range(200):
+                if stop.wait(0.02):
+                    return
+                open(os.path.join(tmp, "%d.jpg" % i), "w").close()
+
+        with Watcher(tmp, lambda name: name.endswith(".jpg"), settle=1.0, max_wait=0.2) as watcher:
+            list(watcher.watch_tree(tmp))
+            thread = threading.Thread(target=trickle)
+            thread.start()
+            try:
+                start = time.monotonic()
+                changed, _ = next(watcher.batches())
+                assert time.monotonic() - start < 1.0
+                assert list(changed) == [tmp]
+            finally:
+                stop.set()
+                thread.join()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])